@@ -17,11 +17,59 @@ params.miniasm_script = file("$baseDir/scripts/miniasm_and_minipolish.sh")
 
 // ------- workflow -------
 
+// if true, each barcode is assembled as soon as it reaches the target depth
+// during basecalling, on a copy of the reads basecalled so far. Barcodes are
+// ready when `basecall.nf --track_coverage true` creates their
+// `barcodeXX.ready` marker in the coverage folder (see
+// `scripts/coverage_tracker.py`). Barcodes that never reach the target depth
+// are not assembled.
+params.early = false
+params.coverage_dir = file("runs/${params.run}/coverage")
+params.coverage_poll = '1min'
+
 // channel containing input reads
-fastq_input_ch = Channel.fromPath("${params.input_dir}/barcode*.fastq.gz")
+if ( params.early ) {
+    // the coverage folder is listed every `coverage_poll`, with the end
+    // marker last, and markers are also watched to pick them up right away.
+    // Only a listing ends the stream: markers are created before the end
+    // marker, so none is missed, also if created while the watch starts.
+    ready_ch = Channel.interval(params.coverage_poll) { files("${params.coverage_dir}/*") }
+        .flatMap { it.sort { f -> f.name == 'basecalling.done' } }
+        .mix(
+            Channel.watchPath("${params.coverage_dir}/barcode*.ready")
+        )
+        .until { it.name == 'basecalling.done' }
+        .filter { it.name ==~ /barcode.*\.ready/ }
+}
+else { ready_ch = Channel.empty() }
+
+// copies the reads of a barcode basecalled so far, while basecalling is running
+process snapshot_reads {
+
+    label 'q30m_1core'
+
+    input:
+        val(marker) from ready_ch.unique { it.name }
+
+    output:
+        path("${marker.getSimpleName()}.fastq.gz") into fastq_snapshot_ch
+
+    script:
+        """
+        python3 $baseDir/scripts/coverage_tracker.py snapshot \
+            ${params.input_dir}/${marker.getSimpleName()}.fastq.gz \
+            ${marker.getSimpleName()}.fastq.gz
+        """
+}
+
+if ( params.early ) { fastq_input_ch = fastq_snapshot_ch }
+else { fastq_input_ch = Channel.fromPath("${params.input_dir}/barcode*.fastq.gz") }
 
-// pre-filtering step with fitlong
-process filtlong {
+// pre-filtering step: discards reads shorter than 1 kbp, and keeps the longest
+// reads making up 95% of the bases (as `filtlong --min_length 1000
+// --keep_percent 95`, ranking reads by length only). Filtered reads are written
+// compressed, so no uncompressed copy of the reads is stored in the work folder.
+process length_filter {
 
     label 'q30m'
 
@@ -30,11 +78,15 @@ process filtlong {
 
 
     output:
-        tuple val("${fastq_file.getSimpleName()}"), file ("reads.fastq") into fastq_filtered_ch
+        tuple val("${fastq_file.getSimpleName()}"), file ("reads.fastq.gz") into fastq_filtered_ch
 
     script:
         """
-        filtlong --min_length 1000 --keep_percent 95 $fastq_file > reads.fastq
+        python3 $baseDir/scripts/length_filter.py $fastq_file \
+            --min_length 1000 \
+            --keep_percent 95 \
+            --threads ${task.cpus} \
+            --out reads.fastq.gz
         """
 }
 
@@ -51,7 +103,7 @@ process subsampler {
     errorStrategy 'ignore'
 
     input:
-        tuple val (bc), file ("reads.fastq") from to_subsampler
+        tuple val (bc), file ("reads.fastq.gz") from to_subsampler
 
 
     output:
@@ -60,7 +112,7 @@ process subsampler {
     script:
         """
         trycycler subsample \
-            --reads reads.fastq \
+            --reads reads.fastq.gz \
             --out_dir ${bc} \
             --threads 16 \
             # --min_read_depth 1
@@ -152,7 +204,9 @@ assembled_ch = flye_out.mix(raven_out, mini_out).groupTuple(size: 12).join(to_cl
 
 // trycicler cluster. Takes as input the assembly files for each barcode, along with the
 // fastq reads. Resulting clusters are saved in the `clustering/barcodeXX` folder
-// for further inspection.
+// for further inspection, along with the filtered reads (compressed, as
+// `filtered_reads.fastq.gz`). The whole folder, reads included, is copied to
+// the clustering folder.
 process trycycler_cluster {
 
     label 'q30m'
@@ -160,7 +214,7 @@ process trycycler_cluster {
     publishDir params.trycyler_dir, mode: 'copy'
 
     input:
-        tuple val(barcode), file("assemblies_*.fasta"), file("reads.fastq") from assembled_ch
+        tuple val(barcode), file("assemblies_*.fasta"), file("reads.fastq.gz") from assembled_ch
 
     output:
         file("$barcode")
@@ -168,10 +222,11 @@ process trycycler_cluster {
     script:
         """
         trycycler cluster \
-            --reads reads.fastq \
+            --reads reads.fastq.gz \
             --assemblies assemblies_*.fasta \
             --out_dir $barcode
 
-        cp reads.fastq $barcode/filtlong_reads.fastq
+        ln -L reads.fastq.gz $barcode/filtered_reads.fastq.gz \
+            || cp reads.fastq.gz $barcode/filtered_reads.fastq.gz
         """
 }
@@ -64,7 +64,8 @@ process basecall {
         path fast5_file from fast5_ch
 
     output:
-        path "**/fastq_pass/*/*.fastq.gz" optional true into fastq_ch
+        tuple val("${fast5_file.getSimpleName()}"),
+            path("**/fastq_pass/*/*.fastq.gz") optional true into fastq_ch
 
 
     script:
@@ -86,80 +87,200 @@ process basecall {
 
 }
 
-// Group results by barcode using the name of the parent
-// folder in which files are stored (created by guppy)
-fastq_barcode_ch = fastq_ch.flatten()
+// Assign to each basecalled file its barcode, using the name of the
+// parent folder in which files are stored (created by guppy), and a
+// unique batch id composed of the fast5 file name and the fastq file name.
+fastq_barcode_ch = fastq_ch
+                    .transpose()
                     .tap { fastq_tap_ch }
-                    .map { x -> [x.getParent().getName(), x] }
-                    .groupTuple()
-
-// This process takes as input a tuple composed of a barcode
-// and a list of fastq.gz files corresponding to that barcode.
-// It decompresses and concatenates these files, returning
-// a unique compressed filename that is named `barcodeXX.fastq.gz`,
-// where `XX` is the barcode number
-process concatenate_and_compress {
-
-    label 'q6h'
-
-    publishDir params.basecall_dir, mode: 'move'
+                    .tap { fastq_daemon_ch }
+                    .map { fast5, fq -> [fq.getParent().getName(), "${fast5}/${fq.name}", fq] }
+
+// if true, the per-batch statistics of the reads are also saved in the
+// statistics cache (see `scripts/stats_cache.py`). Off by default, since
+// each batch is usually scanned only once.
+params.stats_cache = false
+
+// This process appends each basecalled fastq.gz file to the
+// corresponding `barcodeXX.fastq.gz` file in the basecalled folder
+// as soon as it is produced, where `XX` is the barcode number.
+// Gzip members are copied without being recompressed, after checking
+// their CRC and size. A manifest of the appended batches makes the
+// append crash-safe and avoids duplicated reads when resuming.
+// If `params.bgzf` is set, reads are instead recompressed in BGZF
+// format and indexed in `barcodeXX.fastq.gz.fqi`, allowing random
+// access to reads by position or id (see `scripts/fastq_index.py`).
+// If `params.track_coverage` is set, the bases of the batch are also
+// added to the estimated depth of the barcode in `coverage_dir`, and the
+// marker `barcodeXX.ready` is created when the barcode reaches
+// `target_depth` (see `scripts/coverage_tracker.py`), so that its
+// assembly can start before the end of the run (`assemble.nf --early`).
+params.bgzf = true
+params.track_coverage = false
+params.coverage_dir = file("runs/${params.run}/coverage")
+params.genome_size = 5e6
+params.target_depth = 100
+process append_to_barcode {
+
+    label 'q30m_1core'
 
     input:
-        tuple val(barcode), file('reads_*.fastq.gz') from fastq_barcode_ch
-
-    output:
-        file "${barcode}.fastq.gz"
+        tuple val(barcode), val(batch_id), file('reads.fastq.gz') from fastq_barcode_ch
 
     script:
     """
-    # decompress with gzip, concatenate and compress with gz
-    gzip -dc reads_*.fastq.gz | gzip -c > ${barcode}.fastq.gz
+    mkdir -p ${params.basecall_dir}
+    python3 $baseDir/scripts/barcode_merge.py \
+        ${params.basecall_dir}/${barcode}.fastq.gz \
+        ${batch_id} \
+        reads.fastq.gz \
+        ${params.bgzf ? '--bgzf' : ''}
+    if ${params.track_coverage}; then
+        python3 $baseDir/scripts/coverage_tracker.py update \
+            ${params.coverage_dir} \
+            ${barcode} \
+            ${batch_id} \
+            reads.fastq.gz \
+            --genome_size ${params.genome_size} \
+            --target_depth ${params.target_depth} \
+            ${params.stats_cache ? '--cache' : ''}
+    fi
     """
 }
 
+// marks the end of basecalling for `assemble.nf --early`
+if ( params.track_coverage ) {
+    workflow.onComplete {
+        if ( workflow.success ) {
+            file(params.coverage_dir).mkdirs()
+            file("${params.coverage_dir}/basecalling.done").text = "${workflow.complete}\n"
+        }
+    }
+}
+
 // directory to store live statistics on the basecalling
 params.bcstats_dir = file("runs/${params.run}/basecalling_stats")
 
-// if live_stats is set to true, create a file to contain the stats
-if (params.live_stats) {
-    // create directory
-    params.bcstats_dir.mkdirs()
-    // create csv stats file and write header
-    bc_stats_file = file("${params.bcstats_dir}/bc_stats.csv")
-    bc_stats_file.text = 'len,barcode,time\n'
+// number of new statistics shards after which shards are compacted
+params.compact_every = 20
+
+// if true, the live statistics are computed by a long-lived daemon
+// (`scripts/stats_daemon.py`) started with the workflow, instead of a new
+// python process for each batch. The daemon keeps the per-barcode summary
+// in memory, and periodically saves shards and `summary.npz` in
+// `bcstats_dir`. The Unix socket must be on a local filesystem.
+params.stats_daemon = false
+params.stats_socket = "/tmp/basecall_stats_${params.run}.sock"
+params.stats_daemon_jobs = 4
+
+if ( params.live_stats && params.stats_daemon ) {
+    file(params.bcstats_dir).mkdirs()
+    def daemon_cmd = [
+        "python3", "$baseDir/scripts/stats_daemon.py",
+        params.stats_socket, params.bcstats_dir.toString(),
+        "--jobs", params.stats_daemon_jobs.toString()
+    ] + (params.stats_cache ? ["--cache"] : [])
+    def daemon_log = new File("${params.bcstats_dir}/stats_daemon.log")
+    new ProcessBuilder(daemon_cmd)
+        .redirectErrorStream(true)
+        .redirectOutput(ProcessBuilder.Redirect.appendTo(daemon_log))
+        .start()
+    // stopping the daemon saves a last checkpoint
+    workflow.onComplete {
+        ["python3", "$baseDir/scripts/stats_client.py", "stop", params.stats_socket]
+            .execute().waitFor()
+    }
 }
 
-// Create the input channel for the stat as a mix of a channel with a single file
-// and the feedback channel
-bc_stats_init = Channel.fromPath("${params.bcstats_dir}/bc_stats.csv")
-feedback_ch = Channel.create()
-bc_stats_in = bc_stats_init.mix( feedback_ch )
-
-// creates a csv file with read length, barcode and timestamp
-// content of the file get appended to the file "bc_stats.csv"
-// The feedback loop avoids that multiple threads try to append
-// text on the same file.
+// creates a statistics shard with read length, barcode and timestamp
+// for every batch of 50 files. Shards are small and immutable, so that
+// batches can be processed in parallel and each publish only copies
+// the new shard.
 process basecalling_live_report {
 
     label 'q30m'
 
-    publishDir params.bcstats_dir, mode: 'copy'
+    publishDir params.bcstats_dir, mode: 'copy', pattern: 'shard_*.npz'
 
     input:
-        file('reads_*.fastq.gz') from fastq_tap_ch.collate(50)
-        file('bc_stats.csv') from bc_stats_in
+        file('reads_*.fastq.gz') from fastq_tap_ch.map { it[1] }.collate(50)
 
     output:
-        file('bc_stats.csv') into feedback_ch
+        file('shard_*.npz') into bc_stats_shards_ch
+        file('summary_*.npz') into bc_summary_ch
+
+    when:
+        params.live_stats && !params.stats_daemon
+
+    script:
+        """
+        python3 $baseDir/scripts/basecall_stats.py reads_*.fastq.gz \
+            --jobs ${task.cpus} \
+            --out . \
+            --summary . \
+            ${params.stats_cache ? '--cache' : ''}
+        """
+}
+
+// sends each batch of 50 files to the statistics daemon, and waits until
+// they are processed. It runs on the machine of the daemon, which is
+// reached through its Unix socket.
+process stats_daemon_report {
+
+    executor 'local'
+
+    input:
+        file('reads_*.fastq.gz') from fastq_daemon_ch.map { it[1] }.collate(50)
+
+    when:
+        params.live_stats && params.stats_daemon
+
+    script:
+        """
+        python3 $baseDir/scripts/stats_client.py process ${params.stats_socket} \
+            reads_*.fastq.gz
+        """
+}
+
+// merges the per-batch summary into the `summary.npz` file, a small
+// per-barcode summary of the reads from which plots can be generated
+// without loading the statistics of each single read.
+process update_live_summary {
+
+    label 'q30m_1core'
+
+    maxForks 1
+
+    input:
+        file(batch_summary) from bc_summary_ch
+
+    when:
+        params.live_stats && !params.stats_daemon
+
+    script:
+        """
+        python3 $baseDir/scripts/read_summary.py \
+            ${params.bcstats_dir}/summary.npz \
+            $batch_summary
+        """
+}
+
+// merges the published shards in the background, every
+// `compact_every` new shards, to keep the number of files small.
+process compact_live_stats {
+
+    label 'q30m_1core'
+
+    maxForks 1
+
+    input:
+        val(shards) from bc_stats_shards_ch.buffer(size: params.compact_every)
 
     when:
-        params.live_stats
+        params.live_stats && !params.stats_daemon
 
     script:
         """
-        gzip -dc reads_*.fastq.gz > reads.fastq
-        python3 $baseDir/scripts/basecall_stats.py reads.fastq
-        tail -n +2 basecalling_stats.csv >> bc_stats.csv
-        rm reads.fastq
+        python3 $baseDir/scripts/stats_store.py compact ${params.bcstats_dir}
         """
-}
\ No newline at end of file
+}
@@ -0,0 +1,84 @@
+# Benchmark of the concatenation of per-batch fastq.gz files into a single
+# barcode file: `gzip -dc | gzip -c` (previous implementation of the
+# `concatenate_and_compress` process) against `concat_gz.py`.
+# Usage: python3 benchmarks/bench_concat_gz.py [--n_files N] [--n_reads N]
+
+import argparse
+import gzip
+import hashlib
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "scripts"))
+from bench_fastq_scan import write_synthetic_fastq
+from concat_gz import concatenate
+
+
+def content_hash(path):
+    """md5 of the decompressed content of a gzip file."""
+    h = hashlib.md5()
+    with gzip.open(path, "rb") as f:
+        while chunk := f.read(1024**2):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def gzip_pipeline(out_file, files):
+    with open(out_file, "wb") as out:
+        subprocess.run(
+            "gzip -dc " + " ".join(map(str, files)) + " | gzip -c",
+            shell=True,
+            check=True,
+            stdout=out,
+        )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="benchmark concatenation of gzipped fastq files"
+    )
+    parser.add_argument("--n_files", type=int, default=20, help="number of files")
+    parser.add_argument(
+        "--n_reads", type=int, default=2000, help="number of reads per file"
+    )
+    parser.add_argument(
+        "--threads", type=int, default=4, help="threads for BGZF recompression"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        files = []
+        for i in range(args.n_files):
+            files.append(tmp / f"reads_{i}.fastq.gz")
+            write_synthetic_fastq(files[-1], args.n_reads, seed=i)
+        in_size = sum(f.stat().st_size for f in files)
+
+        methods = {
+            "gzip -dc | gzip -c": lambda out: gzip_pipeline(out, files),
+            "concat_gz (checked)": lambda out: concatenate(out, files),
+            "concat_gz (no check)": lambda out: concatenate(out, files, check=False),
+            f"concat_gz --bgzf ({args.threads} threads)": lambda out: concatenate(
+                out, files, bgzf=True, threads=args.threads
+            ),
+        }
+
+        print(f"input: {args.n_files} files, {in_size / 1024**2:.1f} MB compressed")
+        print(f"{'method':<34} {'time (s)':>9} {'MB/s':>8} {'out MB':>8}")
+        reference = None
+        for name, method in methods.items():
+            out = tmp / "out.fastq.gz"
+            t0 = time.perf_counter()
+            method(out)
+            dt = time.perf_counter() - t0
+            h = content_hash(out)
+            reference = reference or h
+            assert h == reference, f"content mismatch for {name}"
+            out_size = out.stat().st_size / 1024**2
+            print(
+                f"{name:<34} {dt:>9.3f} {in_size / 1024**2 / dt:>8.1f} {out_size:>8.1f}"
+            )
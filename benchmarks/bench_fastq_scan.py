@@ -0,0 +1,89 @@
+# Benchmark of the streaming fastq scanner used by `basecall_stats.py`
+# against the previous implementation based on `list(SeqIO.parse(...))`.
+# Usage: python3 benchmarks/bench_fastq_scan.py [--n_reads N ...]
+
+import argparse
+import gzip
+import pathlib
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "scripts"))
+from fastq_scan import FastqScanner
+
+
+def write_synthetic_fastq(path, n_reads, n_barcodes=12, seed=0):
+    """Writes a gzipped fastq file with `n_reads` nanopore-like reads, with
+    log-normal lengths and guppy-style headers."""
+    rng = np.random.default_rng(seed)
+    lengths = rng.lognormal(mean=8.5, sigma=0.8, size=n_reads).astype(int) + 1
+    barcodes = rng.integers(0, n_barcodes + 1, size=n_reads)
+    bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+    with gzip.open(path, "wb", compresslevel=1) as f:
+        for i, (l, b) in enumerate(zip(lengths, barcodes)):
+            bc = f"barcode{b:02d}" if b > 0 else "unclassified"
+            seq = bases[rng.integers(0, 4, size=l)].tobytes()
+            qual = (rng.integers(5, 40, size=l, dtype=np.uint8) + 33).tobytes()
+            header = f"@read_{i} runid=0 ch=1 start_time=0 barcode={bc}"
+            f.write(header.encode() + b"\n" + seq + b"\n+\n" + qual + b"\n")
+
+
+def seqio_stats(path):
+    """Previous implementation: returns the list of (length, barcode)."""
+    from Bio import SeqIO
+
+    with gzip.open(path, "rt") as f:
+        records = list(SeqIO.parse(f, "fastq"))
+    data = []
+    for record in records:
+        dt = {"len": len(record)}
+        for dc in str.split(record.description):
+            if "barcode=" in dc:
+                dt["barcode"] = dc[len("barcode=") :]
+        data.append(dt)
+    return data
+
+
+def scanner_stats(path):
+    """Streaming scanner: returns the total length and number of reads."""
+    scanner = FastqScanner()
+    n, tot = 0, 0
+    for lengths, _, _ in scanner.scan(path):
+        n += len(lengths)
+        tot += int(lengths.sum())
+    return n, tot
+
+
+def timeit(func, *args):
+    t0 = time.perf_counter()
+    res = func(*args)
+    return time.perf_counter() - t0, res
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="benchmark fastq scanner against Biopython SeqIO"
+    )
+    parser.add_argument(
+        "--n_reads",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 50000],
+        help="number of reads of the synthetic files",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'n reads':>10} {'seqio (s)':>10} {'scanner (s)':>12} {'speedup':>8}")
+        for n_reads in args.n_reads:
+            fq = pathlib.Path(tmp) / f"reads_{n_reads}.fastq.gz"
+            write_synthetic_fastq(fq, n_reads)
+            t_seqio, data = timeit(seqio_stats, fq)
+            t_scan, (n, tot) = timeit(scanner_stats, fq)
+            assert n == len(data) and tot == sum(d["len"] for d in data)
+            print(
+                f"{n_reads:>10} {t_seqio:>10.3f} {t_scan:>12.3f} {t_seqio / t_scan:>8.1f}"
+            )
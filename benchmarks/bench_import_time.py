@@ -0,0 +1,115 @@
+# Startup cost of the scripts that Nextflow invokes once per batch of reads
+# (`basecall_stats.py`, `barcode_merge.py`, `stats_store.py`...), for which
+# importing the modules can take longer than the work itself. Each module is
+# imported in a fresh interpreter with `python -X importtime`, and the check
+# fails if it imports one of the heavy packages (pandas, matplotlib,
+# Biopython, scipy) or if its import time exceeds that of numpy, which all
+# of them need, by more than a given budget.
+#
+#   python3 benchmarks/bench_import_time.py [--budget_ms 100] [--repeat 5]
+#
+# Heavy packages must be imported inside the functions that need them, see
+# e.g. `generate_plots.load_summary`.
+
+import argparse
+import pathlib
+import subprocess
+import sys
+
+SCRIPTS_DIR = pathlib.Path(__file__).resolve().parent.parent / "scripts"
+
+HEAVY = ("pandas", "matplotlib", "Bio", "scipy")
+
+# modules of the per-batch invocations and of the scripts whose common paths
+# do not need the heavy packages
+FAST_MODULES = [
+    "basecall_stats",
+    "barcode_merge",
+    "coverage_tracker",
+    "read_summary",
+    "stats_store",
+    "stats_client",
+    "fastq_index",
+    "length_filter",
+    "order_concat_fasta",
+    "generate_plots",
+]
+
+
+def import_time(module):
+    """Imports a module in a new interpreter. Returns the cumulative import
+    time (ms) and the names of all the imported modules."""
+    cmd = [sys.executable, "-X", "importtime", "-c", f"import {module}"]
+    res = subprocess.run(
+        cmd, cwd=SCRIPTS_DIR, capture_output=True, text=True, check=True
+    )
+    total, imported = None, set()
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue  # header line
+        name = name.strip()
+        imported.add(name)
+        if name == module:
+            total = int(cumulative) / 1000
+    return total, imported
+
+
+def best_import_time(module, repeat):
+    """Fastest of `repeat` imports, to reduce the noise of the filesystem
+    cache and of other processes."""
+    runs = [import_time(module) for _ in range(repeat)]
+    return min(t for t, _ in runs), runs[0][1]
+
+
+def check(modules, budget_ms, repeat):
+    """Prints the import time of each module, and returns the list of the
+    problems found."""
+    baseline, _ = best_import_time("numpy", repeat)
+    print(f"{'module':<22} {'import (ms)':>11} {'over numpy':>10}  heavy imports")
+    print(f"{'numpy':<22} {baseline:>11.1f} {0:>10.1f}")
+    problems = []
+    for module in modules:
+        t, imported = best_import_time(module, repeat)
+        heavy = sorted(p for p in HEAVY if p in imported)
+        print(f"{module:<22} {t:>11.1f} {t - baseline:>10.1f}  {' '.join(heavy)}")
+        if heavy:
+            problems.append(f"{module} imports {', '.join(heavy)}")
+        if t - baseline > budget_ms:
+            problems.append(
+                f"{module} takes {t - baseline:.0f} ms more than numpy to import "
+                + f"(budget {budget_ms:.0f} ms)"
+            )
+    return problems
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="check the import time of the per-batch scripts"
+    )
+    parser.add_argument(
+        "modules",
+        type=str,
+        nargs="*",
+        default=FAST_MODULES,
+        help="modules of the scripts folder to check (default: the scripts run "
+        + "per batch and those whose common paths avoid the heavy packages)",
+    )
+    parser.add_argument(
+        "--budget_ms",
+        type=float,
+        default=100,
+        help="maximum import time of a module, in excess of that of numpy",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="imports per module, the fastest is kept"
+    )
+    args = parser.parse_args()
+
+    problems = check(args.modules, args.budget_ms, args.repeat)
+    for p in problems:
+        print(f"FAIL: {p}", file=sys.stderr)
+    exit(1 if problems else 0)
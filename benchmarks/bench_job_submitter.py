@@ -0,0 +1,119 @@
+# Check of the basecalling job submitter (`basecalling_job_submitter.py` in
+# `old-scripts`) without a cluster. The submitter is run on a folder of fake
+# fast5 files, with `fake_sbatch.py` as scheduler and a fake basecalling
+# script that copies each file to its `fastq` folder. The queue command
+# reports a full queue for the first calls, so that submission is postponed.
+# Each scenario checks that every file is basecalled exactly once, that no
+# job array is larger than `--batch_size` and `--max_queued`, and that the
+# retry delays double.
+#
+# Usage: python3 benchmarks/bench_job_submitter.py [--n_files N] [--interval S]
+
+import argparse
+import os
+import pathlib
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = pathlib.Path(__file__).resolve().parent
+SUBMITTER = BENCH_DIR.parent / "old-scripts" / "basecalling_job_submitter.py"
+
+BASECALL_SCRIPT = """#!/bin/bash
+#SBATCH --time=00:10:00
+#SBATCH --cpus-per-task=1
+mkdir -p "$2"
+cp "$1/nanopore_raw_read.fast5" "$2/reads.fastq"
+"""
+
+# reports `max_queued` jobs for the first `busy` calls, then an empty queue
+QUEUE_SCRIPT = """#!/bin/bash
+n=$(cat "{calls}" 2>/dev/null || echo 0)
+echo $((n + 1)) > "{calls}"
+if [ "$n" -lt {busy} ]; then seq 1 {max_queued}; fi
+"""
+
+
+def run_submitter(folder, n_files, interval, batch_size, max_queued, busy):
+    """Runs the submitter until all files are submitted. Returns the sizes of
+    the submitted job arrays, the retry delays and the elapsed time."""
+    fast5 = folder / "fast5"
+    fast5.mkdir()
+    for i in range(n_files):
+        (fast5 / f"read_{i:04d}.fast5").write_text(f"read {i}\n")
+    (fast5 / "end-signal.fast5").write_text("")
+    script = folder / "guppy_basecalling.sh"
+    script.write_text(BASECALL_SCRIPT)
+    queue = folder / "squeue.sh"
+    calls = folder / "queue_calls"
+    queue.write_text(QUEUE_SCRIPT.format(calls=calls, busy=busy, max_queued=max_queued))
+    scheduler = f"{shlex.quote(sys.executable)} {BENCH_DIR / 'fake_sbatch.py'}"
+    cmd = [sys.executable, SUBMITTER, "--flowcell", "FLO-MIN106"]
+    cmd += ["--kit", "SQK-RBK004", "--polling", "--interval", str(interval)]
+    cmd += ["--batch_size", str(batch_size), "--max_queued", str(max_queued)]
+    cmd += ["--max_age", str(10 * interval), "--submit_script", str(script)]
+    cmd += ["--scheduler", scheduler, "--queue_cmd", f"bash {queue}"]
+    env = dict(os.environ, FAKE_SBATCH_COUNTER=str(folder / "job_id"))
+    start = time.perf_counter()
+    res = subprocess.run(
+        list(map(str, cmd)),
+        cwd=folder,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=120 + 100 * interval,
+    )
+    elapsed = time.perf_counter() - start
+    if res.returncode != 0:
+        raise RuntimeError(f"the submitter failed:\n{res.stdout}\n{res.stderr}")
+    sizes = [int(n) for n in re.findall(r"Submitted (\d+) fast5 files", res.stdout)]
+    delays = [
+        float(d) for d in re.findall(r"jobs queued, retrying in (\S+) s", res.stdout)
+    ]
+    return sizes, delays, elapsed
+
+
+def check_basecalled(folder, n_files):
+    """Checks that each file was basecalled once, from its own folder."""
+    assert not list((folder / "fast5").glob("read_*.fast5")), "files not submitted"
+    for i in range(n_files):
+        fastq = folder / "basecalling" / f"read_{i:04d}" / "fastq" / "reads.fastq"
+        assert fastq.is_file(), f"{fastq} not basecalled"
+        assert fastq.read_text() == f"read {i}\n", f"{fastq} has the wrong reads"
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="check of the job submitter")
+    parser.add_argument("--n_files", type=int, default=40, help="fast5 files")
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.1,
+        help="seconds between checks of the files, and first retry delay",
+    )
+    args = parser.parse_args()
+
+    # (batch_size, max_queued, calls reporting a full queue)
+    scenarios = [(8, 100, 0), (8, 100, 3), (10, 4, 0)]
+    for batch_size, max_queued, busy in scenarios:
+        with tempfile.TemporaryDirectory() as tmp:
+            folder = pathlib.Path(tmp)
+            sizes, delays, elapsed = run_submitter(
+                folder, args.n_files, args.interval, batch_size, max_queued, busy
+            )
+            print(
+                f"batch_size {batch_size}, max_queued {max_queued}, "
+                f"{busy} full queue replies: {len(sizes)} job arrays "
+                f"({elapsed:.2f} s), retries after {delays} s"
+            )
+            check_basecalled(folder, args.n_files)
+            assert sum(sizes) == args.n_files, "files submitted more than once"
+            assert max(sizes) <= min(batch_size, max_queued), "job array too large"
+            # delays are printed with 6 significant digits
+            expected = [float(f"{args.interval * 2**i:g}") for i in range(busy)]
+            assert delays == expected, f"retry delays {delays}, expected {expected}"
+    print("all files submitted once, back-off as expected")
@@ -0,0 +1,132 @@
+# Benchmark of the computation of the mean quality of each read: the
+# vectorized `fastq_scan.read_mean_q`, which decodes the quality lines of a
+# whole block of reads at once and averages the error probabilities with
+# `np.add.reduceat`, against naive per-read implementations (a Python loop
+# over the quality characters and numpy on each read), on quality lines
+# already in memory. With `--seqio`, the whole scan of the file by
+# `FastqScanner` is also compared with Biopython records. The mean quality is
+# computed from the average error probability of the bases, as by guppy, and
+# all implementations must agree.
+#
+# Usage: python3 benchmarks/bench_mean_q.py [--n_reads N ...] [--seqio]
+
+import argparse
+import gzip
+import itertools
+import math
+import pathlib
+import sys
+import tempfile
+import time
+import numpy as np
+
+BENCH_DIR = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent / "scripts"))
+import synthetic
+from fastq_scan import FastqScanner, iter_records_blocks, open_fastq, read_mean_q
+
+ERROR_PROB = [10 ** (-(c - 33) / 10) for c in range(256)]
+
+
+def quality_blocks(path):
+    """Returns the quality lines of the reads, in blocks."""
+    with open_fastq(path) as stream:
+        return [lines[3::4] for lines in iter_records_blocks(stream)]
+
+
+def python_loop(blocks):
+    """Per-read Python loop over the quality characters."""
+    res = []
+    for qual in itertools.chain(*blocks):
+        err = sum(ERROR_PROB[c] for c in qual)
+        res.append(-10 * math.log10(err / len(qual)) if qual else math.nan)
+    return np.array(res)
+
+
+def numpy_per_read(blocks):
+    """Numpy on each read separately."""
+    prob = np.array(ERROR_PROB)
+    res = []
+    for qual in itertools.chain(*blocks):
+        q = np.frombuffer(qual, dtype=np.uint8)
+        res.append(-10 * np.log10(prob[q].mean()) if len(q) else np.nan)
+    return np.array(res)
+
+
+def vectorized(blocks):
+    """`read_mean_q` on each block of reads."""
+    res = []
+    for quals in blocks:
+        lengths = np.fromiter(map(len, quals), dtype=np.int64, count=len(quals))
+        res.append(read_mean_q(quals, lengths))
+    return np.concatenate(res)
+
+
+def seqio_records(path):
+    """Biopython records, from the phred scores of `letter_annotations`."""
+    from Bio import SeqIO
+
+    res = []
+    with gzip.open(path, "rt") as f:
+        for record in SeqIO.parse(f, "fastq"):
+            phred = record.letter_annotations["phred_quality"]
+            err = sum(10 ** (-q / 10) for q in phred)
+            res.append(-10 * math.log10(err / len(phred)) if phred else math.nan)
+    return np.array(res)
+
+
+def scanner(path):
+    """`FastqScanner`, which also computes lengths and barcodes."""
+    return np.concatenate([q.copy() for _, _, q in FastqScanner().scan(path)])
+
+
+def timeit(func, *args):
+    t0 = time.perf_counter()
+    res = func(*args)
+    return time.perf_counter() - t0, res
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="benchmark of the vectorized mean read quality"
+    )
+    parser.add_argument(
+        "--n_reads",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 50000],
+        help="number of reads of the synthetic files",
+    )
+    parser.add_argument(
+        "--seqio", help="also time Biopython records (slow)", action="store_true"
+    )
+    args = parser.parse_args()
+
+    methods = {
+        "python loop": python_loop,
+        "numpy per read": numpy_per_read,
+        "vectorized": vectorized,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print("mean quality of reads already in memory")
+        print(f"{'n reads':>10} " + " ".join(f"{m + ' (s)':>18}" for m in methods))
+        files = {}
+        for n_reads in args.n_reads:
+            fq = pathlib.Path(tmp) / f"reads_{n_reads}.fastq.gz"
+            files[n_reads] = synthetic.write_fastq(fq, n_reads)
+            blocks = quality_blocks(fq)
+            times, results = zip(*(timeit(f, blocks) for f in methods.values()))
+            for res in results[:-1]:
+                np.testing.assert_allclose(res, results[-1], rtol=1e-6)
+            print(f"{n_reads:>10} " + " ".join(f"{t:>18.3f}" for t in times))
+
+        if args.seqio:
+            print("whole file, including decompression and parsing")
+            print(f"{'n reads':>10} {'biopython (s)':>18} {'scanner (s)':>18}")
+            for n_reads, fq in files.items():
+                t_seqio, res_seqio = timeit(seqio_records, fq)
+                t_scan, res_scan = timeit(scanner, fq)
+                np.testing.assert_allclose(res_seqio, res_scan, rtol=1e-5)
+                print(f"{n_reads:>10} {t_seqio:>18.3f} {t_scan:>18.3f}")
@@ -0,0 +1,126 @@
+# Benchmark and check of the statistics daemon (`stats_daemon.py`) on
+# synthetic batches of reads. Each batch is first processed by running
+# `basecall_stats.py` (as the `basecalling_live_report` process does), then
+# by the client of a running daemon. The summary saved by the daemon must be
+# identical to the merged per-batch summaries, and must not change when the
+# daemon is restarted and the same batches are sent again.
+#
+# Usage: python3 benchmarks/bench_stats_daemon.py [--n_batches N] [--n_reads N]
+
+import argparse
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+BENCH_DIR = pathlib.Path(__file__).resolve().parent
+SCRIPTS_DIR = BENCH_DIR.parent / "scripts"
+sys.path.insert(0, str(SCRIPTS_DIR))
+import synthetic
+from read_summary import ReadSummary, merge_files
+import stats_daemon
+from stats_client import request
+import stats_store
+
+BARCODES = [f"barcode{i:02d}" for i in range(1, 13)]
+
+
+def run(*args):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, *map(str, args)], check=True)
+    return time.perf_counter() - start
+
+
+def start_daemon(sock, stats_dir, jobs):
+    cmd = [sys.executable, SCRIPTS_DIR / "stats_daemon.py", sock, stats_dir]
+    cmd += ["--jobs", str(jobs), "--checkpoint_every", "3600"]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    request(sock, {"cmd": "snapshot"}, wait_start=60)
+    return proc
+
+
+def stop_daemon(sock, proc):
+    request(sock, {"cmd": "stop"})
+    if proc.wait(timeout=60) != 0:
+        raise RuntimeError("the daemon failed")
+
+
+def same_summary(a, b):
+    order = [b.barcodes.index(bc) for bc in a.barcodes]
+    return sorted(a.barcodes) == sorted(b.barcodes) and all(
+        np.array_equal(getattr(a, k), getattr(b, k)[order])
+        for k in ("hist", "n_reads", "tot_bases", "min_len", "max_len")
+    )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="benchmark of the stats daemon")
+    parser.add_argument("--n_batches", type=int, default=20, help="number of batches")
+    parser.add_argument("--n_reads", type=int, default=4000, help="reads per batch")
+    parser.add_argument("--jobs", type=int, default=2, help="daemon workers")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        batches = [
+            synthetic.write_fastq(
+                tmp / f"batch_{i}.fastq.gz", args.n_reads, BARCODES, seed=i
+            )
+            for i in range(args.n_batches)
+        ]
+
+        # one process per batch
+        script_dir = tmp / "script"
+        script_dir.mkdir()
+        t_script = [
+            run(
+                SCRIPTS_DIR / "basecall_stats.py",
+                f,
+                "--out",
+                script_dir,
+                "--summary",
+                script_dir,
+            )
+            for f in batches
+        ]
+        expected = merge_files(
+            tmp / "expected.npz", sorted(script_dir.glob("summary_*.npz"))
+        )
+
+        # thin client of the daemon
+        sock, daemon_dir = tmp / "stats.sock", tmp / "daemon"
+        proc = start_daemon(sock, daemon_dir, args.jobs)
+        client = SCRIPTS_DIR / "stats_client.py"
+        t_client = [run(client, "process", sock, f) for f in batches]
+        start = time.perf_counter()
+        snapshot = request(sock, {"cmd": "snapshot"})
+        t_snapshot = time.perf_counter() - start
+        stop_daemon(sock, proc)
+
+        # a restarted daemon skips the batches already processed
+        proc = start_daemon(sock, daemon_dir, args.jobs)
+        run(client, "process", sock, *batches)
+        stop_daemon(sock, proc)
+
+        summary = ReadSummary.load(daemon_dir / stats_daemon.SUMMARY_NAME)
+        n_reads = len(stats_store.read_stats(daemon_dir))
+        problems = []
+        if not same_summary(summary, expected):
+            problems.append("the summary differs from that of basecall_stats.py")
+        if n_reads != expected.n_reads.sum():
+            problems.append(
+                f"{n_reads} reads in the shards, {expected.n_reads.sum()} expected"
+            )
+        if sum(s["n_reads"] for s in snapshot["barcodes"].values()) != n_reads:
+            problems.append("the snapshot does not count all the reads")
+
+    print(f"{args.n_batches} batches of {args.n_reads} reads")
+    print(f"basecall_stats.py per batch:   {np.median(t_script) * 1000:8.1f} ms")
+    print(f"daemon client per batch:       {np.median(t_client) * 1000:8.1f} ms")
+    print(f"snapshot query:                {t_snapshot * 1000:8.1f} ms")
+    for p in problems:
+        print(f"FAIL: {p}", file=sys.stderr)
+    exit(1 if problems else 0)
@@ -0,0 +1,323 @@
+# Benchmark suite of the scripts on synthetic data (see `synthetic.py`) of
+# increasing size. Each case runs in its own process, whose wall time, CPU
+# time and peak resident memory are measured, and the throughput is computed
+# from the size of the input data. Scripts with a command line interface are
+# run end to end (including interpreter startup), archive functions are
+# called from a small driver.
+#
+# Results are saved in json format, together with the commit they refer to,
+# and can be compared with those of another commit:
+#
+#   python3 benchmarks/bench_suite.py --scales 1 4 --out new.json
+#   python3 benchmarks/bench_suite.py --compare old.json new.json
+
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = pathlib.Path(__file__).resolve().parent
+SCRIPTS_DIR = BENCH_DIR.parent / "scripts"
+sys.path.insert(0, str(SCRIPTS_DIR))
+import synthetic
+
+# size of the data at scale 1
+READS = 5000
+CONTIGS = 12
+CONTIG_LENGTH = 250000
+BARCODES = 12
+READS_PER_BARCODE = 500
+FAST5_FILES = 10
+FAST5_SIZE = 2 * 1024**2
+
+
+def dir_size(paths):
+    return sum(p.stat().st_size for p in paths)
+
+
+def n_reads(folder):
+    """Number of reads of `reads.fastq.gz` in the data folder of a scale."""
+    return READS * int(folder.name.split("_")[1])
+
+
+def generate(data_dir, scale):
+    """Generates (once) the data of a given scale. Returns the folder."""
+    folder = pathlib.Path(data_dir) / f"scale_{scale}"
+    done = folder / ".complete"
+    if done.is_file():
+        return folder
+    folder.mkdir(parents=True, exist_ok=True)
+    barcodes = [f"barcode{i:02d}" for i in range(1, BARCODES + 1)]
+    synthetic.write_fastq(folder / "reads.fastq.gz", READS * scale, barcodes)
+    synthetic.write_contig_files(folder / "contigs", CONTIGS, CONTIG_LENGTH * scale)
+    synthetic.make_run_tree(
+        folder / "run",
+        n_barcodes=BARCODES,
+        reads_per_barcode=READS_PER_BARCODE * scale,
+        n_fast5=FAST5_FILES * scale,
+        fast5_size=FAST5_SIZE,
+    )
+    done.touch()
+    return folder
+
+
+# ------- cases -------
+# each case returns the command to run, the input bytes and the number of
+# items (reads, contigs or files) processed
+
+
+def script(name, *args):
+    return [sys.executable, str(SCRIPTS_DIR / name), *map(str, args)]
+
+
+def driver(case, folder, out):
+    return [sys.executable, __file__, "--driver", case, str(folder), str(out)]
+
+
+def case_basecall_stats_csv(folder, out):
+    fq = folder / "reads.fastq.gz"
+    cmd = script("basecall_stats.py", fq, "--out", out / "stats.csv")
+    return cmd, fq.stat().st_size, n_reads(folder)
+
+
+def case_basecall_stats_npz(folder, out):
+    fq = folder / "reads.fastq.gz"
+    cmd = script("basecall_stats.py", fq, "--out", out / "stats.npz")
+    return cmd, fq.stat().st_size, n_reads(folder)
+
+
+def case_generate_plots(folder, out):
+    fq = folder / "reads.fastq.gz"
+    cmd = script("generate_plots.py", fq, "--dest", out, "--no_cache")
+    return cmd, fq.stat().st_size, n_reads(folder)
+
+
+def case_order_concat_fasta(folder, out):
+    files = sorted((folder / "contigs").glob("*.fasta"))
+    cmd = script("order_concat_fasta.py", "--prefix", out / "concat", *files)
+    return cmd, dir_size(files), len(files)
+
+
+def case_order_concat_fasta_stream(folder, out):
+    files = sorted((folder / "contigs").glob("*.fasta"))
+    cmd = script("order_concat_fasta.py", "--stream", "--prefix", out / "c", *files)
+    return cmd, dir_size(files), len(files)
+
+
+def case_sample_df_no_qc(folder, out):
+    files = list((folder / "run" / "basecalled").glob("*.fastq.gz"))
+    return driver("sample_df_no_qc", folder, out), dir_size(files), len(files)
+
+
+def case_sample_df_qc(folder, out):
+    files = list((folder / "run" / "basecalled").glob("*.fastq.gz"))
+    return driver("sample_df_qc", folder, out), dir_size(files), len(files)
+
+
+def case_tar_fast5(folder, out):
+    files = list((folder / "run" / "input").glob("*.fast5"))
+    return driver("tar_fast5", folder, out), dir_size(files), len(files)
+
+
+def case_copy_barcodes(folder, out):
+    files = list((folder / "run" / "basecalled").glob("*.fastq.gz"))
+    return driver("copy_barcodes", folder, out), dir_size(files), len(files)
+
+
+CASES = {
+    name[len("case_") :]: func
+    for name, func in list(globals().items())
+    if name.startswith("case_")
+}
+
+
+# ------- drivers of the archive functions, run in a separate process -------
+
+
+def run_driver(case, folder, out):
+    import archive
+    from barcode_qc import GENOME_SIZE, VALID_RULE
+    from copy_engine import copy_files
+    from fast5_tar import create_archive
+
+    run = pathlib.Path(folder) / "run"
+    out = pathlib.Path(out)
+    if case.startswith("sample_df"):
+        args = argparse.Namespace(
+            no_qc=case == "sample_df_no_qc",
+            no_cache=True,
+            threads=4,
+            genome_size=GENOME_SIZE,
+            valid_rule=VALID_RULE,
+            exp_id=None,
+            date=None,
+        )
+        archive.extract_barcodes(run)
+        archive.initialize_sample_df(run, args).to_csv(out / "sample.csv")
+    elif case == "tar_fast5":
+        create_archive(out, sorted((run / "input").glob("*.fast5")))
+    elif case == "copy_barcodes":
+        files = sorted((run / "basecalled").glob("*.fastq.gz"))
+        copy_files([(f, out / f.name) for f in files], threads=4, verbose=False)
+
+
+# ------- measurement -------
+
+
+# run in a fresh interpreter: runs the command given as arguments, and prints
+# its exit code, wall time, CPU time (s) and peak resident memory (kB)
+MEASURE_HELPER = """
+import resource, subprocess, sys, time
+start = time.perf_counter()
+code = subprocess.call(sys.argv[1:], stdout=subprocess.DEVNULL)
+wall = time.perf_counter() - start
+usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+print(code, wall, usage.ru_utime + usage.ru_stime, usage.ru_maxrss)
+"""
+
+
+def measure(cmd):
+    """Runs a command and returns its wall time, CPU time (s) and peak
+    resident memory (MB). The command is launched by a small helper
+    interpreter, which reports the resource usage of its child: a process
+    started directly by this one (even with `posix_spawn`, which uses vfork)
+    inherits the peak memory of this process. Commands lighter than an
+    interpreter are reported with its footprint (~10 MB)."""
+    env = dict(os.environ, MPLBACKEND="Agg")
+    with tempfile.TemporaryFile() as err:
+        res = subprocess.run(
+            [sys.executable, "-c", MEASURE_HELPER, *map(str, cmd)],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=err,
+            text=True,
+            check=True,
+        )
+        code, wall, cpu, rss = res.stdout.split()
+        if int(code) != 0:
+            err.seek(0)
+            raise RuntimeError(f"{' '.join(cmd)} failed:\n{err.read().decode()}")
+    return float(wall), float(cpu), int(rss) / 1024
+
+
+def run_case(name, folder, scale, repeat=1):
+    """Runs a case `repeat` times on fresh output folders, and returns the
+    result of the fastest run."""
+    best = None
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as out:
+            cmd, n_bytes, n_items = CASES[name](folder, pathlib.Path(out))
+            wall, cpu, rss = measure(cmd)
+        if best is None or wall < best["wall_s"]:
+            best = {
+                "case": name,
+                "scale": scale,
+                "wall_s": round(wall, 4),
+                "cpu_s": round(cpu, 4),
+                "max_rss_mb": round(rss, 1),
+                "input_mb": round(n_bytes / 1e6, 3),
+                "mb_per_s": round(n_bytes / 1e6 / wall, 3),
+                "items_per_s": None if n_items is None else round(n_items / wall, 3),
+            }
+    return best
+
+
+def git_commit():
+    try:
+        cmd = ["git", "rev-parse", "--short", "HEAD"]
+        return subprocess.check_output(cmd, cwd=BENCH_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_file, new_file, tolerance=0.1):
+    """Prints the ratio new/old of wall time and peak memory of each case,
+    flagging the cases slower by more than `tolerance`."""
+    old, new = [json.loads(pathlib.Path(f).read_text()) for f in (old_file, new_file)]
+    old_res = {(r["case"], r["scale"]): r for r in old["results"]}
+    print(f"{old['commit']} -> {new['commit']}")
+    print(f"{'case':<28} {'scale':>5} {'time':>7} {'memory':>7}")
+    for r in new["results"]:
+        o = old_res.get((r["case"], r["scale"]))
+        if o is None:
+            continue
+        t, m = r["wall_s"] / o["wall_s"], r["max_rss_mb"] / o["max_rss_mb"]
+        flag = "  slower" if t > 1 + tolerance else ""
+        print(f"{r['case']:<28} {r['scale']:>5} {t:>6.2f}x {m:>6.2f}x{flag}")
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) == 5 and sys.argv[1] == "--driver":
+        run_driver(*sys.argv[2:])
+        exit(0)
+
+    parser = argparse.ArgumentParser(description="benchmark suite of the scripts")
+    parser.add_argument(
+        "--scales",
+        type=int,
+        nargs="+",
+        default=[1, 4],
+        help="sizes of the synthetic data, as multiples of the smallest one",
+    )
+    parser.add_argument(
+        "--cases", type=str, nargs="+", choices=list(CASES), help="cases to run"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="runs per case, the fastest is kept"
+    )
+    parser.add_argument(
+        "--data_dir",
+        type=str,
+        help="folder where the synthetic data is generated (and reused). A "
+        + "temporary folder by default.",
+    )
+    parser.add_argument(
+        "--out", type=str, default="bench_results.json", help="json results file"
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        nargs=2,
+        metavar=("OLD", "NEW"),
+        help="compare two results files and exit",
+    )
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        compare(*args.compare)
+        exit(0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = tmp if args.data_dir is None else args.data_dir
+        results = []
+        print(
+            f"{'case':<28} {'scale':>5} {'wall (s)':>9} {'cpu (s)':>8} "
+            + f"{'rss (MB)':>9} {'MB/s':>8}"
+        )
+        for scale in args.scales:
+            folder = generate(data_dir, scale)
+            for name in args.cases or CASES:
+                r = run_case(name, folder, scale, args.repeat)
+                results.append(r)
+                print(
+                    f"{name:<28} {scale:>5} {r['wall_s']:>9.2f} {r['cpu_s']:>8.2f} "
+                    + f"{r['max_rss_mb']:>9.1f} {r['mb_per_s']:>8.1f}"
+                )
+
+    report = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    pathlib.Path(args.out).write_text(json.dumps(report, indent=2) + "\n")
+    print(f"results saved in {args.out}")
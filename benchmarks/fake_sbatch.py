@@ -0,0 +1,50 @@
+# Local stand-in for `sbatch`, to test job submitters without a cluster.
+# Job arrays are run immediately and sequentially, one process per task,
+# with `SLURM_ARRAY_TASK_ID` set. Only the `--array` and `--output` options
+# are interpreted, other options are ignored.
+# Usage: python3 benchmarks/fake_sbatch.py [--array=0-N] [--output=F] script
+
+import os
+import pathlib
+import subprocess
+import sys
+
+COUNTER = pathlib.Path(os.environ.get("FAKE_SBATCH_COUNTER", "/tmp/fake_sbatch_id"))
+
+
+def parse_array(spec):
+    """Task ids of an array specification such as `0-9` or `1,3,5-7`."""
+    ids = []
+    for part in spec.split("%")[0].split(","):
+        start, _, end = part.partition("-")
+        ids += range(int(start), int(end or start) + 1)
+    return ids
+
+
+def next_job_id():
+    job_id = int(COUNTER.read_text()) + 1 if COUNTER.is_file() else 1
+    COUNTER.write_text(str(job_id))
+    return job_id
+
+
+if __name__ == "__main__":
+
+    options, script = {}, None
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg.startswith("--"):
+            key, _, value = arg[2:].partition("=")
+            options[key] = value
+        elif script is None:
+            script = arg
+    job_id = next_job_id()
+    tasks = parse_array(options["array"]) if "array" in options else [None]
+    for task in tasks:
+        env = dict(os.environ, SLURM_JOB_ID=str(job_id))
+        output = options.get("output", f"slurm-{job_id}.out")
+        if task is not None:
+            env["SLURM_ARRAY_TASK_ID"] = str(task)
+            output = output.replace("%a", str(task))
+        with open(output.replace("%j", str(job_id)), "w") as out:
+            subprocess.run(["bash", script], env=env, stdout=out, stderr=out)
+    print(f"Submitted batch job {job_id}")
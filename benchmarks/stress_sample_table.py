@@ -0,0 +1,129 @@
+# Stress test of concurrent updates of an experiment `sample.csv` table.
+# Many archiver processes append their barcodes to the same table at the
+# same time, some of them being killed while holding the lock. At the end
+# the table must be a valid csv containing the rows of all processes that
+# completed their update. Other processes append rows and remove them again,
+# as a failed archive run does, which must not remove the rows of the other
+# processes. A stale lock (held, but recorded as owned by a dead process of
+# this host) is also simulated, and must be broken.
+
+import argparse
+import fcntl
+import multiprocessing as mp
+import os
+import pathlib
+import signal
+import socket
+import sys
+import tempfile
+import time
+import pandas as pd
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "scripts"))
+from sample_table import append_rows, locked, lock_path, remove_rows
+
+READ_KWARGS = {"dtype": {"barcode": int, "vial": str, "timepoint": str}}
+
+
+def archiver(table, worker, n_updates, start, rollback=False):
+    """Appends `n_updates` rows to the table, one update at a time. If
+    `rollback`, each update is removed right after."""
+    while time.time() < start:
+        pass
+    for i in range(n_updates):
+        df = pd.DataFrame(
+            {
+                "barcode": [worker],
+                "vial": [f"{worker:02d}"],
+                "timepoint": [str(i)],
+                "run": [f"run_{worker}"],
+            }
+        )
+        added = append_rows(table, df, READ_KWARGS)
+        if rollback:
+            remove_rows(table, added, READ_KWARGS)
+
+
+def crasher(table, start):
+    """Takes the lock and gets killed while holding it."""
+    while time.time() < start:
+        pass
+    with locked(table, verbose=False):
+        os.kill(os.getpid(), signal.SIGKILL)
+
+
+def noop():
+    pass
+
+
+def stale_holder(table, dead_pid, ready):
+    """Holds the lock forever, with the record of the dead process
+    `dead_pid` of this host, simulating a lock whose release was lost."""
+    fd = os.open(lock_path(table), os.O_RDWR | os.O_CREAT, 0o666)
+    fcntl.lockf(fd, fcntl.LOCK_EX)
+    os.write(fd, f"{dead_pid} {socket.gethostname()} 2000-01-01\n".encode())
+    ready.set()
+    time.sleep(3600)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="stress test concurrent updates of a sample.csv table"
+    )
+    parser.add_argument("--n_workers", type=int, default=16)
+    parser.add_argument("--n_updates", type=int, default=20)
+    parser.add_argument("--n_crashers", type=int, default=4)
+    parser.add_argument("--n_rollbacks", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        table = pathlib.Path(tmp) / "sample.csv"
+        dead = mp.Process(target=noop)
+        dead.start()
+        dead.join()
+        ready = mp.Event()
+        stale = mp.Process(
+            target=stale_holder, args=(table, dead.pid, ready), daemon=True
+        )
+        stale.start()
+        ready.wait()
+        start = time.time() + 1.0
+        procs = [
+            mp.Process(target=archiver, args=(table, w, args.n_updates, start))
+            for w in range(args.n_workers)
+        ]
+        procs += [
+            mp.Process(
+                target=archiver,
+                args=(table, args.n_workers + w, args.n_updates, start, True),
+            )
+            for w in range(args.n_rollbacks)
+        ]
+        procs += [
+            mp.Process(target=crasher, args=(table, start))
+            for _ in range(args.n_crashers)
+        ]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        elapsed = time.time() - start
+        stale.terminate()
+
+        df = pd.read_csv(table, **READ_KWARGS)
+        expected = args.n_workers * args.n_updates
+        n_updates = len(df)
+        print(f"{args.n_workers} workers x {args.n_updates} updates")
+        print(f"{args.n_rollbacks} workers removing their updates")
+        print(f"{args.n_crashers} processes killed while holding the lock")
+        print(f"elapsed time: {elapsed:.2f} s ({expected / elapsed:.0f} updates/s)")
+        print(f"rows in table: {n_updates} (expected {expected})")
+        counts = df.groupby("barcode").size()
+        assert n_updates == expected, "some updates were lost"
+        assert (counts == args.n_updates).all(), "updates missing for some workers"
+        assert (df.barcode < args.n_workers).all(), "removed updates still present"
+        assert not df.duplicated().any(), "duplicated rows in the table"
+        leftovers = [f.name for f in pathlib.Path(tmp).glob("*.tmp")]
+        assert not leftovers, f"temporary files left behind: {leftovers}"
+        print("all updates present, table consistent")
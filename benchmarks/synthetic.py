@@ -0,0 +1,166 @@
+# Deterministic generators of synthetic nanopore-like data for benchmarks:
+# fastq files with log-normal read lengths, per-read quality profiles and
+# guppy-style headers, fasta contigs, and fake run folders with the layout
+# expected by `archive.py` (`input/*.fast5`, `basecalled/barcodeXX.fastq.gz`).
+# The same arguments always produce the same files.
+#
+# Usage: python3 benchmarks/synthetic.py run_tree DEST [--n_barcodes N ...]
+
+import argparse
+import gzip
+import pathlib
+import numpy as np
+
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+# reads are generated in groups, so that random numbers are drawn in bulk
+GROUP_SIZE = 1000
+
+
+def read_lengths(rng, n_reads, mean=8.5, sigma=0.8):
+    """Log-normal read lengths (median ~5 kbp), of at least 1 bp."""
+    return rng.lognormal(mean=mean, sigma=sigma, size=n_reads).astype(np.int64) + 1
+
+
+def quality_strings(rng, lengths):
+    """Phred+33 quality strings (concatenated) of reads with the given
+    lengths. Each read has its own mean quality, around Q12."""
+    mean_q = rng.normal(12, 3, size=len(lengths)).clip(3, 30)
+    q = np.repeat(mean_q, lengths) + rng.normal(0, 4, size=lengths.sum())
+    return (q.clip(1, 50).astype(np.uint8) + 33).tobytes()
+
+
+def fastq_records(n_reads, barcodes=("barcode01",), seed=0, run_id="0" * 40):
+    """Yields blocks of fastq records (bytes). Reads are assigned at random to
+    one of the `barcodes`, or left unclassified (one read in 20)."""
+    rng = np.random.default_rng(seed)
+    names = list(barcodes) + ["unclassified"]
+    p = np.full(len(names), 0.95 / len(barcodes))
+    p[-1] = 0.05
+    for start in range(0, n_reads, GROUP_SIZE):
+        n = min(GROUP_SIZE, n_reads - start)
+        lengths = read_lengths(rng, n)
+        seqs = BASES[rng.integers(0, 4, size=lengths.sum())].tobytes()
+        quals = quality_strings(rng, lengths)
+        bcs = rng.choice(len(names), size=n, p=p)
+        ends = np.cumsum(lengths).tolist()
+        records, pos = [], 0
+        for i, (end, bc) in enumerate(zip(ends, bcs)):
+            header = (
+                f"@{rng.bytes(16).hex()} runid={run_id} read={start + i} ch={i % 512 + 1} "
+                + f"start_time=2022-01-01T00:00:00Z flow_cell_id=FAL00000 "
+                + f"barcode={names[bc]}"
+            )
+            records.append(
+                b"%s\n%s\n+\n%s\n" % (header.encode(), seqs[pos:end], quals[pos:end])
+            )
+            pos = end
+        yield b"".join(records)
+
+
+def write_fastq(path, n_reads, barcodes=("barcode01",), seed=0, compress=True):
+    """Writes a (gzipped) fastq file with `n_reads` synthetic reads. Returns
+    the path."""
+    path = pathlib.Path(path)
+    opener = gzip.open if compress else open
+    kwargs = {"compresslevel": 1} if compress else {}
+    with opener(path, "wb", **kwargs) as f:
+        for block in fastq_records(n_reads, barcodes, seed):
+            f.write(block)
+    return path
+
+
+def write_fasta(path, contigs, seed=0, width=60):
+    """Writes a fasta file with the given {id: length} contigs, wrapped at
+    `width` characters. Returns the path."""
+    rng = np.random.default_rng(seed)
+    with open(path, "wb") as f:
+        for rid, length in contigs.items():
+            seq = BASES[rng.integers(0, 4, size=length)].tobytes()
+            lines = [seq[i : i + width] for i in range(0, length, width)]
+            f.write(b">%s length=%d\n" % (rid.encode(), length))
+            f.write(b"\n".join(lines) + b"\n")
+    return pathlib.Path(path)
+
+
+def write_contig_files(folder, n_files, length, seed=0):
+    """Writes `n_files` single-contig fasta files (as produced by the
+    assemblers) in `folder`, with ids in shuffled order. Returns the paths."""
+    folder = pathlib.Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    files = []
+    for i, k in enumerate(rng.permutation(n_files)):
+        path = folder / f"contig_{i:03d}.fasta"
+        files.append(write_fasta(path, {f"contig_{k:03d}": length}, seed=seed + i))
+    return files
+
+
+def make_run_tree(
+    root,
+    n_barcodes=12,
+    reads_per_barcode=2000,
+    n_fast5=20,
+    fast5_size=4 * 1024**2,
+    seed=0,
+    run_id="FAL00000_0a1b2c3d",
+):
+    """Creates a fake run folder in `root`: `n_fast5` fast5 files of random
+    content in `input/`, and one fastq.gz file per barcode in `basecalled/`.
+    Returns the root folder."""
+    root = pathlib.Path(root)
+    (root / "input").mkdir(parents=True, exist_ok=True)
+    (root / "basecalled").mkdir(exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for i in range(1, n_fast5 + 1):
+        (root / "input" / f"{run_id}_{i}.fast5").write_bytes(rng.bytes(fast5_size))
+    for bc in range(1, n_barcodes + 1):
+        name = f"barcode{bc:02d}"
+        # reads per barcode vary, as for real runs
+        n_reads = int(reads_per_barcode * rng.uniform(0.2, 1.8))
+        write_fastq(
+            root / "basecalled" / f"{name}.fastq.gz",
+            n_reads,
+            barcodes=(name,),
+            seed=seed + bc,
+        )
+    return root
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="generate synthetic test data")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_fastq = subparsers.add_parser("fastq", help="gzipped fastq file")
+    p_fastq.add_argument("out", type=str, help="output file")
+    p_fastq.add_argument("--n_reads", type=int, default=10000)
+    p_fastq.add_argument("--n_barcodes", type=int, default=12)
+    p_fastq.add_argument("--seed", type=int, default=0)
+    p_fasta = subparsers.add_parser("contigs", help="single-contig fasta files")
+    p_fasta.add_argument("out", type=str, help="output folder")
+    p_fasta.add_argument("--n_files", type=int, default=12)
+    p_fasta.add_argument("--length", type=int, default=500000)
+    p_fasta.add_argument("--seed", type=int, default=0)
+    p_run = subparsers.add_parser("run_tree", help="fake run folder")
+    p_run.add_argument("out", type=str, help="output folder")
+    p_run.add_argument("--n_barcodes", type=int, default=12)
+    p_run.add_argument("--reads_per_barcode", type=int, default=2000)
+    p_run.add_argument("--n_fast5", type=int, default=20)
+    p_run.add_argument("--fast5_size", type=float, default=4, help="size (MB)")
+    p_run.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == "fastq":
+        barcodes = [f"barcode{i:02d}" for i in range(1, args.n_barcodes + 1)]
+        write_fastq(args.out, args.n_reads, barcodes, args.seed)
+    elif args.command == "contigs":
+        write_contig_files(args.out, args.n_files, args.length, args.seed)
+    elif args.command == "run_tree":
+        make_run_tree(
+            args.out,
+            args.n_barcodes,
+            args.reads_per_barcode,
+            args.n_fast5,
+            int(args.fast5_size * 1024**2),
+            args.seed,
+        )
@@ -12,15 +12,22 @@ params.input_dir = file("runs/${params.run}/clustering")
 // capture barcode folders
 barcodes_ch = Channel.fromPath("${params.input_dir}/barcode*", type: 'dir')
 
+// filtered reads of a barcode folder. Folders clustered before the reads were
+// filtered by `length_filter.py` contain `filtlong_reads.fastq` instead.
+def filtered_reads(bc_dir) {
+    def reads = file("$bc_dir/filtered_reads.fastq.gz")
+    return reads.exists() ? reads : file("$bc_dir/filtlong_reads.fastq")
+}
+
 // performs three different operations:
-// - captures barcode, filtlong_reads.fastq and list of clusters.
+// - captures barcode, filtered reads and list of clusters.
 // - transposes, to have one item per cluster with assigned barcode
 // - captures the label of destination folder barcodeXX/cluster_XXX,
-//     the filtlong_reads.fastq file and the 2_all_seqs.fasta file.
+//     the filtered reads file and the 2_all_seqs.fasta file.
 cluster_ch = barcodes_ch
     .map { [
         it.getSimpleName(), 
-        file("$it/filtlong_reads.fastq", type: 'dir'),
+        filtered_reads(it),
         file("$it/cluster_*", type: 'dir')
            ]}
     .transpose()
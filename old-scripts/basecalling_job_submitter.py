@@ -1,47 +1,254 @@
+# Submits the basecalling of fast5 files to the cluster as they are produced.
+# The `fast5` folder is watched for new files (see `scripts/fs_watch.py`), and
+# a file is considered complete once its size is stable. Complete files are
+# grouped in batches, submitted when `--batch_size` files are ready or when
+# the oldest file of the batch has waited `--max_age` seconds. Each batch is
+# submitted as a single job array, with one task per fast5 file.
+#
+# As before, each file is moved to its own `basecalling/<name>/` folder as
+# `nanopore_raw_read.fast5`, and basecalled by `guppy_basecalling.sh`. The
+# `#SBATCH` options of this script are copied into the job array script of
+# each batch, saved in `basecalling/batches/`.
+#
+# The scheduler command is configurable (`--scheduler`, default `sbatch`), so
+# that a local replacement can be used for testing. Submission is postponed,
+# with exponential back-off, while the number of queued jobs returned by
+# `--queue_cmd` exceeds `--max_queued`.
+
+import argparse
 import os
-import glob
+import pathlib
+import re
+import shlex
 import shutil
+import subprocess
+import sys
 import time
-import argparse
 
-base_dir = os.getcwd()+'/'
-fast5_path = base_dir+'fast5/'
-basecalling_path = base_dir+'basecalling/'
-submit_script = '~/nanopore_scripts/guppy_scripts/guppy_basecalling.sh'
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "scripts"))
+from fs_watch import StableFileWatcher
+
+base_dir = pathlib.Path.cwd()
+fast5_path = base_dir / "fast5"
+basecalling_path = base_dir / "basecalling"
+batches_path = basecalling_path / "batches"
+submit_script = "~/nanopore_scripts/guppy_scripts/guppy_basecalling.sh"
+
+END_SIGNAL = "end-signal.fast5"
+MAX_BACKOFF = 600
+
+
+def sbatch_options(script):
+    """Returns the `#SBATCH` lines of the header of a job script."""
+    options = []
+    with open(script, "r") as f:
+        for line in f:
+            if line.startswith("#SBATCH"):
+                options.append(line.rstrip("\n"))
+            elif line.strip() and not line.startswith("#"):
+                break
+    return options
+
+
+def array_script(script, task_dirs, flow_cell, kit):
+    """Returns a job array script basecalling one folder per task."""
+    dirs = "\n".join(f"    {shlex.quote(str(d))}" for d in task_dirs)
+    call = " ".join(
+        [
+            "bash",
+            shlex.quote(str(script)),
+            '"$DIR"',
+            '"$DIR/fastq"',
+            shlex.quote(flow_cell),
+            shlex.quote(kit),
+            '"$DIR/barcoded_output"',
+        ]
+    )
+    lines = ["#!/bin/bash"] + sbatch_options(script)
+    lines += [
+        "",
+        "DIRS=(",
+        dirs,
+        ")",
+        'DIR="${DIRS[$SLURM_ARRAY_TASK_ID]}"',
+        call,
+        "",
+    ]
+    return "\n".join(lines)
+
 
-# Make directory where the basecalling takes place
-if not os.path.exists(basecalling_path):
-    os.mkdir(basecalling_path)
+def queue_depth(queue_cmd):
+    """Number of jobs in the queue, one per line of the output of
+    `queue_cmd`. Returns 0 if the command is empty or fails."""
+    if not queue_cmd:
+        return 0
+    cmd = shlex.split(os.path.expandvars(queue_cmd))
+    try:
+        res = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f"could not get the queue depth: {e}")
+        return 0
+    if res.returncode != 0:
+        print(f"could not get the queue depth: {res.stderr.strip()}")
+        return 0
+    return sum(1 for line in res.stdout.splitlines() if line.strip())
 
-def call_guppy(flow_cell,kit):
-    fast5_files = glob.glob(fast5_path+'*.fast5')
-    for fast5_file in fast5_files:
-        # Make directory for the fastq
-        fast5_file_directory_name = fast5_file.split('/')[-1].split('.')[0]
-        fast5_file_directory = basecalling_path+fast5_file_directory_name
-        os.mkdir(basecalling_path+fast5_file_directory_name)
 
-        # Move read to created directory
-        shutil.move(fast5_file,fast5_file_directory+'/nanopore_raw_read.fast5')
+class BatchSubmitter:
+    """Accumulates complete fast5 files and submits them in job arrays."""
 
-        # Call guppy
-        call = ['sbatch',submit_script,fast5_file_directory,fast5_file_directory+'/fastq',flow_cell,kit,fast5_file_directory+'/barcoded_output']
-        os.system(' '.join(call))
-        print(call)
-    raw_file_counts = len(fast5_files)  
-    return len(fast5_files)
+    def __init__(self, params):
+        self.params = params
+        self.script = pathlib.Path(os.path.expanduser(params.submit_script))
+        self.batch = []
+        self.oldest = None
+        self.next_try = 0.0
+        self.backoff = params.interval
+        self.n_batches = len(list(batches_path.glob("batch_*.sh")))
 
+    def add(self, files):
+        if files and not self.batch:
+            self.oldest = time.monotonic()
+        self.batch += files
 
-if __name__=="__main__":
+    def due(self, flush=False):
+        """Whether the current batch should be submitted now."""
+        if not self.batch or time.monotonic() < self.next_try:
+            return False
+        age = time.monotonic() - self.oldest
+        full = len(self.batch) >= self.params.batch_size
+        return flush or full or age >= self.params.max_age
+
+    def time_to_due(self, flush=False):
+        """Seconds until the current batch is due, or None if empty."""
+        if not self.batch:
+            return None
+        due = self.oldest + self.params.max_age
+        if flush or len(self.batch) >= self.params.batch_size:
+            due = 0.0
+        due = max(due, self.next_try)
+        return max(0.0, due - time.monotonic())
+
+    def _postpone(self, reason):
+        print(f"{reason}, retrying in {self.backoff:g} s")
+        self.next_try = time.monotonic() + self.backoff
+        self.backoff = min(2 * self.backoff, MAX_BACKOFF)
+
+    def submit(self):
+        """Submits the files of the current batch (up to `batch_size`, and
+        never more than `max_queued`, which could otherwise never fit in the
+        queue)."""
+        files = self.batch[: min(self.params.batch_size, self.params.max_queued)]
+        depth = queue_depth(self.params.queue_cmd)
+        if depth + len(files) > self.params.max_queued:
+            self._postpone(f"{depth} jobs queued")
+            return False
+
+        # move each read to its own folder
+        task_dirs = []
+        for fast5_file in files:
+            task_dir = basecalling_path / fast5_file.name.split(".")[0]
+            task_dir.mkdir()
+            shutil.move(str(fast5_file), task_dir / "nanopore_raw_read.fast5")
+            task_dirs.append(task_dir)
+
+        self.n_batches += 1
+        batch_name = f"batch_{self.n_batches:05d}"
+        batch_script = batches_path / f"{batch_name}.sh"
+        batch_script.write_text(
+            array_script(self.script, task_dirs, self.params.flowcell, self.params.kit)
+        )
+        cmd = shlex.split(self.params.scheduler) + [
+            f"--array=0-{len(files) - 1}",
+            f"--job-name=guppy_{batch_name}",
+            f"--output={batches_path / batch_name}_%a.out",
+            str(batch_script),
+        ]
+        res = subprocess.run(cmd, capture_output=True, text=True)
+        if res.returncode != 0:
+            # put the reads back, to retry later
+            for fast5_file, task_dir in zip(files, task_dirs):
+                shutil.move(str(task_dir / "nanopore_raw_read.fast5"), fast5_file)
+                task_dir.rmdir()
+            batch_script.unlink()
+            self.n_batches -= 1
+            self._postpone(f"submission failed: {res.stderr.strip()}")
+            return False
+
+        job = re.search(r"\d+", res.stdout)
+        job_id = job.group() if job else "?"
+        print(f"Submitted {len(files)} fast5 files to guppy as job array {job_id}")
+        self.batch = self.batch[len(files) :]
+        self.oldest = time.monotonic() if self.batch else None
+        self.backoff = self.params.interval
+        return True
+
+
+if __name__ == "__main__":
     # Parse arguments needed for guppy
-    parser = argparse.ArgumentParser(description = "stage reads and call bases")
+    parser = argparse.ArgumentParser(description="stage reads and call bases")
     parser.add_argument("--flowcell", type=str, help="flowcell")
     parser.add_argument("--kit", type=str, help="library kit")
-    parser.add_argument("--interval", type=int, default=600, help="number of second delay in the cycle")
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=10,
+        help="seconds between checks of the size of the files being written",
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=100, help="max number of files per job array"
+    )
+    parser.add_argument(
+        "--max_age",
+        type=float,
+        default=300,
+        help="max seconds a complete file waits before its batch is submitted",
+    )
+    parser.add_argument(
+        "--scheduler",
+        type=str,
+        default="sbatch",
+        help="command used to submit the job arrays",
+    )
+    parser.add_argument(
+        "--queue_cmd",
+        type=str,
+        default="squeue --noheader --array --user $USER",
+        help="command listing the queued jobs, one per line. Empty to disable.",
+    )
+    parser.add_argument(
+        "--max_queued",
+        type=int,
+        default=1000,
+        help="submission is postponed while more jobs are queued",
+    )
+    parser.add_argument(
+        "--submit_script", type=str, default=submit_script, help="basecalling script"
+    )
+    parser.add_argument(
+        "--polling", action="store_true", help="list the folder instead of inotify"
+    )
     params = parser.parse_args()
 
-    # Scan for files every defined interval
-    while True:
-        submitted_files = call_guppy(params.flowcell,params.kit)
-        print('Submitted %d fast5 file to guppy' % (submitted_files))
-        time.sleep(params.interval)
+    basecalling_path.mkdir(exist_ok=True)
+    batches_path.mkdir(exist_ok=True)
+
+    watcher = StableFileWatcher(
+        fast5_path,
+        pattern="*.fast5",
+        interval=params.interval,
+        use_inotify=not params.polling,
+    )
+    submitter = BatchSubmitter(params)
+    print(f"watching {fast5_path} ({watcher.mode})")
+    finished = False
+    while not (finished and not submitter.batch):
+        files = watcher.wait(timeout=submitter.time_to_due(flush=finished))
+        if any(f.name == END_SIGNAL for f in files):
+            finished = True
+            files = [f for f in files if f.name != END_SIGNAL]
+        submitter.add(files)
+        while submitter.due(flush=finished) and submitter.submit():
+            pass
+    watcher.close()
+    print("end signal received, all files submitted")
@@ -11,11 +11,18 @@ params.input_dir = file("runs/${params.run}/clustering")
 barcodes_ch = Channel.fromPath("${params.input_dir}/barcode*", type: 'dir')
 
 
-// separate into barcode label, filtlong reads and cluster folder
+// filtered reads of a barcode folder. Folders clustered before the reads were
+// filtered by `length_filter.py` contain `filtlong_reads.fastq` instead.
+def filtered_reads(bc_dir) {
+    def reads = file("$bc_dir/filtered_reads.fastq.gz")
+    return reads.exists() ? reads : file("$bc_dir/filtlong_reads.fastq")
+}
+
+// separate into barcode label, filtered reads and cluster folder
 cluster_ch = barcodes_ch
     .map { [
         it.getSimpleName(), 
-        file("$it/filtlong_reads.fastq", type: 'dir'),
+        filtered_reads(it),
         file("$it/cluster_*", type: 'dir')
            ]}
     .transpose()
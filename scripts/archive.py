@@ -2,13 +2,22 @@
 
 import argparse
 import pathlib
-import os
 import re
 import datetime
+import functools
 import subprocess
 import numpy as np
 import pandas as pd
-import time
+from fastq_index import index_file
+from fast5_tar import INDEX_NAME, plan_shards, shard_names
+from copy_engine import ALGORITHMS
+from archive_journal import ArchiveJournal, JOURNAL_NAME
+from archive_plan import ArchivePlan, ArchiveExecutor
+from archive_catalog import update_run
+from barcode_qc import GENOME_SIZE, QC_COLUMNS, VALID_RULE, apply_rule, qc_table
+from stats_cache import open_cache
+import profiling
+from profiling import profiled, stage
 
 dest = pathlib.Path("/scicore/home/neher/GROUP/data/2022_nanopore_sequencing")
 # dest = pathlib.Path("archive")
@@ -16,6 +25,9 @@ raw_main_dir = dest / "raw"
 bc_main_dir = dest / "basecalled"
 exp_main_dir = dest / "experiments"
 
+# arguments to load `sample.csv` tables
+read_sample_info_kwargs = {"dtype": {"barcode": int, "vial": str, "timepoint": str}}
+
 
 def extract_flowcell_run_id(data_fld):
     """Extracts the flowcell run id from the fast5 files prefix."""
@@ -39,9 +51,12 @@ def extract_barcodes(data_fld):
     return barcodes, filesizes
 
 
+@profiled("sample table")
 def initialize_sample_df(data_fld, args):
     """Initializes a dataframe containing sample information, to be later
-    completed by the user."""
+    completed by the user. Unless `args.no_qc` is set, the reads of each
+    barcode are scanned to compute QC metrics, and barcodes are marked valid
+    according to `args.valid_rule`."""
     barcodes, filesizes = extract_barcodes(data_fld)
     flowcell_run_id = extract_flowcell_run_id(data_fld)
 
@@ -49,7 +64,17 @@ def initialize_sample_df(data_fld, args):
     df["vial"] = np.nan
     df["timepoint"] = np.nan
     df["filesize (Mb)"] = np.round(filesizes / (1024**2), 2)
-    df["valid"] = df["filesize (Mb)"] > 10
+    if args.no_qc:
+        df["valid"] = df["filesize (Mb)"] > 10
+    else:
+        files = [data_fld / "basecalled" / f"barcode{bc}.fastq.gz" for bc in barcodes]
+        print(f"computing QC metrics of {len(files)} barcodes...")
+        cache = open_cache(not args.no_cache)
+        with stage("QC metrics"):
+            qc = qc_table(files, args.threads, args.genome_size, cache=cache)
+        for col in QC_COLUMNS:
+            df[col] = qc[col].values
+        df["valid"] = apply_rule(qc, args.valid_rule).values
     df["flowcell_run_id"] = flowcell_run_id
     if args.exp_id is None:
         df["experiment_id"] = np.nan
@@ -66,7 +91,8 @@ def initialize_sample_df(data_fld, args):
 def check_valid(df):
     """Checks that the dataframe has all the necessary columns, that the
     `flowcell_run_id` column is the same for all entries,
-    and that for all valid barcodes, both vial and timepoint are specified."""
+    and that for all valid barcodes, both vial and timepoint are specified.
+    QC metrics columns are optional."""
     columns = set(
         [
             "barcode",
@@ -80,7 +106,7 @@ def check_valid(df):
         ]
     )
     assert (
-        set(df.columns) == columns
+        columns <= set(df.columns) <= columns | set(QC_COLUMNS)
     ), "some of the required columns of the dataframe is missing."
     mask = df.valid
     assert np.all(
@@ -95,61 +121,16 @@ def check_valid(df):
 
 
 def filter_dataframe(df):
-    """Keep only relevant barcodes and filter out irrelevant columns"""
+    """Keep only relevant barcodes and filter out irrelevant columns. QC
+    metrics are dropped, so that archived tables keep the same columns."""
     df = df[df.valid].copy()
-    df = df.drop(columns=["filesize (Mb)", "valid"])
+    qc_columns = [c for c in QC_COLUMNS if c in df.columns]
+    df = df.drop(columns=["filesize (Mb)", "valid"] + qc_columns)
     return df
 
 
-def run_command(command, verbose=False):
-    """Utility function to run a shell command and optionally visualize output."""
-    subp = subprocess.run(command, capture_output=True)
-    if subp.returncode:
-        print(f"Error: return code {subp.returncode}")
-        print("message:")
-        print(subp.stderr.decode())
-        raise RuntimeError(f"command {' '.join(command)} failed")
-    else:
-        if verbose:
-            stdout = subp.stdout.decode()
-            if len(stdout) > 0:
-                print(stdout)
-
-
-def create_fast5_archive(archive_fld, fast5_fld):
-    """creates a `fast5_reads.tar.gz` file inside of `archive_fld` folder,
-    containing all .fast5 files from `fast5_fld`. Returns the path of the
-    created archive."""
-    fast5_files = [f.name for f in fast5_fld.glob("*.fast5")]
-    archive_file = archive_fld / "fast5_reads.tar"
-    command = [
-        "tar",
-        "cvf",
-        str(archive_file),
-        "--directory=" + str(fast5_fld),
-    ] + fast5_files
-    run_command(command)
-    return archive_file
-
-
-def make_read_only(files):
-    """given a list of files, runs chmod 444 to make them read-only."""
-    file_names = [str(f) for f in files]
-    run_command(["chmod", "444"] + file_names)
-
-
-def mkdir_check_nonexistent(dir_path):
-    """Check that a directory does not exist, and if so then creates it."""
-    if dir_path.is_dir():
-        raise FileExistsError(
-            f"""The folder {dir_path} already exists.
-        Remove it if you want to overwrite it."""
-        )
-    dir_path.mkdir()
-
-
-def single_experiment_readme(subdir, df_row, git_id):
-    """creates a README.txt file for the single experiment"""
+def single_experiment_readme(df_row, git_id):
+    """returns the content of the README.txt file for the single experiment"""
     message = [
         "The reads for this condition:",
         f"\texperiment tag: {df_row.experiment_id}",
@@ -169,60 +150,35 @@ def single_experiment_readme(subdir, df_row, git_id):
         "For reproducibility, the log of trycycler reconcile command is also saved.",
         "This contains information on which contigs were included in the assembly.",
     ]
-    rdm_file = subdir / "README.txt"
-    with open(rdm_file, "w") as f:
-        f.write("\n".join(message))
-    make_read_only([str(rdm_file)])
-
-
-def lock_file(f):
-    """creates a file.lock to signal the lock of the file"""
-    lock_f = pathlib.Path(str(f) + ".lock")
-    t = 0
-    while t < 50:
-        if lock_f.is_file():
-            t += 1
-            time.sleep(5)
-        else:
-            with open(lock_f, "w") as lf:
-                lf.write(f"lock file created on {datetime.date.today().isoformat()}")
-            return True
-    raise RuntimeError(f"maximum waiting time exceeded when trying to lock {f}")
-
-
-def unlock_file(f):
-    """Unlocks a file by removing the corresponding lock file"""
-    lock_f = pathlib.Path(str(f) + ".lock")
-    assert lock_f.is_file(), "Lock file missing"
-    os.remove(lock_f)
-
-
-def copy_prokka_data(prokka_src, prokka_dest):
-    """Copies and renames the content of the prokka folder."""
-    # copy prokka output
+    return "\n".join(message)
+
+
+def prokka_copy_pairs(prokka_src, prokka_dest):
+    """Returns the (source, destination) pairs to copy and rename the content
+    of the prokka folder."""
+    # prokka output
+    pairs = []
     for f in prokka_src.glob("barcode*_genome.*"):
-        new_file = prokka_dest / f"assembly{f.suffix}"
-        run_command(["cp", str(f), str(new_file)])
-        make_read_only([new_file])
-    # copy reconcile_log for different clusters
+        pairs.append((f, prokka_dest / f"assembly{f.suffix}"))
+    # reconcile_log for different clusters
     parent_dir = prokka_src.parent
     for f in parent_dir.glob("cluster_*"):
         cluster_id = f.name
         log_file_from = f / "reconcile_log.txt"
         log_file_to = prokka_dest / f"{cluster_id}_reconcile_log.txt"
-        run_command(["cp", str(log_file_from), str(log_file_to)])
-        make_read_only([log_file_to])
+        pairs.append((log_file_from, log_file_to))
+    return pairs
 
 
+@functools.lru_cache(maxsize=None)
 def get_git_commit_id():
-    """Gets the current"""
+    """Gets the current commit id of the repository. The result is cached."""
     return subprocess.check_output(["git", "rev-parse", "HEAD"]).decode("ascii").strip()
 
 
-def generate_seqdata_readme(dest_fld, df, filetype):
-    """Generates the readme file for the `raw` and `basecalled` subfolders"""
-    readme = dest_fld / "README.txt"
-
+def generate_seqdata_readme(df, filetype, git_id):
+    """Returns the content of the readme file for the `raw` and `basecalled`
+    subfolders"""
     fri = df["flowcell_run_id"].iloc[0]
 
     if filetype == "fast5":
@@ -237,7 +193,6 @@ def generate_seqdata_readme(dest_fld, df, filetype):
     else:
         raise RuntimeError("filetype must be either fast5 or fastq")
 
-    git_id = get_git_commit_id()
     content += [
         "\nThe data was generated by the nanopore sequencing run with id:",
         str(fri),
@@ -249,9 +204,112 @@ def generate_seqdata_readme(dest_fld, df, filetype):
         "and their corresponding experimental condition (experiment id,",
         " vial, timepoint...).",
     ]
-    with open(readme, "w") as f:
-        f.write("\n".join(content))
-    make_read_only([readme])
+    return "\n".join(content)
+
+
+def plan_archive(data_fld, df, run_tag, git_id, journal, max_shard_size=None):
+    """Plans all the actions needed to archive the data in `data_fld` for the
+    barcodes in `df`, under the given run tag. Experiments already completed
+    according to the `journal` are not included."""
+    plan = ArchivePlan(run_tag, journal)
+
+    # -------------- archive fast5 files ---------------------
+    # fast5 files are archived in (possibly multiple) indexed tar files
+    archive_fld = raw_main_dir / run_tag
+    plan.mkdir(archive_fld)
+    fast5_files = sorted((data_fld / "input").glob("*.fast5"))
+    plan.fast5_archive(archive_fld, fast5_files, max_shard_size)
+    shards = shard_names(len(plan_shards(fast5_files, max_shard_size)))
+    plan.make_read_only(*[archive_fld / shard for shard in shards])
+    plan.make_read_only(archive_fld / INDEX_NAME)
+
+    # add copy of sample.csv file and a readme file
+    plan.write_csv(archive_fld / "sample.csv", df)
+    readme = generate_seqdata_readme(df, "fast5", git_id)
+    plan.write_text(archive_fld / "README.txt", readme)
+    plan.make_read_only(archive_fld / "sample.csv", archive_fld / "README.txt")
+
+    # -------------- archive fastq reads ---------------------
+    fastq_to_fld = bc_main_dir / run_tag
+    plan.mkdir(fastq_to_fld)
+
+    # transfer fastq reads (and read indices, if present) to basecalled folder
+    fastq_from_fld = data_fld / "basecalled"
+    fastq_to_files = {}  # dictionary with files destinations
+    copy_pairs = []  # (source, destination) of all files to copy
+    for bc in df.barcode.values:
+        fastq_from_file = fastq_from_fld / f"barcode{int(bc):02d}.fastq.gz"
+        assert fastq_from_file.is_file(), f"file {fastq_from_file} does not exist."
+        fastq_to_files[bc] = fastq_to_fld / f"barcode{int(bc):02d}.fastq.gz"
+        copy_pairs.append((fastq_from_file, fastq_to_files[bc]))
+        index_from_file = index_file(fastq_from_file)
+        if index_from_file.is_file():
+            copy_pairs.append((index_from_file, index_file(fastq_to_files[bc])))
+    plan.copy(copy_pairs, manifest_fld=fastq_to_fld)
+    plan.make_read_only(*[dst for _, dst in copy_pairs])
+
+    plan.write_csv(fastq_to_fld / "sample.csv", df)
+    readme = generate_seqdata_readme(df, "fastq", git_id)
+    plan.write_text(fastq_to_fld / "README.txt", readme)
+    plan.make_read_only(fastq_to_fld / "sample.csv", fastq_to_fld / "README.txt")
+
+    # -------------- create experiment database with links ---------------------
+    # find pairs of date/experiment_id
+    pairs = df[["experiment_id", "date"]].value_counts().index.to_list()
+    for exp_id, date in pairs:
+
+        # skip experiments completed in a previous attempt
+        exp_tag = f"{date}_{exp_id}"
+        if journal.is_done(f"experiment {exp_tag}"):
+            print(f"experiment {exp_id} date {date} already archived, skipping")
+            continue
+
+        # select only data
+        mask = (df.experiment_id == exp_id) & (df.date == date)
+        sdf = df[mask].copy()
+
+        # experiment folder, created if it does not exist
+        exp_dir = exp_main_dir / exp_tag
+        plan.mkdir(exp_dir, exist_ok=True)
+
+        # for every barcode
+        for idx, row in sdf.iterrows():
+            bc, vial, tp = row.barcode, row.vial, row.timepoint
+
+            # create experiment vial/timepoint subdirectory. If partially
+            # filled by an interrupted attempt, the files it wrote are removed.
+            exp_subdir = exp_dir / f"vial_{int(vial):02d}" / f"time_{tp}"
+            plan.mkdir(exp_subdir.parent, exist_ok=True)
+            plan.mkdir(exp_subdir, rebuild=True)
+
+            # create symbolic link to reads
+            plan.symlink(fastq_to_files[bc].resolve(), exp_subdir / "reads.fastq.gz")
+
+            readme = single_experiment_readme(row, git_id)
+            plan.write_text(exp_subdir / "README.txt", readme)
+            plan.make_read_only(exp_subdir / "README.txt")
+
+            # if present, copy the prokka folder containing annotated genome
+            prokka_fld_src = (
+                data_fld
+                / "clustering"
+                / f"barcode{int(bc):02d}"
+                / f"prokka_barcode{int(bc):02d}"
+            )
+            if prokka_fld_src.is_dir():
+                prokka_dest = exp_subdir / "assembled_genome"
+                plan.mkdir(prokka_dest)
+                prokka_pairs = prokka_copy_pairs(prokka_fld_src, prokka_dest)
+                plan.copy(prokka_pairs)
+                plan.make_read_only(*[dst for _, dst in prokka_pairs])
+
+        # if sample.csv already exists, merge and overwrite
+        sample_info = exp_dir / "sample.csv"
+        plan.write_csv(sample_info, sdf, merge_kwargs=read_sample_info_kwargs)
+        plan.make_read_only(sample_info)
+        plan.mark_done(f"experiment {exp_tag}")
+
+    return plan
 
 
 if __name__ == "__main__":
@@ -287,9 +345,83 @@ if __name__ == "__main__":
         help="force the creation of the `sample.csv` file.",
         action="store_true",
     )
+    parser.add_argument(
+        "--genome_size",
+        help="""expected genome size (bp), used to estimate the coverage of
+        each barcode when creating `sample.csv`.""",
+        type=float,
+        default=GENOME_SIZE,
+    )
+    parser.add_argument(
+        "--valid_rule",
+        help="""rule on the QC metrics (n_reads, tot_bases, N50, mean_q,
+        coverage) used to mark barcodes as valid when creating `sample.csv`,
+        e.g. "n_reads > 1000 and coverage >= 30".""",
+        type=str,
+        default=VALID_RULE,
+    )
+    parser.add_argument(
+        "--no_qc",
+        help="""do not compute QC metrics when creating `sample.csv`, and mark
+        barcodes as valid based on the file size only.""",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no_cache",
+        help="""do not use the statistics cache (see `stats_cache.py`) for
+        the QC metrics.""",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--threads",
+        help="""number of threads used to copy the fastq files, and of
+        processes used to compute QC metrics.""",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--checksum",
+        help="""checksum computed while copying the fastq files, saved in a
+        manifest next to `sample.csv`. xxhash checksums require the `xxhash`
+        package.""",
+        choices=list(ALGORITHMS) + ["none"],
+        default="sha256",
+    )
+    parser.add_argument(
+        "--resume",
+        help="""resume an interrupted archive run, skipping the work already
+        done according to the progress journal.""",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no_dedup",
+        help="""do not hardlink fastq files identical to files already archived
+        under another run tag.""",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--dry_run",
+        help="only print the actions that would be performed, and exit.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--keep_partial",
+        help="""do not remove the created files if the archive fails, so that
+        the run can be continued with --resume.""",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max_shard_size",
+        help="""if specified, the fast5 archive is split in multiple tar files
+        of at most this size (in GB).""",
+        type=float,
+        required=False,
+    )
+    profiling.add_argument(parser)
 
     # parse arguments
     args = parser.parse_args()
+    profiling.setup(args)
     data_fld = pathlib.Path(args.data_fld)
 
     assert data_fld.is_dir(), "The data folder must be a directory"
@@ -306,11 +438,43 @@ if __name__ == "__main__":
         exit(0)
 
     # if the csv file exists then load it and check if it is valid
-    read_sample_info_kwargs = {"dtype": {"barcode": int, "vial": str, "timepoint": str}}
     df = pd.read_csv(sample_info_file, **read_sample_info_kwargs)
     print(df)
     check_valid(df)
 
+    # select only barcodes to be transferred and filter dataframe to relevant columns:
+    df = filter_dataframe(df)
+
+    # progress journal, used to resume interrupted runs
+    journal = ArchiveJournal(data_fld / JOURNAL_NAME)
+    if journal.exists() and not journal.is_done("archive"):
+        assert args.resume, f"""a previous archive run was interrupted (see
+        {journal.path}). Use --resume to continue it."""
+    elif journal.exists() and args.resume:
+        print("Data already archived, nothing to resume.")
+        exit(0)
+    elif journal.exists():
+        # previous run completed: start a new one
+        journal.reset()
+
+    # name for the storage folders. When resuming, the tag of the
+    # interrupted run is used.
+    flow_id = df["flowcell_run_id"].iloc[0]
+    flow_run_tag = journal.run_tag
+    if flow_run_tag is None:
+        flow_run_tag = f"{datetime.date.today().isoformat()}_{flow_id}"
+
+    # plan all actions before touching the archive
+    max_shard_size = None if args.max_shard_size is None else args.max_shard_size * 1e9
+    git_id = get_git_commit_id()
+    with stage("plan archive"):
+        plan = plan_archive(data_fld, df, flow_run_tag, git_id, journal, max_shard_size)
+
+    print("\n ---- Archive plan ----")
+    print(plan.describe())
+    if args.dry_run:
+        exit(0)
+
     # ask for confirmation before data archiviation
     answer = input(
         "\n".join(
@@ -324,149 +488,28 @@ if __name__ == "__main__":
         print("Aborting data archiviation.")
         exit(0)
 
-    # select only barcodes to be transferred and filter dataframe to relevant columns:
-    df = filter_dataframe(df)
-
-    # -------------- archive fast5 files ---------------------
-    print("\n ---- Creating fast5 file archive ----")
-
-    # name for fast5 files storage folder
-    flow_id = df["flowcell_run_id"].iloc[0]
-    today = datetime.date.today().isoformat()
-    flow_run_tag = f"{today}_{flow_id}"
-    archive_fld = raw_main_dir / flow_run_tag
-    git_id = get_git_commit_id()
-
-    # check that folder does not already exist and create it
-    mkdir_check_nonexistent(archive_fld)
-
-    # list of created directories for log
-    created_dirs = [archive_fld]
-
-    # list entries to archive
+    print("\n ---- Archiving data ----")
     print("archiving the following entries:")
     print(df)
-
-    # copy fast5 files in tar archive
-    print(f"creating fast5 archive in {archive_fld}...")
-    print(f"this might take some time...")
-    fast5_fld = data_fld / "input"
-    fast5_archive = create_fast5_archive(archive_fld, fast5_fld)
-
-    # add copy of sample.csv file
-    stats_file = archive_fld / "sample.csv"
-    print(f"saving sample information on {stats_file}...")
-    df.to_csv(stats_file, index=False)
-
-    # add a readme file
-    generate_seqdata_readme(archive_fld, df, filetype="fast5")
-
-    # change permissions to read-only
-    change_permissions_to = [fast5_archive, stats_file]
-    make_read_only(change_permissions_to)
-
-    # -------------- archive fastq reads ---------------------
-    print("\n ---- Copying compressed fastq files for selected barcodes ----")
-
-    # create folder to store reads (check that it does not exist already)
-    fastq_to_fld = bc_main_dir / flow_run_tag
-    mkdir_check_nonexistent(fastq_to_fld)
-
-    created_dirs.append(fastq_to_fld)  # for later logging
-
-    # transfer fastq reads to basecalled folder
-    fastq_from_fld = data_fld / "basecalled"
-    print(f"copy selected barcodes from {fastq_from_fld} to {fastq_to_fld}")
-    fastq_to_files = {}  # dictionary with files destinations
-    for bc in df.barcode.values:
-        print(f"processing barcode {bc}")
-        fastq_from_file = fastq_from_fld / f"barcode{int(bc):02d}.fastq.gz"
-        assert fastq_from_file.is_file(), f"file {fastq_from_file} does not exist."
-        fastq_to_files[bc] = fastq_to_fld / f"barcode{int(bc):02d}.fastq.gz"
-        # copy fastq files
-        run_command(["cp", str(fastq_from_file), str(fastq_to_files[bc])])
-
-    sample_info_file = fastq_to_fld / "sample.csv"
-    print(f"creating info table {sample_info_file}")
-    df.to_csv(sample_info_file, index=False)
-
-    # change file permissions
-    readonly_files = [str(f) for f in fastq_to_files.values()] + [str(sample_info_file)]
-    make_read_only(readonly_files)
-
-    # add readme file
-    generate_seqdata_readme(fastq_to_fld, df, filetype="fastq")
-
-    # -------------- create experiment database with links ---------------------
-    print("\n ---- Creating directories and links in experiments folder ----")
-
-    # find pairs of date/experiment_id
-    pairs = df[["experiment_id", "date"]].value_counts().index.to_list()
-    for exp_id, date in pairs:
-
-        print(f"processing experiment {exp_id} date {date}")
-
-        # select only data
-        mask = (df.experiment_id == exp_id) & (df.date == date)
-        sdf = df[mask].copy()
-
-        # define experiment folder and create it if it does not exist
-        exp_tag = f"{date}_{exp_id}"
-        exp_dir = exp_main_dir / exp_tag
-        if not exp_dir.is_dir():
-            created_dirs.append(exp_dir)
-        exp_dir.mkdir(exist_ok=True)
-
-        # for every barcode
-        for idx, row in sdf.iterrows():
-            bc, vial, tp = row.barcode, row.vial, row.timepoint
-            print(f"processing barcode {bc}, vial {vial}, timepoint {tp}")
-
-            # create experiment vial/timepoint subdirectory
-            exp_subdir = exp_dir / f"vial_{int(vial):02d}" / f"time_{tp}"
-            assert not exp_subdir.is_dir(), f"the directory {exp_subdir} already exists"
-            exp_subdir.mkdir(parents=True)
-            created_dirs.append(exp_subdir)
-
-            # create symbolic link to reads, and make it read-only
-            link_file = exp_subdir / "reads.fastq.gz"
-            command = ["ln", "-s", fastq_to_files[bc].resolve(), str(link_file)]
-            run_command(command)
-            make_read_only([str(link_file)])
-
-            single_experiment_readme(exp_subdir, row, git_id)
-
-            # if present, copy the prokka folder containing annotated genome
-            prokka_fld_src = (
-                data_fld
-                / "clustering"
-                / f"barcode{int(bc):02d}"
-                / f"prokka_barcode{int(bc):02d}"
-            )
-            if prokka_fld_src.is_dir():
-                print("copying assembled and annotated genome")
-                prokka_dest = exp_subdir / "assembled_genome"
-                prokka_dest.mkdir()
-                copy_prokka_data(prokka_fld_src, prokka_dest)
-
-        # check if sample.csv already exists, if so merge and overwrite
-        sample_info = exp_dir / "sample.csv"
-        if sample_info.is_file():
-            print(f"appending to table {sample_info}")
-            lock_file(sample_info)
-            old_df = pd.read_csv(sample_info, **read_sample_info_kwargs)
-            new_df = pd.concat([old_df, sdf], ignore_index=True)
-            run_command(["chmod", "666", str(sample_info)])
-            new_df.to_csv(sample_info, index=False)
-            unlock_file(sample_info)
-        else:
-            print(f"creating table {sample_info}")
-            sdf.to_csv(sample_info, index=False)
-
-        # making the file read-only
-        run_command(["chmod", "444", str(sample_info)])
+    print("this might take some time...")
+    checksum = None if args.checksum == "none" else args.checksum
+    dedup_root = None if args.no_dedup else bc_main_dir
+    executor = ArchiveExecutor(journal, args.threads, checksum, dedup_root)
+    try:
+        executor.execute(plan, rollback=not args.keep_partial)
+    except BaseException:
+        if not args.keep_partial and not args.resume:
+            # nothing left to resume
+            journal.path.unlink(missing_ok=True)
+        raise
+
+    # update the catalog of the archive
+    print(f"updating archive catalog for run {flow_run_tag}")
+    with stage("update catalog"):
+        update_run(dest, flow_run_tag)
 
     print("\n ---- Data successfully archived ----\n")
     print("the following folders were created:")
-    for fold in created_dirs:
-        print(fold)
+    for fold in executor.created:
+        if fold.is_dir():
+            print(fold)
@@ -0,0 +1,276 @@
+# SQLite catalog of the group archive. The catalog indexes the content of the
+# `raw`, `basecalled` and `experiments` folders: archived runs, barcodes,
+# experimental samples, files (with size and checksum) and assembled genomes,
+# so that samples can be looked up without walking the archive tree.
+#
+# The catalog is derived entirely from the archive: each run is scanned from
+# its folders and `sample.csv` tables, and its rows are replaced in a single
+# transaction. The whole catalog can be rebuilt from the tree, scanning runs
+# in parallel.
+
+import argparse
+import csv
+import pathlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from copy_engine import ALGORITHMS, manifest_name, read_manifest
+from fast5_tar import INDEX_NAME
+
+CATALOG_NAME = "catalog.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_tag TEXT PRIMARY KEY,
+    flowcell_run_id TEXT,
+    archive_date TEXT
+);
+CREATE TABLE IF NOT EXISTS barcodes (
+    run_tag TEXT,
+    barcode INTEGER,
+    fastq_file TEXT,
+    PRIMARY KEY (run_tag, barcode)
+);
+CREATE TABLE IF NOT EXISTS samples (
+    experiment_id TEXT,
+    date TEXT,
+    vial TEXT,
+    timepoint TEXT,
+    run_tag TEXT,
+    barcode INTEGER,
+    folder TEXT
+);
+CREATE INDEX IF NOT EXISTS samples_condition
+    ON samples (experiment_id, vial, timepoint);
+CREATE INDEX IF NOT EXISTS samples_run ON samples (run_tag, barcode);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    run_tag TEXT,
+    kind TEXT,
+    size INTEGER,
+    checksum TEXT,
+    algorithm TEXT
+);
+CREATE INDEX IF NOT EXISTS files_run ON files (run_tag);
+CREATE TABLE IF NOT EXISTS assemblies (
+    run_tag TEXT,
+    barcode INTEGER,
+    experiment_id TEXT,
+    vial TEXT,
+    timepoint TEXT,
+    folder TEXT
+);
+CREATE INDEX IF NOT EXISTS assemblies_run ON assemblies (run_tag, barcode);
+"""
+
+TABLES = ["runs", "barcodes", "samples", "files", "assemblies"]
+
+
+def connect(archive_root):
+    """Opens the catalog of the archive, creating it if needed."""
+    conn = sqlite3.connect(pathlib.Path(archive_root) / CATALOG_NAME, timeout=60)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def read_table(csv_file):
+    """Reads a `sample.csv` table as a list of dictionaries."""
+    with open(csv_file, "r", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def file_kind(name):
+    """Classifies the files of the archive."""
+    if name.endswith(".tar"):
+        return "fast5_tar"
+    if name == INDEX_NAME:
+        return "fast5_index"
+    if name.endswith(".fastq.gz"):
+        return "fastq"
+    if name.endswith(".fastq.gz.fqi"):
+        return "fastq_index"
+    if name.startswith("checksums."):
+        return "checksums"
+    return "other"
+
+
+def scan_run(archive_root, run_tag):
+    """Scans the archived run `run_tag` and returns the rows of each table of
+    the catalog, as a dictionary {table: list of tuples}."""
+    root = pathlib.Path(archive_root)
+    rows = {table: [] for table in TABLES}
+    raw_fld, bc_fld = root / "raw" / run_tag, root / "basecalled" / run_tag
+
+    # checksums of the copied files, if any
+    checksums = {}
+    for alg in ALGORITHMS:
+        mf = bc_fld / manifest_name(alg)
+        if mf.is_file():
+            for rel, digest in read_manifest(mf).items():
+                checksums[str(bc_fld / rel)] = (digest, alg)
+
+    for fld in [raw_fld, bc_fld]:
+        if not fld.is_dir():
+            continue
+        for f in sorted(fld.iterdir()):
+            if f.is_file() and f.name not in ("sample.csv", "README.txt"):
+                digest, alg = checksums.get(str(f), (None, None))
+                kind = file_kind(f.name)
+                rows["files"].append(
+                    (str(f), run_tag, kind, f.stat().st_size, digest, alg)
+                )
+
+    sample_file = bc_fld / "sample.csv"
+    if not sample_file.is_file():
+        sample_file = raw_fld / "sample.csv"
+    table = read_table(sample_file) if sample_file.is_file() else []
+    flowcell = table[0]["flowcell_run_id"] if table else None
+    rows["runs"].append((run_tag, flowcell, run_tag[:10]))
+
+    for row in table:
+        bc = int(row["barcode"])
+        fastq_file = bc_fld / f"barcode{bc:02d}.fastq.gz"
+        rows["barcodes"].append((run_tag, bc, str(fastq_file)))
+        exp_tag = f"{row['date']}_{row['experiment_id']}"
+        folder = (
+            root
+            / "experiments"
+            / exp_tag
+            / f"vial_{int(row['vial']):02d}"
+            / f"time_{row['timepoint']}"
+        )
+        exp_id, vial, tp = row["experiment_id"], row["vial"], row["timepoint"]
+        rows["samples"].append(
+            (exp_id, row["date"], vial, tp, run_tag, bc, str(folder))
+        )
+        if (folder / "assembled_genome").is_dir():
+            assembly_fld = str(folder / "assembled_genome")
+            rows["assemblies"].append((run_tag, bc, exp_id, vial, tp, assembly_fld))
+    return rows
+
+
+def replace_run(conn, run_tag, rows):
+    """Replaces the rows of a run in all tables. Must be called inside of a
+    transaction."""
+    for table in TABLES:
+        conn.execute(f"DELETE FROM {table} WHERE run_tag = ?", (run_tag,))
+        if rows[table]:
+            marks = ",".join("?" * len(rows[table][0]))
+            conn.executemany(f"INSERT INTO {table} VALUES ({marks})", rows[table])
+
+
+def update_run(archive_root, run_tag):
+    """Scans an archived run and updates its entries in the catalog, in a
+    single transaction."""
+    rows = scan_run(archive_root, run_tag)
+    conn = connect(archive_root)
+    try:
+        with conn:
+            replace_run(conn, run_tag, rows)
+    finally:
+        conn.close()
+
+
+def list_runs(archive_root):
+    """Returns the tags of all runs in the archive."""
+    root = pathlib.Path(archive_root)
+    tags = set()
+    for sub in ["raw", "basecalled"]:
+        if (root / sub).is_dir():
+            tags |= {f.name for f in (root / sub).iterdir() if f.is_dir()}
+    return sorted(tags)
+
+
+def rebuild(archive_root, threads=8):
+    """Reconstructs the whole catalog from the archive tree. Runs are scanned
+    in parallel by `threads` threads, and the catalog is replaced in a single
+    transaction. Returns the number of runs."""
+    run_tags = list_runs(archive_root)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        all_rows = list(pool.map(lambda t: scan_run(archive_root, t), run_tags))
+    conn = connect(archive_root)
+    try:
+        with conn:
+            for table in TABLES:
+                conn.execute(f"DELETE FROM {table}")
+            for run_tag, rows in zip(run_tags, all_rows):
+                replace_run(conn, run_tag, rows)
+    finally:
+        conn.close()
+    return len(run_tags)
+
+
+def query(archive_root, sql, params=()):
+    """Runs a query on the catalog, and returns the column names and rows."""
+    conn = connect(archive_root)
+    try:
+        cur = conn.execute(sql, params)
+        return [d[0] for d in cur.description], cur.fetchall()
+    finally:
+        conn.close()
+
+
+def find_samples(archive_root, experiment_id=None, vial=None, timepoint=None):
+    """Returns the samples matching the conditions, with the flowcell run and
+    barcode containing their reads."""
+    conds, params = [], []
+    for col, val in [
+        ("experiment_id", experiment_id),
+        ("vial", vial),
+        ("timepoint", timepoint),
+    ]:
+        if val is not None:
+            conds.append(f"s.{col} = ?")
+            params.append(val)
+    where = f"WHERE {' AND '.join(conds)}" if conds else ""
+    sql = f"""SELECT s.experiment_id, s.date, s.vial, s.timepoint,
+        r.flowcell_run_id, s.run_tag, s.barcode, b.fastq_file
+        FROM samples s
+        JOIN runs r ON r.run_tag = s.run_tag
+        LEFT JOIN barcodes b ON b.run_tag = s.run_tag AND b.barcode = s.barcode
+        {where} ORDER BY s.experiment_id, s.date, s.vial, s.timepoint"""
+    return query(archive_root, sql, params)
+
+
+def print_rows(columns, rows):
+    print("\t".join(columns))
+    for row in rows:
+        print("\t".join("" if v is None else str(v) for v in row))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="catalog of the group archive")
+    parser.add_argument("archive_root", type=str, help="root folder of the archive")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_rebuild = subparsers.add_parser(
+        "rebuild", help="reconstruct the catalog from the archive tree"
+    )
+    p_rebuild.add_argument(
+        "--threads", type=int, help="number of runs scanned in parallel", default=8
+    )
+    p_update = subparsers.add_parser("update", help="update the entries of a run")
+    p_update.add_argument("run_tag", type=str, help="tag of the archived run")
+    p_samples = subparsers.add_parser(
+        "samples", help="find the runs and barcodes of experimental samples"
+    )
+    p_samples.add_argument("--exp_id", type=str, help="experiment id")
+    p_samples.add_argument("--vial", type=str, help="vial")
+    p_samples.add_argument("--timepoint", type=str, help="timepoint")
+    subparsers.add_parser("assemblies", help="list all assembled genomes")
+    p_sql = subparsers.add_parser("sql", help="run an arbitrary SQL query")
+    p_sql.add_argument("sql", type=str, help="SQL query")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        n = rebuild(args.archive_root, threads=args.threads)
+        print(f"catalog rebuilt with {n} runs")
+    elif args.command == "update":
+        update_run(args.archive_root, args.run_tag)
+    elif args.command == "samples":
+        print_rows(
+            *find_samples(args.archive_root, args.exp_id, args.vial, args.timepoint)
+        )
+    elif args.command == "assemblies":
+        print_rows(*query(args.archive_root, "SELECT * FROM assemblies"))
+    elif args.command == "sql":
+        print_rows(*query(args.archive_root, args.sql))
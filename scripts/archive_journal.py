@@ -0,0 +1,113 @@
+# Progress journal of an archive run, used to resume interrupted runs. The
+# journal is a json file saved in the folder of the run being archived. It
+# records the run tag of the archive (which contains the date of the first
+# attempt), the completed steps, the size and checksum of every copied file,
+# the index entries of completed fast5 tar shards, and the paths created.
+# It is rewritten atomically after every update, so that it always reflects
+# work that was completed.
+
+import json
+import os
+import pathlib
+import threading
+
+JOURNAL_NAME = "archive_journal.json"
+
+
+class ArchiveJournal:
+    """Persistent record of the progress of an archive run. Updates are
+    thread-safe."""
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.lock = threading.Lock()
+        self.reset()
+        if self.path.is_file():
+            with open(self.path, "r") as f:
+                self.data.update(json.load(f))
+
+    def reset(self):
+        """Clears the journal, to start a new run. The file is overwritten at
+        the next update."""
+        self.data = {
+            "run_tag": None,
+            "steps": [],
+            "files": {},
+            "shards": {},
+            "created": [],
+        }
+
+    def exists(self):
+        return self.path.is_file()
+
+    def _save(self):
+        tmp = self.path.with_name(f".{self.path.name}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.data, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    @property
+    def run_tag(self):
+        return self.data["run_tag"]
+
+    def set_run_tag(self, run_tag):
+        with self.lock:
+            self.data["run_tag"] = run_tag
+            self._save()
+
+    def is_done(self, step):
+        return step in self.data["steps"]
+
+    def mark_done(self, step):
+        with self.lock:
+            if step not in self.data["steps"]:
+                self.data["steps"].append(step)
+            self._save()
+
+    def unmark_done(self, step):
+        with self.lock:
+            if step in self.data["steps"]:
+                self.data["steps"].remove(step)
+            self._save()
+
+    def file_record(self, dst):
+        """Returns (size, digest) of a file copied in a previous attempt, or
+        None if absent."""
+        rec = self.data["files"].get(str(dst))
+        return None if rec is None else tuple(rec)
+
+    def record_file(self, dst, size, digest):
+        with self.lock:
+            self.data["files"][str(dst)] = [size, digest]
+            self._save()
+
+    def shard_entries(self, shard):
+        """Returns the index entries of a completed tar shard, or None."""
+        return self.data["shards"].get(str(shard))
+
+    def record_shard(self, shard, entries):
+        with self.lock:
+            self.data["shards"][str(shard)] = entries
+            self._save()
+
+    def was_created(self, path):
+        return str(path) in self.data["created"]
+
+    def record_created(self, path):
+        with self.lock:
+            if str(path) not in self.data["created"]:
+                self.data["created"].append(str(path))
+            self._save()
+
+    def entries_in(self, folder):
+        """Returns the paths created or copied inside `folder` (excluded),
+        deepest first."""
+        folder = pathlib.Path(folder)
+        paths = {
+            pathlib.Path(p)
+            for p in self.data["created"] + list(self.data["files"])
+            if folder in pathlib.Path(p).parents
+        }
+        return sorted(paths, key=lambda p: len(p.parts), reverse=True)
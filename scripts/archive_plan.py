@@ -0,0 +1,284 @@
+# Plan-then-execute engine for `archive.py`. The archive is first described
+# as an ordered list of actions (folders to create, files to copy or write,
+# symlinks, permission changes...), without touching the filesystem. The plan
+# can be printed for a dry run, and is then executed with in-process `os`
+# calls. Paths created during the execution are recorded, and removed in
+# reverse order if the execution fails, so that a failed run does not leave
+# a partial archive behind. Only the files written by the run are removed,
+# and folders only if they are left empty, since shared folders (e.g. of an
+# experiment) can be filled at the same time by other runs. Rows appended to
+# shared tables are removed, keeping those added by other runs.
+
+import os
+import pathlib
+import stat
+from copy_engine import copy_files, dedup_index, manifest_name, write_manifest
+from fast5_tar import create_archive, plan_shards
+from profiling import stage
+from sample_table import append_rows, remove_rows
+
+READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+# profiling stage of each kind of action (see `profiling.py`)
+STAGES = {
+    "mkdir": "create folders",
+    "fast5": "tar fast5",
+    "copy": "copy files",
+    "text": "write files",
+    "csv": "write tables",
+    "symlink": "link experiments",
+    "step": "journal",
+}
+
+
+def make_read_only(files):
+    """Sets the permissions of the files to read-only (444)."""
+    for f in files:
+        os.chmod(f, READ_ONLY)
+
+
+def remove_path(path):
+    """Removes a file or symlink, or a folder if it is empty."""
+    if path.is_dir() and not path.is_symlink():
+        try:
+            path.rmdir()
+        except OSError:
+            pass  # not empty, e.g. filled by another run
+    else:
+        path.unlink(missing_ok=True)
+
+
+def _size_mb(files):
+    return sum(pathlib.Path(f).stat().st_size for f in files) / 1e6
+
+
+class ArchivePlan:
+    """Ordered list of the actions needed to archive a run. Each action is
+    a tuple whose first element is its kind. The `journal` of the run is used
+    to detect conflicts with existing folders while planning."""
+
+    def __init__(self, run_tag, journal):
+        self.run_tag = run_tag
+        self.journal = journal
+        self.actions = []
+        self.read_only = []
+
+    def mkdir(self, path, exist_ok=False, rebuild=False):
+        """Creates a folder. If `exist_ok` an existing folder is used as it
+        is. If `rebuild` a folder created by an interrupted attempt of the
+        same run is removed and created again."""
+        path = pathlib.Path(path)
+        if path.is_dir() and not (exist_ok or self.journal.was_created(path)):
+            raise FileExistsError(
+                f"The folder {path} already exists. Remove it to overwrite it."
+            )
+        self.actions.append(("mkdir", path, exist_ok, rebuild))
+
+    def fast5_archive(self, archive_fld, files, max_shard_size=None):
+        """Archives the fast5 files in one or more indexed tar files."""
+        self.actions.append(("fast5", pathlib.Path(archive_fld), files, max_shard_size))
+
+    def copy(self, pairs, manifest_fld=None):
+        """Copies the (src, dst) pairs in parallel. If `manifest_fld` is
+        specified, the checksums are saved in a manifest in this folder."""
+        for src, _ in pairs:
+            assert pathlib.Path(src).is_file(), f"file {src} does not exist."
+        self.actions.append(("copy", list(pairs), manifest_fld))
+
+    def write_text(self, path, text):
+        self.actions.append(("text", pathlib.Path(path), text))
+
+    def write_csv(self, path, df, merge_kwargs=None):
+        """Writes a dataframe in csv format. If `merge_kwargs` is specified,
+        and the file exists, the dataframe is appended to the existing table,
+        read with these `pd.read_csv` arguments (see `sample_table.py`)."""
+        self.actions.append(("csv", pathlib.Path(path), df, merge_kwargs))
+
+    def symlink(self, target, link):
+        self.actions.append(("symlink", pathlib.Path(target), pathlib.Path(link)))
+
+    def mark_done(self, step):
+        """Records a completed step in the journal."""
+        self.actions.append(("step", step))
+
+    def make_read_only(self, *paths):
+        """Marks files to be made read-only at the end of the execution."""
+        self.read_only += [pathlib.Path(p) for p in paths]
+
+    def describe(self):
+        """Returns a human-readable description of the plan, one action per
+        line."""
+        lines = [f"archive run tag: {self.run_tag}"]
+        for kind, *args in self.actions:
+            if kind == "mkdir":
+                lines.append(f"create folder {args[0]}")
+            elif kind == "fast5":
+                fld, files, max_size = args
+                n = len(plan_shards(files, max_size))
+                size = _size_mb(files)
+                lines.append(
+                    f"archive {len(files)} fast5 files ({size:.1f} MB) "
+                    + f"in {n} tar files in {fld}"
+                )
+            elif kind == "copy":
+                pairs, mfld = args
+                size = _size_mb(src for src, _ in pairs)
+                lines += [f"copy {src} -> {dst}" for src, dst in pairs]
+                lines.append(f"  ({len(pairs)} files, {size:.1f} MB)")
+                if mfld is not None:
+                    lines.append(f"save checksums in {mfld}")
+            elif kind == "text":
+                lines.append(f"write {args[0]}")
+            elif kind == "csv":
+                action = "write" if args[2] is None else "write or append to"
+                lines.append(f"{action} table {args[0]}")
+            elif kind == "symlink":
+                lines.append(f"link {args[1]} -> {args[0]}")
+        lines.append(f"make {len(self.read_only)} files read-only")
+        return "\n".join(lines)
+
+
+class ArchiveExecutor:
+    """Executes an `ArchivePlan`, recording progress in an `ArchiveJournal`.
+    Copies use `threads` threads and the `checksum` algorithm (or None). If
+    `dedup_root` is specified, copied files identical to files listed in
+    checksum manifests of its subfolders are hardlinked instead."""
+
+    def __init__(self, journal, threads=4, checksum="sha256", dedup_root=None):
+        self.journal = journal
+        self.threads = threads
+        self.checksum = checksum
+        self.dedup_root = dedup_root
+        # paths created, rows appended to tables and steps completed by this
+        # execution
+        self.created = []
+        self.modified = []
+        self.steps = []
+
+    def _create(self, path):
+        self.created.append(path)
+        self.journal.record_created(path)
+
+    def _mkdir(self, path, exist_ok, rebuild):
+        journaled = self.journal.was_created(path)
+        if path.is_dir() and journaled and rebuild:
+            # only the entries written by the interrupted attempt are removed
+            for entry in self.journal.entries_in(path):
+                remove_path(entry)
+            self._create(path)
+            return
+        elif path.is_dir() and (journaled or exist_ok):
+            return
+        if path.is_dir():
+            raise FileExistsError(
+                f"The folder {path} already exists. Remove it to overwrite it."
+            )
+        path.mkdir()
+        self._create(path)
+
+    def _copy(self, pairs, manifest_fld):
+        dedup = None
+        if self.checksum is not None and self.dedup_root is not None:
+            manifests = self.dedup_root.glob(f"*/{manifest_name(self.checksum)}")
+            dedup = dedup_index(m for m in manifests if m.parent != manifest_fld)
+        existing = [dst.exists() for _, dst in pairs]
+        try:
+            copied = copy_files(
+                pairs,
+                algorithm=self.checksum,
+                threads=self.threads,
+                journal=self.journal,
+                dedup=dedup,
+            )
+        finally:
+            for (_, dst), found in zip(pairs, existing):
+                if not found and dst.exists():
+                    self._create(dst)
+        if manifest_fld is not None and self.checksum is not None:
+            manifest = manifest_fld / manifest_name(self.checksum)
+            print(f"saving checksums in {manifest}")
+            self._write(manifest, lambda: write_manifest(manifest, copied))
+            make_read_only([manifest])
+
+    def _write(self, path, write):
+        """Writes a file with the function `write`, replacing it if present."""
+        path.unlink(missing_ok=True)
+        self._create(path)
+        write()
+
+    def _write_csv(self, path, df, merge_kwargs):
+        if merge_kwargs is None:
+            print(f"creating table {path}")
+            self._write(path, lambda: df.to_csv(path, index=False))
+            return
+        print(f"updating table {path}")
+        added = append_rows(path, df, merge_kwargs)
+        self.modified.append((path, added, merge_kwargs))
+
+    def _run(self, action):
+        name = STAGES[action[0]]
+        # only the copy of the fastq files of the barcodes has a manifest
+        if action[0] == "copy" and action[2] is not None:
+            name = "copy barcodes"
+        with stage(name):
+            self._run_action(*action)
+
+    def _run_action(self, kind, *args):
+        if kind == "mkdir":
+            self._mkdir(*args)
+        elif kind == "fast5":
+            fld, files, max_size = args
+            print(f"creating fast5 archive in {fld}...")
+            existing = set(fld.iterdir())
+            try:
+                create_archive(fld, files, max_size, journal=self.journal)
+            finally:
+                for p in fld.iterdir():
+                    if p not in existing:
+                        self._create(p)
+        elif kind == "copy":
+            self._copy(*args)
+        elif kind == "text":
+            path, text = args
+            self._write(path, lambda: path.write_text(text))
+        elif kind == "csv":
+            self._write_csv(*args)
+        elif kind == "symlink":
+            target, link = args
+            link.unlink(missing_ok=True)
+            os.symlink(target, link)
+            self._create(link)
+        elif kind == "step":
+            self.journal.mark_done(args[0])
+            self.steps.append(args[0])
+
+    def rollback(self):
+        """Removes the rows appended to tables and the created paths, in
+        reverse order of creation. Folders are removed only if empty, since
+        they can contain files of other runs. Steps completed are marked as
+        not done in the journal."""
+        for step in self.steps:
+            self.journal.unmark_done(step)
+        for path, rows, merge_kwargs in reversed(self.modified):
+            remove_rows(path, rows, merge_kwargs)
+        for path in reversed(self.created):
+            remove_path(path)
+        self.created, self.modified, self.steps = [], [], []
+
+    def execute(self, plan, rollback=True):
+        """Executes the plan, and marks the `archive` step as done in the
+        journal. If an action fails and `rollback` is True, the created paths
+        are removed before raising the error."""
+        self.journal.set_run_tag(plan.run_tag)
+        try:
+            for action in plan.actions:
+                self._run(action)
+            # symlinks point to files that are already read-only
+            with stage("set permissions"):
+                make_read_only(p for p in plan.read_only if not p.is_symlink())
+            self.journal.mark_done("archive")
+        except BaseException:
+            if rollback:
+                print("archive failed, removing created files...")
+                self.rollback()
+            raise
@@ -0,0 +1,148 @@
+# Incrementally appends basecalled fastq.gz files to the corresponding
+# `barcodeXX.fastq.gz` file, while basecalling is still running. Gzip members
+# are appended without recompression (see `concat_gz.py`).
+#
+# Appends are crash-safe: a per-barcode manifest records which batches were
+# appended and the size of the file after each of them. Before appending, the
+# file is truncated to the size recorded in the manifest, removing any partial
+# append left by an interrupted run, and batches already in the manifest are
+# skipped, so that resuming the pipeline does not duplicate reads.
+#
+# Optionally reads are recompressed in BGZF format, and a read-offset index is
+# appended to the companion `.fqi` file (see `fastq_index.py`).
+#
+# Since data before the size recorded in the manifest is never modified, a
+# consistent copy of the reads appended so far can be taken at any time,
+# without locking (see `snapshot`).
+
+import argparse
+import fcntl
+import json
+import os
+import pathlib
+from concat_gz import copy_checked
+from fastq_index import index_file, write_bgzf_fastq
+
+
+def manifest_file(fastq_file):
+    """Returns the path of the (hidden) manifest of a barcode file."""
+    fastq_file = pathlib.Path(fastq_file)
+    return fastq_file.with_name(f".{fastq_file.name}.manifest.json")
+
+
+def load_manifest(fastq_file):
+    """Returns the manifest of the barcode file: a dictionary with the list of
+    appended batches, the committed size of the file and of its index, and
+    whether the file is in BGZF format."""
+    mf = manifest_file(fastq_file)
+    if not mf.is_file():
+        return {"batches": [], "size": 0, "index_size": 0, "bgzf": None}
+    with open(mf, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(fastq_file, manifest):
+    """Atomically replaces the manifest of the barcode file."""
+    mf = manifest_file(fastq_file)
+    tmp = mf.with_name(mf.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, mf)
+
+
+def append_batch(fastq_file, batch_id, files, bgzf=False, threads=1):
+    """Appends the gzip `files` to `fastq_file`, recording them in the
+    manifest under `batch_id`. Returns False if the batch was already
+    appended. If `bgzf` is True the reads are recompressed in BGZF format
+    with `threads` threads and indexed. The file is locked during the
+    operation, so that concurrent appends to the same barcode are
+    serialized."""
+    fastq_file = pathlib.Path(fastq_file)
+    lock_file = fastq_file.with_name(f".{fastq_file.name}.lock")
+    with open(lock_file, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = load_manifest(fastq_file)
+        if batch_id in manifest["batches"]:
+            return False
+        if manifest["bgzf"] is None:
+            manifest["bgzf"] = bgzf
+        assert (
+            manifest["bgzf"] == bgzf
+        ), f"cannot mix BGZF and plain gzip appends in {fastq_file}"
+        with open(fastq_file, "ab+") as f:
+            # discard data from interrupted appends
+            f.truncate(manifest["size"])
+            f.seek(manifest["size"])
+            if bgzf:
+                with open(index_file(fastq_file), "ab+") as idx:
+                    idx.truncate(manifest["index_size"])
+                    idx.seek(manifest["index_size"])
+                    write_bgzf_fastq(
+                        files, f, idx, threads=threads, start_offset=manifest["size"]
+                    )
+                    idx.flush()
+                    os.fsync(idx.fileno())
+                    manifest["index_size"] = idx.tell()
+            else:
+                for src in files:
+                    copy_checked(src, f)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        manifest["batches"].append(batch_id)
+        manifest["size"] = size
+        save_manifest(fastq_file, manifest)
+    return True
+
+
+def snapshot(fastq_file, out_file, block_size=8 * 1024**2):
+    """Copies the batches appended so far to `out_file`, leaving out a
+    running append. Returns the number of bytes copied."""
+    fastq_file = pathlib.Path(fastq_file)
+    if not manifest_file(fastq_file).is_file():
+        raise ValueError(f"{fastq_file} has no manifest")
+    size = load_manifest(fastq_file)["size"]
+    with open(fastq_file, "rb") as src, open(out_file, "wb") as dst:
+        remaining = size
+        while remaining > 0:
+            data = src.read(min(remaining, block_size))
+            if not data:
+                raise ValueError(f"{fastq_file} is shorter than its manifest")
+            dst.write(data)
+            remaining -= len(data)
+    return size
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="append basecalled fastq.gz files to a barcode file"
+    )
+    parser.add_argument(
+        "fastq_file", type=str, help="barcode file, e.g. `barcode01.fastq.gz`"
+    )
+    parser.add_argument(
+        "batch_id",
+        type=str,
+        help="unique identifier of the batch, used to avoid duplicated appends",
+    )
+    parser.add_argument("files", type=str, nargs="+", help="gzip files to append")
+    parser.add_argument(
+        "--bgzf",
+        help="recompress the reads in BGZF format and index them",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="number of compression threads, only used with --bgzf",
+        default=1,
+    )
+    args = parser.parse_args()
+
+    if not append_batch(
+        args.fastq_file, args.batch_id, args.files, bgzf=args.bgzf, threads=args.threads
+    ):
+        print(f"batch {args.batch_id} already in {args.fastq_file}, skipping")
@@ -0,0 +1,191 @@
+# Quality control summary of the reads of each barcode: number of reads,
+# total bases, N50, mean read quality and estimated coverage of the genome.
+# Files are parsed in parallel by a pool of processes, streaming the reads in
+# large blocks (see `fastq_scan.py`). Large BGZF files with a read index
+# (`.fqi`, see `fastq_index.py`) are also split in chunks that are processed
+# in parallel, so that a single large barcode does not dominate the runtime.
+#
+# Usage: python3 barcode_qc.py basecalled/barcode*.fastq.gz [--threads N]
+
+import argparse
+import os
+import pathlib
+import numpy as np
+from bgzf import BgzfReader
+from fastq_index import index_file, load_index
+from fastq_scan import BLOCK_SIZE, iter_records_blocks, open_fastq, read_mean_q
+from stats_cache import open_cache
+import profiling
+from profiling import stage
+
+QC_COLUMNS = ["n_reads", "tot_bases", "N50", "mean_q", "coverage"]
+
+# default expected genome size (bp), used to estimate the coverage
+GENOME_SIZE = 5e6
+
+# default rule to mark a barcode as valid
+VALID_RULE = "coverage >= 5"
+
+# compressed size of the chunks in which indexed files are split
+CHUNK_SIZE = 128 * 1024**2
+
+
+class BgzfRange:
+    """File-like object reading the uncompressed data of a BGZF file between
+    two virtual offsets (until the end of the file if `stop` is None)."""
+
+    def __init__(self, path, start, stop=None):
+        self.reader = BgzfReader(path)
+        self.reader.seek(start)
+        self.stop = stop
+
+    def read(self, size):
+        return self.reader.read(size, self.stop)
+
+    def close(self):
+        self.reader.close()
+
+
+def file_tasks(fastq_file, chunk_size=CHUNK_SIZE):
+    """Splits a file in (path, start, stop) tasks. Only indexed files are
+    split, at the virtual offsets of the reads. Start and stop are None for
+    a task covering the whole file."""
+    size = os.path.getsize(fastq_file)
+    if size <= chunk_size or not index_file(fastq_file).is_file():
+        return [(fastq_file, None, None)]
+    voffsets = load_index(fastq_file)["voffset"]
+    # stale index, e.g. the file was rewritten
+    if len(voffsets) == 0 or int(voffsets[-1]) >> 16 >= size:
+        return [(fastq_file, None, None)]
+    coffsets = voffsets >> np.uint64(16)
+    targets = np.arange(chunk_size, size, chunk_size)
+    bounds = np.unique(np.searchsorted(coffsets, targets))
+    bounds = bounds[(bounds > 0) & (bounds < len(voffsets))]
+    starts = [0] + [int(voffsets[b]) for b in bounds]
+    stops = starts[1:] + [None]
+    return [(fastq_file, start, stop) for start, stop in zip(starts, stops)]
+
+
+def scan_task(task):
+    """Returns the distinct read lengths, their counts, and the sum of the
+    mean quality of the reads covered by a task."""
+    path, start, stop = task
+    if start is None:
+        with open_fastq(path) as stream:
+            return scan_stream(stream)
+    stream = BgzfRange(path, start, stop)
+    try:
+        return scan_stream(stream)
+    finally:
+        stream.close()
+
+
+def scan_stream(stream):
+    lengths, q_sum, q_count = [], 0.0, 0
+    for lines in iter_records_blocks(stream, BLOCK_SIZE):
+        n = len(lines) // 4
+        ls = np.fromiter(map(len, lines[1::4]), dtype=np.int64, count=n)
+        if lines[1].endswith(b"\r"):
+            ls -= 1
+        mean_q = read_mean_q(lines[3::4], ls)
+        lengths.append(ls)
+        q_sum += np.nansum(mean_q)
+        q_count += np.count_nonzero(~np.isnan(mean_q))
+    if not lengths:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), 0.0, 0
+    values, counts = np.unique(np.concatenate(lengths), return_counts=True)
+    return values, counts, q_sum, q_count
+
+
+def n50(values, counts):
+    """N50 of reads with lengths `values` occurring `counts` times."""
+    if len(values) == 0:
+        return 0
+    order = np.argsort(values)[::-1]
+    bases = np.cumsum(values[order] * counts[order])
+    return int(values[order][np.searchsorted(bases, bases[-1] / 2)])
+
+
+def summarize(result, genome_size=GENOME_SIZE):
+    """Computes the QC metrics of a file from the combined result of its
+    tasks."""
+    values, counts, q_sum, q_count = result
+    tot_bases = int(np.sum(values * counts))
+    return {
+        "n_reads": int(counts.sum()),
+        "tot_bases": tot_bases,
+        "N50": n50(values, counts),
+        "mean_q": round(float(q_sum / q_count), 2) if q_count else np.nan,
+        "coverage": round(tot_bases / genome_size, 2),
+    }
+
+
+def combine(results):
+    """Combines the results of the tasks of a file in a single one."""
+    values = np.concatenate([r[0] for r in results])
+    counts = np.concatenate([r[1] for r in results])
+    values, inverse = np.unique(values, return_inverse=True)
+    counts = np.bincount(inverse, weights=counts).astype(np.int64)
+    return values, counts, sum(r[2] for r in results), sum(r[3] for r in results)
+
+
+def qc_table(fastq_files, threads=8, genome_size=GENOME_SIZE, cache=None):
+    """Returns a dataframe with the QC metrics (`QC_COLUMNS`) of each file,
+    in the same order as the files. If a `StatsCache` is given, only files
+    that are not in the cache are scanned."""
+    # imported here, so that `length_filter.py` does not import them
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    import pandas as pd
+
+    def scan(path):
+        res = combine(list(pool.map(scan_task, file_tasks(path))))
+        return {"len": res[0], "count": res[1], "q": np.array(res[2:])}
+
+    def file_stats(path):
+        return scan(path) if cache is None else cache.cached("qc", path, scan)
+
+    # files are handled in threads, each submitting its tasks to the pool of
+    # processes, so that small files are scanned in parallel too
+    with stage("scan reads"), ProcessPoolExecutor(max_workers=threads) as pool:
+        with ThreadPoolExecutor(max_workers=threads) as files_pool:
+            per_file = list(files_pool.map(file_stats, fastq_files))
+    rows = [summarize((s["len"], s["count"], *s["q"]), genome_size) for s in per_file]
+    return pd.DataFrame(rows, columns=QC_COLUMNS)
+
+
+def apply_rule(df, rule=VALID_RULE):
+    """Evaluates the validity rule (a pandas expression on the QC columns,
+    e.g. `n_reads > 1000 and coverage >= 30`) on each row."""
+    return df.eval(rule).astype(bool)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="QC summary of fastq files")
+    parser.add_argument("fastq_files", type=str, nargs="+", help="fastq files")
+    parser.add_argument(
+        "--threads", type=int, default=8, help="number of parallel processes"
+    )
+    parser.add_argument(
+        "--genome_size",
+        type=float,
+        default=GENOME_SIZE,
+        help="expected genome size (bp), to estimate the coverage",
+    )
+    parser.add_argument("--out", type=str, help="save the table in csv format")
+    parser.add_argument(
+        "--no_cache",
+        help="do not use the statistics cache (see `stats_cache.py`)",
+        action="store_true",
+    )
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args)
+
+    files = [pathlib.Path(f) for f in args.fastq_files]
+    cache = open_cache(not args.no_cache)
+    df = qc_table(files, args.threads, args.genome_size, cache=cache)
+    df.insert(0, "file", [f.name for f in files])
+    print(df.to_string(index=False))
+    if args.out is not None:
+        df.to_csv(args.out, index=False)
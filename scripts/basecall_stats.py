@@ -1,33 +1,157 @@
+import argparse
+import datetime
+import itertools
+import pathlib
+import numpy as np
+from fastq_scan import FastqScanner
+from read_summary import ReadSummary
+import stats_store
+from stats_cache import open_cache
+import profiling
+from profiling import stage
 
-import sys
-import pandas as pd
-from Bio import SeqIO
 
-if __name__ == "__main__":
+def read_stats(fastq):
+    """Scans a fastq file and returns the length, barcode and mean quality of
+    each read."""
+    scanner = FastqScanner()
+    lengths, barcodes, mean_q = [], [], []
+    for l, b, q in scanner.scan(fastq):
+        lengths.append(l.copy())
+        barcodes.append(b.copy())
+        mean_q.append(q.copy())
+    return {
+        "len": np.concatenate(lengths + [np.empty(0, np.int64)]),
+        "barcode": np.concatenate(barcodes + [np.empty(0, np.int32)]),
+        "barcode_names": np.array(scanner.barcode_names, dtype=str),
+        "mean_q": np.concatenate(mean_q + [np.empty(0, np.float32)]),
+    }
+
+
+def scan_file(fastq, time, cache=None):
+    """Scans a fastq file and returns the length, barcode and mean quality of
+    each read, in the shard format of `stats_store.py`, together with the per-barcode
+    summary of the reads. All reads are assigned the same timestamp. If a
+    `StatsCache` is given, the statistics of the file are loaded from it
+    when available."""
+    if cache is None or fastq == "-":
+        shard = read_stats(fastq)
+    else:
+        shard = cache.cached("reads", fastq, read_stats)
+    summary = ReadSummary()
+    summary.add(
+        shard["len"],
+        shard["barcode"],
+        shard["barcode_names"].tolist(),
+        mean_q=shard["mean_q"],
+    )
+    shard["time"] = np.full(len(shard["len"]), np.datetime64(time, "ms"))
+    return shard, summary
 
-    # The only argument is the fastq file to process
-    assert len(sys.argv) == 2
 
-    # extract the records
-    with open(sys.argv[1], 'r') as f:
-        records = list(SeqIO.parse(f, 'fastq'))
-    
-    data = []
+def scan_files(files, time, jobs=1, cache=None):
+    """Scans the fastq files, distributing them over `jobs` worker processes.
+    The partial results are merged in the order of the input files, so that
+    the output does not depend on the number of workers."""
+    args = (files, itertools.repeat(time), itertools.repeat(cache))
+    if jobs > 1 and len(files) > 1:
+        # not imported at the top, it slows down the startup of the per-batch
+        # invocations, which scan a single file
+        from concurrent.futures import ProcessPoolExecutor
 
-    for record in records:
-        # for every read capture length
-        dt = {'len' : len(record)}
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(scan_file, *args))
+    else:
+        results = list(map(scan_file, *args))
+    summary = ReadSummary()
+    for _, partial in results:
+        summary.merge(partial)
+    return stats_store.concat_shards([shard for shard, _ in results]), summary
 
-        # and barcode (or unclassified)
-        desc = str.split(record.description)
-        for dc in desc:
-            if 'barcode=' in dc:
-                dt['barcode'] = dc[len('barcode='):]
-        data.append(dt)
+
+def write_csv(data, out_file):
+    """Writes length, barcode, time and mean quality of each read in csv
+    format."""
+    barcode = np.append(data["barcode_names"], "")[data["barcode"]]
+    time = data["time"].astype(datetime.datetime)
+    mean_q = np.char.mod("%.2f", data["mean_q"])
+    with open(out_file, "w") as f:
+        f.write("len,barcode,time,mean_q\n")
+        f.writelines(
+            f"{l},{b},{t},{q}\n"
+            for l, b, t, q in zip(
+                data["len"].tolist(), barcode.tolist(), time, mean_q.tolist()
+            )
+        )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="extract length and barcode of basecalled reads"
+    )
+    parser.add_argument(
+        "fastq",
+        type=str,
+        nargs="+",
+        help="""fastq files to process (optionally gzipped). Use `-` for
+        stdin.""",
+    )
+    parser.add_argument(
+        "--out",
+        type=str,
+        help="""output file. If it has the `.npz` extension a statistics shard
+        is created, otherwise a csv file. If it is a directory, a new shard
+        with a unique name is created inside of it.""",
+        default="basecalling_stats.csv",
+    )
+    parser.add_argument(
+        "--summary",
+        type=str,
+        help="""if specified, also saves a per-barcode summary of the reads in
+        this file (see `read_summary.py`). If it is a directory, a file with a
+        unique name is created inside of it.""",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="number of worker processes used to scan the files in parallel",
+        default=1,
+    )
+    parser.add_argument(
+        "--cache",
+        help="""use the statistics cache (see `stats_cache.py`). Off by default,
+        since each batch file is usually scanned only once.""",
+        action="store_true",
+    )
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args)
 
     # assign timestamp to the batch
-    df = pd.DataFrame(data)
-    df['time'] = pd.Timestamp.now()
+    time = datetime.datetime.now()
+
+    if pathlib.Path(args.out).is_dir():
+        args.out = str(pathlib.Path(args.out) / stats_store.shard_name())
+    if args.summary is not None and pathlib.Path(args.summary).is_dir():
+        args.summary = pathlib.Path(args.summary) / stats_store.shard_name("summary_")
+
+    cache = open_cache(args.cache)
+    with stage("parse batch"):
+        data, summary = scan_files(args.fastq, time, jobs=args.jobs, cache=cache)
+
+    with stage("write output"):
+        if args.out.endswith(".npz"):
+            stats_store.save_shard(
+                args.out,
+                data["len"],
+                data["barcode"],
+                data["barcode_names"],
+                data["time"],
+                data["mean_q"],
+            )
+        else:
+            write_csv(data, args.out)
 
-    # save in csv format
-    df.to_csv('basecalling_stats.csv', index=False, header=True)
+        if args.summary is not None:
+            summary.save(args.summary)
@@ -0,0 +1,220 @@
+# Utilities to write and read BGZF files, the blocked gzip format used by
+# samtools and htslib. A BGZF file is a valid gzip file, made of a series of gzip members
+# each containing at most 64 KiB of uncompressed data. The compressed size of
+# each block is stored in the header, so that blocks can be located without
+# decompressing the file and compressed independently in parallel.
+#
+# Positions in a BGZF file are expressed as virtual offsets: the offset of the
+# beginning of a compressed block, shifted left by 16 bits, plus the offset
+# within the uncompressed data of the block.
+
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# maximum amount of uncompressed data per block, as in htslib. This ensures
+# that the compressed block always fits in 64 KiB.
+MAX_BLOCK_DATA = 0xFF00
+
+# fixed part of the header: gzip magic, deflate, FEXTRA flag, no mtime,
+# no extra flags, unknown OS, extra field of length 6 with the `BC` subfield
+# of length 2, followed by the total block size minus one.
+HEADER = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+HEADER_SIZE = len(HEADER) + 2
+
+# empty block that marks the end of a BGZF file
+EOF_BLOCK = HEADER + b"\x1b\x00\x03\x00" + b"\x00" * 8
+
+
+def compress_block(data, level=6):
+    """Compresses up to `MAX_BLOCK_DATA` bytes in a single BGZF block."""
+    assert len(data) <= MAX_BLOCK_DATA, "too much data for a single BGZF block"
+    comp = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = comp.compress(data) + comp.flush()
+    bsize = HEADER_SIZE + len(cdata) + 8
+    return b"".join(
+        [
+            HEADER,
+            struct.pack("<H", bsize - 1),
+            cdata,
+            struct.pack("<II", zlib.crc32(data), len(data)),
+        ]
+    )
+
+
+class BgzfWriter:
+    """Writes data to a binary stream in BGZF format. Blocks are compressed
+    in parallel by `threads` threads (zlib releases the GIL), in batches of
+    `batch_blocks` blocks. The end-of-file block is written by `close`, which
+    does not close the underlying stream.
+
+    `start_offset` is the position of the stream at which writing starts (non
+    zero when appending to a file). The compressed offset of each data block
+    is recorded, so that uncompressed positions in the written data can be
+    converted to virtual offsets with `virtual_offsets`."""
+
+    def __init__(self, stream, threads=1, level=6, batch_blocks=64, start_offset=0):
+        self.stream = stream
+        self.level = level
+        self.batch_size = batch_blocks * MAX_BLOCK_DATA
+        self.pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.buffer = bytearray()
+        # offset of the beginning of the next block in the compressed stream
+        self.block_offset = start_offset
+        # compressed offset of the beginning of each data block
+        self.block_starts = []
+
+    def _compress(self, data):
+        blocks = [
+            bytes(data[i : i + MAX_BLOCK_DATA])
+            for i in range(0, len(data), MAX_BLOCK_DATA)
+        ]
+        levels = [self.level] * len(blocks)
+        if self.pool is None:
+            return map(compress_block, blocks, levels)
+        return self.pool.map(compress_block, blocks, levels)
+
+    def _write_blocks(self, data):
+        for block in self._compress(data):
+            self.block_starts.append(self.block_offset)
+            self.stream.write(block)
+            self.block_offset += len(block)
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.batch_size:
+            n = len(self.buffer) // MAX_BLOCK_DATA * MAX_BLOCK_DATA
+            self._write_blocks(self.buffer[:n])
+            del self.buffer[:n]
+
+    def flush(self):
+        """Compresses all buffered data. The last block might be smaller
+        than the maximum block size."""
+        if self.buffer:
+            self._write_blocks(self.buffer)
+            self.buffer = bytearray()
+
+    def virtual_offsets(self, positions):
+        """Converts positions in the uncompressed data written so far into
+        virtual offsets. All blocks but the last one contain exactly
+        `MAX_BLOCK_DATA` bytes, so the block of each position is known."""
+        positions = np.asarray(positions, dtype=np.uint64)
+        block = positions // MAX_BLOCK_DATA
+        starts = np.array(self.block_starts, dtype=np.uint64)[block.astype(np.int64)]
+        return (starts << np.uint64(16)) | (positions % MAX_BLOCK_DATA)
+
+    def close(self):
+        self.flush()
+        self.stream.write(EOF_BLOCK)
+        self.block_offset += len(EOF_BLOCK)
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_block(stream):
+    """Reads a BGZF block from the current position of the binary stream.
+    Returns the uncompressed data and the compressed size of the block, or
+    `(b"", 0)` at the end of the stream."""
+    header = stream.read(HEADER_SIZE)
+    if not header:
+        return b"", 0
+    if len(header) < HEADER_SIZE or header[:4] != HEADER[:4] or header[12:14] != b"BC":
+        raise ValueError("not a BGZF block")
+    (bsize,) = struct.unpack("<H", header[-2:])
+    rest = stream.read(bsize + 1 - HEADER_SIZE)
+    data = zlib.decompress(rest[:-8], -15)
+    crc, isize = struct.unpack("<II", rest[-8:])
+    if crc != zlib.crc32(data) or isize != len(data):
+        raise ValueError("corrupted BGZF block")
+    return data, bsize + 1
+
+
+class BgzfReader:
+    """Random-access reader of BGZF files. Positions are virtual offsets, as
+    returned by `tell` and accepted by `seek`. Only the blocks that are
+    needed are decompressed."""
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.block_start = 0
+        self.block_size = 0
+        self.data = b""
+        self.pos = 0
+        self.eof = False
+
+    def _load_block(self, coffset):
+        self.file.seek(coffset)
+        self.block_start = coffset
+        self.data, self.block_size = read_block(self.file)
+        self.eof = self.block_size == 0
+        self.pos = 0
+
+    def seek(self, voffset):
+        coffset, uoffset = int(voffset) >> 16, int(voffset) & 0xFFFF
+        if coffset != self.block_start or self.block_size == 0:
+            self._load_block(coffset)
+        self.pos = uoffset
+
+    def tell(self):
+        if self.pos == len(self.data) and self.block_size > 0:
+            # end of the block: equivalent to the beginning of the next one
+            return (self.block_start + self.block_size) << 16
+        return (self.block_start << 16) | self.pos
+
+    def _next_block(self):
+        """Moves to the next non-empty block. Returns False at end of file."""
+        while self.pos >= len(self.data):
+            if self.eof:
+                return False
+            self._load_block(self.block_start + self.block_size)
+        return True
+
+    def readline(self):
+        """Reads a line, including the final newline."""
+        parts = []
+        while self._next_block():
+            end = self.data.find(b"\n", self.pos)
+            if end >= 0:
+                parts.append(self.data[self.pos : end + 1])
+                self.pos = end + 1
+                break
+            parts.append(self.data[self.pos :])
+            self.pos = len(self.data)
+        return b"".join(parts)
+
+    def read(self, size, stop=None):
+        """Reads up to `size` bytes of uncompressed data. If `stop` is given,
+        reading ends at this virtual offset."""
+        if stop is not None:
+            stop_block, stop_pos = divmod(int(stop), 1 << 16)
+        parts = []
+        while size > 0 and self._next_block():
+            end = self.pos + size
+            if stop is not None:
+                if self.block_start > stop_block:
+                    break
+                if self.block_start == stop_block:
+                    end = min(end, stop_pos)
+                    if self.pos >= end:
+                        break
+            chunk = self.data[self.pos : end]
+            self.pos += len(chunk)
+            size -= len(chunk)
+            parts.append(chunk)
+        return b"".join(parts)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,145 @@
+# Concatenates gzip files without recompressing them. The concatenation of
+# gzip members is itself a valid gzip file, so the compressed bytes can be
+# copied as they are. By default each member is decompressed (and the output
+# discarded) to verify its CRC32 and size trailer before being copied.
+# Optionally the data can instead be recompressed in BGZF format with
+# multiple threads.
+
+import argparse
+import gzip
+import os
+import pathlib
+import zlib
+from bgzf import BgzfWriter
+
+CHUNK = 1024**2
+
+# window bits for zlib to decode a single gzip member, checking its trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def copy_checked(src, dst):
+    """Copies the gzip file `src` to the binary stream `dst`, checking the
+    CRC and size trailer of every member. Returns the number of members."""
+    n_members, in_member = 0, False
+    d = zlib.decompressobj(GZIP_WBITS)
+    with open(src, "rb") as f:
+        while chunk := f.read(CHUNK):
+            while chunk:
+                try:
+                    # bounded output size, the decompressed data is discarded
+                    d.decompress(chunk, 8 * CHUNK)
+                    while d.unconsumed_tail and not d.eof:
+                        d.decompress(d.unconsumed_tail, 8 * CHUNK)
+                except zlib.error as e:
+                    raise ValueError(f"corrupted gzip member in {src}: {e}")
+                if d.eof:
+                    used = len(chunk) - len(d.unused_data)
+                    dst.write(chunk[:used])
+                    chunk = d.unused_data
+                    n_members += 1
+                    in_member = False
+                    d = zlib.decompressobj(GZIP_WBITS)
+                else:
+                    dst.write(chunk)
+                    chunk = b""
+                    in_member = True
+    if in_member:
+        raise ValueError(f"truncated gzip member at the end of {src}")
+    return n_members
+
+
+def copy_raw(src, dst):
+    """Copies the file `src` to the binary stream `dst` with no check other
+    than the gzip magic number, using `os.sendfile` when possible."""
+    with open(src, "rb") as f:
+        if f.read(2) != b"\x1f\x8b":
+            raise ValueError(f"{src} is not a gzip file")
+        size = os.fstat(f.fileno()).st_size
+        dst.flush()
+        offset = 0
+        try:
+            while offset < size:
+                sent = os.sendfile(dst.fileno(), f.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError:
+            # sendfile not supported between these files: plain copy
+            f.seek(offset)
+            while chunk := f.read(CHUNK):
+                dst.write(chunk)
+
+
+def recompress_bgzf(files, dst, threads=1, level=6):
+    """Decompresses the files and writes their concatenated content to the
+    binary stream `dst` in BGZF format, compressing with `threads` threads."""
+    with BgzfWriter(dst, threads=threads, level=level) as writer:
+        for src in files:
+            with gzip.open(src, "rb") as f:
+                while chunk := f.read(CHUNK):
+                    writer.write(chunk)
+
+
+def concatenate(out_file, files, check=True, bgzf=False, threads=1, level=6):
+    """Concatenates the gzip files in `out_file`. The output is first written
+    to a temporary file, renamed once complete."""
+    out_file = pathlib.Path(out_file)
+    tmp = out_file.with_name(f".{out_file.name}.tmp")
+    try:
+        with open(tmp, "wb") as dst:
+            if bgzf:
+                recompress_bgzf(files, dst, threads=threads, level=level)
+            else:
+                for src in files:
+                    if check:
+                        copy_checked(src, dst)
+                    else:
+                        copy_raw(src, dst)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    os.replace(tmp, out_file)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="concatenate gzip files without recompressing them"
+    )
+    parser.add_argument("out_file", type=str, help="output gzip file")
+    parser.add_argument(
+        "files", type=str, nargs="+", help="gzip files to concatenate, in order"
+    )
+    parser.add_argument(
+        "--no_check",
+        help="do not verify the CRC and size of the gzip members before copying",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--bgzf",
+        help="recompress the data in BGZF blocks instead of copying it",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="number of compression threads, only used with --bgzf",
+        default=1,
+    )
+    parser.add_argument(
+        "--level",
+        type=int,
+        help="compression level, only used with --bgzf",
+        default=6,
+    )
+    args = parser.parse_args()
+
+    concatenate(
+        args.out_file,
+        args.files,
+        check=not args.no_check,
+        bgzf=args.bgzf,
+        threads=args.threads,
+        level=args.level,
+    )
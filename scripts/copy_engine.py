@@ -0,0 +1,254 @@
+# Parallel file copy with inline checksums. Files are copied by a bounded
+# pool of threads, and their checksum is computed on the same buffers that
+# are written to the destination, so that each file is read only once.
+# Checksums are saved in a manifest in the format of `sha256sum`/`xxhsum`,
+# which can be verified with `sha256sum -c` from the manifest folder.
+#
+# When no checksum is requested the copy is done in the kernel with
+# `os.copy_file_range` or `os.sendfile`, falling back to a buffered copy when
+# the filesystem does not support them.
+#
+# Copies can be resumed: files already present at the destination with the
+# expected size and checksum are skipped. Files identical to one already
+# archived elsewhere (listed in another checksum manifest) are hardlinked to
+# it instead of being copied again.
+
+import argparse
+import hashlib
+import os
+import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+CHUNK = 8 * 1024**2
+
+# supported checksums, also used as extension of the manifest file
+ALGORITHMS = ("sha256", "xxh64", "xxh128")
+
+
+def new_hasher(algorithm):
+    """Returns a new hash object for `algorithm`, or None if the algorithm is
+    `None`."""
+    if algorithm is None:
+        return None
+    if algorithm == "sha256":
+        return hashlib.sha256()
+    if algorithm in ("xxh64", "xxh128"):
+        if xxhash is None:
+            raise ValueError(f"the `xxhash` package is needed for {algorithm}")
+        return xxhash.xxh64() if algorithm == "xxh64" else xxhash.xxh3_128()
+    raise ValueError(f"unknown checksum algorithm {algorithm}")
+
+
+def _copy_kernel(fin, fout, size):
+    """Copies `size` bytes between file objects without going through user
+    space. Returns the number of bytes copied before the kernel calls failed,
+    so that the caller can complete the copy."""
+    offset = 0
+    for call in ("copy_file_range", "sendfile"):
+        if not hasattr(os, call):
+            continue
+        try:
+            # copy_file_range leaves the file positions untouched, while
+            # sendfile writes at the current position of the output
+            os.lseek(fout.fileno(), offset, os.SEEK_SET)
+            while offset < size:
+                if call == "copy_file_range":
+                    n = os.copy_file_range(
+                        fin.fileno(), fout.fileno(), size - offset, offset, offset
+                    )
+                else:
+                    n = os.sendfile(fout.fileno(), fin.fileno(), offset, size - offset)
+                if n == 0:
+                    break
+                offset += n
+            return offset
+        except OSError:
+            # not supported between these filesystems: try the next option
+            continue
+    return offset
+
+
+def copy_file(src, dst, algorithm="sha256", chunk=CHUNK):
+    """Copies `src` to `dst`, which must not exist, and returns the number of
+    copied bytes and the hex digest of the data (None if `algorithm` is
+    None). The destination is removed if the copy fails."""
+    hasher = new_hasher(algorithm)
+    with open(src, "rb") as fin, open(dst, "xb") as fout:
+        try:
+            size = os.fstat(fin.fileno()).st_size
+            copied = 0
+            if hasher is None:
+                copied = _copy_kernel(fin, fout, size)
+                fin.seek(copied)
+                fout.seek(copied)
+            buf = bytearray(chunk)
+            view = memoryview(buf)
+            while n := fin.readinto(buf):
+                if hasher is not None:
+                    hasher.update(view[:n])
+                fout.write(view[:n])
+                copied += n
+        except BaseException:
+            pathlib.Path(dst).unlink(missing_ok=True)
+            raise
+    return copied, None if hasher is None else hasher.hexdigest()
+
+
+def file_digest(path, algorithm="sha256", chunk=CHUNK):
+    """Returns the hex digest of a file."""
+    hasher = new_hasher(algorithm)
+    buf = bytearray(chunk)
+    with open(path, "rb") as f:
+        while n := f.readinto(buf):
+            hasher.update(memoryview(buf)[:n])
+    return hasher.hexdigest()
+
+
+def dedup_index(manifest_files):
+    """Indexes the files listed in checksum manifests by their size, for
+    deduplication. Returns a dictionary {size: [(path, digest), ...]}.
+    Files that no longer exist are skipped."""
+    index = {}
+    for mf in manifest_files:
+        mf = pathlib.Path(mf)
+        for rel, digest in read_manifest(mf).items():
+            path = mf.parent / rel
+            if path.is_file():
+                index.setdefault(path.stat().st_size, []).append((path, digest))
+    return index
+
+
+def sync_file(src, dst, algorithm="sha256", journal=None, dedup=None):
+    """Makes `dst` a copy of `src`, avoiding work when possible. Returns
+    the size, the digest and the action performed, one of `skipped` (`dst`
+    already matches, according to the checksum recorded in the `journal`
+    or recomputed), `linked` (hardlinked to an identical file from the
+    `dedup` index) or `copied`. Without checksum, files are compared by
+    size only and deduplication is disabled."""
+    src, dst = pathlib.Path(src), pathlib.Path(dst)
+    size = src.stat().st_size
+    if dst.is_file():
+        rec = None if journal is None else journal.file_record(dst)
+        if dst.stat().st_size == size:
+            if algorithm is None:
+                return size, None, "skipped"
+            expected = rec[1] if rec is not None else file_digest(src, algorithm)
+            if file_digest(dst, algorithm) == expected:
+                return size, expected, "skipped"
+        # leftover of an interrupted copy
+        dst.unlink()
+    action = "copied"
+    candidates = [] if dedup is None or algorithm is None else dedup.get(size, [])
+    digest = file_digest(src, algorithm) if candidates else None
+    for path, cand_digest in candidates:
+        if cand_digest != digest:
+            continue
+        try:
+            os.link(path, dst)
+            action = "linked"
+            break
+        except OSError:
+            # e.g. different filesystem: copy instead
+            continue
+    if action == "copied":
+        size, digest = copy_file(src, dst, algorithm)
+    if journal is not None:
+        journal.record_file(dst, size, digest)
+    return size, digest, action
+
+
+def copy_files(
+    pairs, algorithm="sha256", threads=4, verbose=True, journal=None, dedup=None
+):
+    """Copies the (src, dst) pairs with a pool of `threads` threads. Returns
+    the list of (dst, size, digest) of the copied files, in input order. If
+    `verbose` the aggregate throughput is printed at the end. Progress is
+    recorded in the `journal` if specified, and files are deduplicated
+    against the `dedup` index (see `sync_file`)."""
+    start = time.perf_counter()
+    srcs, dsts = zip(*pairs) if pairs else ((), ())
+
+    def sync(src, dst):
+        return sync_file(src, dst, algorithm, journal=journal, dedup=dedup)
+
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as pool:
+        results = list(pool.map(sync, srcs, dsts))
+    elapsed = time.perf_counter() - start
+    if verbose:
+        tot = sum(size for size, _, action in results if action == "copied")
+        n_copied = sum(action == "copied" for _, _, action in results)
+        print(throughput_report(n_copied, tot, elapsed))
+        for action in ("skipped", "linked"):
+            if n := sum(a == action for _, _, a in results):
+                print(f"{action} {n} files already archived")
+    return [(dst, size, digest) for dst, (size, digest, _) in zip(dsts, results)]
+
+
+def throughput_report(n_files, n_bytes, elapsed):
+    """Returns a one-line summary of the copy throughput."""
+    rate = n_bytes / 1e6 / elapsed if elapsed > 0 else float("inf")
+    mb = n_bytes / 1e6
+    return f"copied {n_files} files, {mb:.1f} MB in {elapsed:.1f} s ({rate:.1f} MB/s)"
+
+
+def manifest_name(algorithm):
+    """Name of the checksum manifest for the algorithm."""
+    return f"checksums.{algorithm}"
+
+
+def write_manifest(manifest_file, results):
+    """Writes the digests of the copied files in `manifest_file`, with paths
+    relative to the folder of the manifest. Files without a digest are
+    skipped."""
+    manifest_file = pathlib.Path(manifest_file)
+    with open(manifest_file, "w") as f:
+        for dst, _, digest in results:
+            if digest is None:
+                continue
+            rel = os.path.relpath(dst, manifest_file.parent)
+            f.write(f"{digest}  {rel}\n")
+
+
+def read_manifest(manifest_file):
+    """Reads a checksum manifest and returns a dictionary {path: digest},
+    with paths relative to the folder of the manifest."""
+    with open(manifest_file, "r") as f:
+        return dict(
+            reversed(line.rstrip("\n").split("  ", 1)) for line in f if line.strip()
+        )
+
+
+def verify_manifest(manifest_file, algorithm="sha256", threads=4):
+    """Recomputes the checksums of the files in the manifest. Returns the
+    list of files whose checksum does not match."""
+    manifest_file = pathlib.Path(manifest_file)
+    expected = read_manifest(manifest_file)
+    paths = [manifest_file.parent / rel for rel in expected]
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as pool:
+        digests = pool.map(file_digest, paths, [algorithm] * len(paths))
+        found = dict(zip(expected, digests))
+    return [rel for rel in expected if found[rel] != expected[rel]]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="verify the files listed in a checksum manifest"
+    )
+    parser.add_argument("manifest", type=str, help="checksum manifest file")
+    parser.add_argument("--threads", type=int, help="number of threads", default=4)
+    args = parser.parse_args()
+
+    algorithm = pathlib.Path(args.manifest).suffix[1:]
+    mismatched = verify_manifest(args.manifest, algorithm, threads=args.threads)
+    for rel in mismatched:
+        print(f"{rel}: FAILED")
+    if mismatched:
+        raise RuntimeError(f"{len(mismatched)} files do not match their checksum")
+    print("all checksums match")
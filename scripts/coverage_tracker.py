@@ -0,0 +1,218 @@
+# Tracks the sequencing depth of each barcode while basecalling is running,
+# so that the assembly of a barcode can start as soon as it has enough reads,
+# instead of waiting for the end of the whole run.
+#
+# Every basecalled batch is added with `update`, which counts the bases of the
+# reads at least `--min_length` bp long (the reads kept by the length filter
+# of `assemble.nf`) and adds them to the per-barcode state (`barcodeXX.json`
+# in the coverage folder). Batches are identified as in `barcode_merge.py`, so
+# that resuming the pipeline does not count them twice. When the estimated
+# depth (bases / genome size) of a barcode reaches `--target_depth`, the
+# marker file `barcodeXX.ready` is created, which is watched by `assemble.nf`
+# when run with `--early true`. `report` prints the depth of all barcodes,
+# showing the ones that are still below target.
+#
+# Usage:
+#   python3 coverage_tracker.py update coverage barcode01 batch_id reads.fastq.gz
+#   python3 coverage_tracker.py report coverage
+#   python3 coverage_tracker.py snapshot basecalled/barcode01.fastq.gz out.fastq.gz
+
+import argparse
+import datetime
+import fcntl
+import json
+import os
+import pathlib
+from barcode_merge import snapshot
+from basecall_stats import read_stats
+from stats_cache import open_cache
+
+# default expected genome size (bp), depth required to start the assembly
+# and minimum length of the reads that are counted (bp)
+GENOME_SIZE = 5e6
+TARGET_DEPTH = 100
+MIN_LENGTH = 1000
+
+# created in the coverage folder when basecalling is completed
+END_MARKER = "basecalling.done"
+
+
+def state_file(cov_dir, barcode):
+    return pathlib.Path(cov_dir) / f"{barcode}.json"
+
+
+def marker_file(cov_dir, barcode):
+    return pathlib.Path(cov_dir) / f"{barcode}.ready"
+
+
+def write_json(path, data):
+    """Atomically replaces a json file."""
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, path)
+
+
+def load_state(cov_dir, barcode):
+    """Returns the state of a barcode: the list of counted batches, the
+    number of reads and bases counted, the time of the last update and the
+    time at which the barcode became ready (None if not yet)."""
+    sf = state_file(cov_dir, barcode)
+    if not sf.is_file():
+        return {
+            "barcode": barcode,
+            "batches": [],
+            "n_reads": 0,
+            "bases": 0,
+            "last_update": None,
+            "ready": None,
+        }
+    with open(sf, "r") as f:
+        return json.load(f)
+
+
+def count_bases(fastq_file, min_length=MIN_LENGTH, cache=None):
+    """Returns the number of reads at least `min_length` bp long in a fastq
+    file, and their total length. Read lengths can be shared through the
+    statistics `cache` with the live statistics of `basecall_stats.py`."""
+    if cache is None:
+        stats = read_stats(fastq_file)
+    else:
+        stats = cache.cached("reads", fastq_file, read_stats)
+    lengths = stats["len"][stats["len"] >= min_length]
+    return len(lengths), int(lengths.sum())
+
+
+def update(
+    cov_dir,
+    barcode,
+    batch_id,
+    files,
+    genome_size=GENOME_SIZE,
+    target_depth=TARGET_DEPTH,
+    min_length=MIN_LENGTH,
+    cache=None,
+):
+    """Adds the reads of the batch `files` to the state of the barcode, and
+    creates its marker if the target depth is reached. Batches already
+    counted are skipped. Returns the updated state. The state is locked
+    during the update, so that concurrent updates of the same barcode are
+    serialized."""
+    cov_dir = pathlib.Path(cov_dir)
+    cov_dir.mkdir(parents=True, exist_ok=True)
+    counts = [count_bases(f, min_length, cache) for f in files]
+    with open(cov_dir / f".{barcode}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = load_state(cov_dir, barcode)
+        if batch_id in state["batches"]:
+            return state
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        state["batches"].append(batch_id)
+        state["n_reads"] += sum(n for n, _ in counts)
+        state["bases"] += sum(b for _, b in counts)
+        state["last_update"] = now
+        depth = state["bases"] / genome_size
+        if state["ready"] is None and depth >= target_depth:
+            state["ready"] = now
+            marker = marker_file(cov_dir, barcode)
+            # created once, also if an update was interrupted after it
+            if not marker.exists():
+                write_json(
+                    marker,
+                    {"barcode": barcode, "depth": depth, "bases": state["bases"]},
+                )
+            print(f"{barcode} ready: depth {depth:.1f}x")
+        write_json(state_file(cov_dir, barcode), state)
+    return state
+
+
+def report(cov_dir, genome_size=GENOME_SIZE, target_depth=TARGET_DEPTH):
+    """Prints the depth of each barcode, and whether it is ready."""
+    states = []
+    for sf in sorted(pathlib.Path(cov_dir).glob("*.json")):
+        with open(sf, "r") as f:
+            states.append(json.load(f))
+    print(
+        f"{'barcode':<14} {'batches':>7} {'reads':>9} {'bases':>13} "
+        + f"{'depth':>7} {'target':>6}  {'last update':<19}  status"
+    )
+    for s in states:
+        depth = s["bases"] / genome_size
+        status = f"ready since {s['ready']}" if s["ready"] else "starving"
+        print(
+            f"{s['barcode']:<14} {len(s['batches']):>7} {s['n_reads']:>9} "
+            + f"{s['bases']:>13} {depth:>6.1f}x {depth / target_depth:>6.0%}  "
+            + f"{s['last_update'] or '-':<19}  {status}"
+        )
+    if (pathlib.Path(cov_dir) / END_MARKER).exists():
+        print("basecalling is completed")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="track the sequencing depth of each barcode during basecalling"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_update = subparsers.add_parser(
+        "update", help="add a basecalled batch to the depth of a barcode"
+    )
+    p_update.add_argument("cov_dir", type=str, help="coverage folder")
+    p_update.add_argument("barcode", type=str, help="barcode of the batch")
+    p_update.add_argument(
+        "batch_id",
+        type=str,
+        help="unique identifier of the batch, used to avoid counting it twice",
+    )
+    p_update.add_argument("files", type=str, nargs="+", help="fastq files")
+    p_update.add_argument(
+        "--min_length",
+        type=int,
+        default=MIN_LENGTH,
+        help="only count reads at least this long (bp)",
+    )
+    p_update.add_argument(
+        "--cache",
+        help="use the statistics cache (see `stats_cache.py`), e.g. shared with "
+        + "`basecall_stats.py --cache`",
+        action="store_true",
+    )
+    p_report = subparsers.add_parser("report", help="print the depth of each barcode")
+    p_report.add_argument("cov_dir", type=str, help="coverage folder")
+    for p in (p_update, p_report):
+        p.add_argument(
+            "--genome_size",
+            type=float,
+            default=GENOME_SIZE,
+            help="expected genome size (bp), to estimate the depth",
+        )
+        p.add_argument(
+            "--target_depth",
+            type=float,
+            default=TARGET_DEPTH,
+            help="depth at which a barcode is ready to be assembled",
+        )
+    p_snapshot = subparsers.add_parser(
+        "snapshot",
+        help="copy the reads appended so far to a barcode file (see "
+        + "`barcode_merge.py`), while basecalling is running",
+    )
+    p_snapshot.add_argument("fastq_file", type=str, help="barcode file")
+    p_snapshot.add_argument("out_file", type=str, help="destination file")
+    args = parser.parse_args()
+
+    if args.command == "update":
+        update(
+            args.cov_dir,
+            args.barcode,
+            args.batch_id,
+            args.files,
+            genome_size=args.genome_size,
+            target_depth=args.target_depth,
+            min_length=args.min_length,
+            cache=open_cache(args.cache),
+        )
+    elif args.command == "report":
+        report(args.cov_dir, args.genome_size, args.target_depth)
+    elif args.command == "snapshot":
+        snapshot(args.fastq_file, args.out_file)
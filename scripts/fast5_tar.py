@@ -0,0 +1,230 @@
+# Streaming tar archives of fast5 files, with an index of the members. Files
+# are written in standard (PAX) tar format, optionally split in shards of
+# bounded size, each of which is a valid tar file that can be read with `tar`.
+# For every member the index records the shard, the offset of its data in the
+# shard, its size and its checksum, so that single files can be extracted by
+# seeking directly to them without scanning the archive.
+
+import argparse
+import csv
+import pathlib
+import tarfile
+from copy_engine import CHUNK, new_hasher
+
+BLOCK = tarfile.BLOCKSIZE
+RECORD = tarfile.RECORDSIZE
+INDEX_NAME = "fast5_reads.index.csv"
+INDEX_COLUMNS = ["name", "shard", "offset", "size", "sha256"]
+
+
+def shard_names(n_shards, prefix="fast5_reads"):
+    """Names of the tar shards. A single shard is simply `<prefix>.tar`."""
+    if n_shards == 1:
+        return [f"{prefix}.tar"]
+    return [f"{prefix}_{i:03d}.tar" for i in range(n_shards)]
+
+
+def plan_shards(files, max_shard_size=None):
+    """Splits the files in consecutive groups whose total size is at most
+    `max_shard_size` bytes (a single file larger than this gets its own
+    shard). If `max_shard_size` is None all files go in one shard."""
+    shards, current, size = [], [], 0
+    for f in files:
+        fsize = pathlib.Path(f).stat().st_size
+        if max_shard_size is not None and current and size + fsize > max_shard_size:
+            shards.append(current)
+            current, size = [], 0
+        current.append(f)
+        size += fsize
+    if current or not shards:
+        shards.append(current)
+    return shards
+
+
+def write_member(tar, path, arcname, offset):
+    """Writes the file `path` as member `arcname` of the binary stream `tar`,
+    positioned at `offset`. Returns the offset of the data, its size, its
+    checksum and the offset after the member."""
+    path = pathlib.Path(path)
+    stat = path.stat()
+    info = tarfile.TarInfo(arcname)
+    info.size, info.mtime, info.mode = stat.st_size, int(stat.st_mtime), 0o644
+    header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+    tar.write(header)
+    data_offset = offset + len(header)
+    hasher = new_hasher("sha256")
+    size = 0
+    buf = bytearray(CHUNK)
+    view = memoryview(buf)
+    with open(path, "rb") as f:
+        while n := f.readinto(buf):
+            hasher.update(view[:n])
+            tar.write(view[:n])
+            size += n
+    assert size == info.size, f"{path} changed while being archived"
+    padding = -size % BLOCK
+    tar.write(b"\0" * padding)
+    return data_offset, size, hasher.hexdigest(), data_offset + size + padding
+
+
+def write_tar(tar_file, files, buffering=CHUNK):
+    """Writes the files in the tar archive `tar_file`, using their names as
+    member names. Returns the index entries of the members."""
+    tar_file = pathlib.Path(tar_file)
+    entries = []
+    offset = 0
+    with open(tar_file, "wb", buffering=buffering) as tar:
+        for f in files:
+            name = pathlib.Path(f).name
+            data_offset, size, checksum, offset = write_member(tar, f, name, offset)
+            entries.append([name, tar_file.name, data_offset, size, checksum])
+        # end of archive: two empty blocks, padded to a full record
+        end = offset + 2 * BLOCK
+        tar.write(b"\0" * (2 * BLOCK + (-end % RECORD)))
+    return entries
+
+
+def write_index(index_file, entries):
+    """Writes the index entries of the members in csv format."""
+    with open(index_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(INDEX_COLUMNS)
+        writer.writerows(entries)
+
+
+def read_index(index_file):
+    """Reads the index of an archive. Returns a dictionary {member name:
+    (shard, offset, size, checksum)}."""
+    with open(index_file, "r", newline="") as f:
+        return {
+            row["name"]: (
+                row["shard"],
+                int(row["offset"]),
+                int(row["size"]),
+                row["sha256"],
+            )
+            for row in csv.DictReader(f)
+        }
+
+
+def shard_size(entries):
+    """Expected size of a tar shard with the given index entries."""
+    end = 0
+    if entries:
+        _, _, offset, size, _ = entries[-1]
+        end = offset + size + (-size % BLOCK)
+    end += 2 * BLOCK
+    return end + (-end % RECORD)
+
+
+def create_archive(archive_fld, files, max_shard_size=None, journal=None):
+    """Archives the files in `archive_fld`, in one or more tar shards of at
+    most `max_shard_size` bytes each, and writes the index of the members.
+    Returns the list of created shards and the index file. If a `journal`
+    (see `archive_journal.py`) is specified, shards completed in a previous
+    attempt are not written again."""
+    archive_fld = pathlib.Path(archive_fld)
+    names = [pathlib.Path(f).name for f in files]
+    assert len(set(names)) == len(names), "duplicated file names in archive"
+    groups = plan_shards(files, max_shard_size)
+    shards = [archive_fld / name for name in shard_names(len(groups))]
+    entries = []
+    for shard, group in zip(shards, groups):
+        done = None if journal is None else journal.shard_entries(shard)
+        if done is not None and [e[0] for e in done] == [
+            pathlib.Path(f).name for f in group
+        ]:
+            if shard.is_file() and shard.stat().st_size == shard_size(done):
+                print(f"skipping {shard.name}, already archived")
+                entries += done
+                continue
+        shard.unlink(missing_ok=True)
+        shard_entries = write_tar(shard, group)
+        if journal is not None:
+            journal.record_shard(shard, shard_entries)
+        entries += shard_entries
+    index_file = archive_fld / INDEX_NAME
+    index_file.unlink(missing_ok=True)
+    write_index(index_file, entries)
+    return shards, index_file
+
+
+class Fast5Archive:
+    """Access to the members of an indexed (and possibly sharded) archive."""
+
+    def __init__(self, archive_fld):
+        self.archive_fld = pathlib.Path(archive_fld)
+        self.index = read_index(self.archive_fld / INDEX_NAME)
+
+    def names(self):
+        return list(self.index)
+
+    def iter_chunks(self, name):
+        """Iterates over the data of a member, checking its checksum."""
+        shard, offset, size, checksum = self.index[name]
+        hasher = new_hasher("sha256")
+        with open(self.archive_fld / shard, "rb") as f:
+            f.seek(offset)
+            while size > 0:
+                chunk = f.read(min(CHUNK, size))
+                if not chunk:
+                    raise ValueError(f"archive shard {shard} is truncated")
+                hasher.update(chunk)
+                size -= len(chunk)
+                yield chunk
+        if hasher.hexdigest() != checksum:
+            raise ValueError(f"checksum mismatch for {name} in {shard}")
+
+    def read(self, name):
+        """Returns the content of a member."""
+        return b"".join(self.iter_chunks(name))
+
+    def extract(self, name, out_fld):
+        """Extracts a member in `out_fld`, and returns the path of the file."""
+        out_file = pathlib.Path(out_fld) / name
+        try:
+            with open(out_file, "wb") as f:
+                for chunk in self.iter_chunks(name):
+                    f.write(chunk)
+        except BaseException:
+            out_file.unlink(missing_ok=True)
+            raise
+        return out_file
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="indexed tar archives of fast5 files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_create = subparsers.add_parser("create", help="archive fast5 files")
+    p_create.add_argument("archive_fld", type=str, help="destination folder")
+    p_create.add_argument("fast5_fld", type=str, help="folder with fast5 files")
+    p_create.add_argument(
+        "--max_shard_size",
+        type=float,
+        help="maximum size of each tar shard, in GB",
+    )
+    p_list = subparsers.add_parser("list", help="list archived files")
+    p_list.add_argument("archive_fld", type=str, help="archive folder")
+    p_extract = subparsers.add_parser("extract", help="extract single files")
+    p_extract.add_argument("archive_fld", type=str, help="archive folder")
+    p_extract.add_argument("names", type=str, nargs="+", help="files to extract")
+    p_extract.add_argument("--out", type=str, help="output folder", default=".")
+    args = parser.parse_args()
+
+    if args.command == "create":
+        files = sorted(pathlib.Path(args.fast5_fld).glob("*.fast5"))
+        max_size = None if args.max_shard_size is None else args.max_shard_size * 1e9
+        shards, index_file = create_archive(args.archive_fld, files, max_size)
+        print(
+            f"archived {len(files)} files in {len(shards)} shards, index {index_file}"
+        )
+    elif args.command == "list":
+        for name, (shard, offset, size, _) in Fast5Archive(
+            args.archive_fld
+        ).index.items():
+            print(f"{name}\t{shard}\t{offset}\t{size}")
+    elif args.command == "extract":
+        archive = Fast5Archive(args.archive_fld)
+        for name in args.names:
+            print(f"extracted {archive.extract(name, args.out)}")
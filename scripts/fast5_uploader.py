@@ -0,0 +1,293 @@
+# Uploads the fast5 files produced by MinKNOW to the cluster while the run is
+# in progress. Replaces the `rsync` loop of `server_sync.sh`, which listed the
+# whole (growing) reads folder every 5 minutes and could ship files that were
+# still being written.
+#
+# The reads folder is watched for new files (see `fs_watch.py`), and a file
+# is shipped once its size is stable over two checks. Files are transferred
+# concurrently by a bounded pool of threads, to a destination that is either
+# a local folder or a remote `user@host:folder` reached with rsync over ssh
+# (sharing a single ssh connection). Files are renamed into place once
+# complete, so that the Nextflow watcher on the cluster never sees partial
+# files.
+#
+# Shipped files are recorded in a local manifest (json lines), so that the
+# uploader can be restarted without sending files again. Each record also
+# contains timings of the file: when it was last modified by the sequencer,
+# found stable, and shipped, from which the upload latency is reported
+# (`fast5_uploader.py report manifest`).
+#
+# The run is finished when MinKNOW writes its `final_summary_*.txt` in the run
+# folder, or when a file `end-signal.fast5` is created in the reads folder.
+# Once all remaining files are shipped, `end-signal.fast5` is sent to the
+# destination, which stops the basecalling watcher.
+
+import argparse
+import json
+import os
+import pathlib
+import shlex
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from copy_engine import copy_file
+from fs_watch import StableFileWatcher
+
+END_SIGNAL = "end-signal.fast5"
+MANIFEST_NAME = "upload_manifest.jsonl"
+
+
+class LocalDestination:
+    """Copies the files to a local folder."""
+
+    def __init__(self, folder):
+        self.folder = pathlib.Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def put(self, path):
+        tmp = self.folder / f".{path.name}.part"
+        tmp.unlink(missing_ok=True)
+        copy_file(path, tmp, algorithm=None)
+        os.replace(tmp, self.folder / path.name)
+
+    def close(self):
+        pass
+
+
+class RsyncDestination:
+    """Sends the files to `user@host:folder` with rsync. All transfers share
+    a single ssh connection, kept open by an ssh control master."""
+
+    def __init__(self, target, control_dir):
+        self.target = target.rstrip("/") + "/"
+        self.control_path = pathlib.Path(control_dir) / ".upload-ssh-%C"
+        self.ssh = [
+            "ssh",
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={self.control_path}",
+            "-o",
+            "ControlPersist=300",
+        ]
+
+    def put(self, path):
+        # rsync writes to a hidden temporary file, renamed when complete
+        cmd = ["rsync", "--times", "-e", shlex.join(self.ssh), str(path), self.target]
+        subprocess.run(cmd, check=True, capture_output=True, text=True)
+
+    def close(self):
+        host = self.target.split(":")[0]
+        subprocess.run(self.ssh + ["-O", "exit", host], capture_output=True)
+
+
+def make_destination(dest, state_dir):
+    """Remote destination if `dest` has the form `[user@]host:folder`,
+    local folder otherwise."""
+    host, sep, _ = dest.partition(":")
+    if sep and "/" not in host:
+        return RsyncDestination(dest, state_dir)
+    return LocalDestination(dest)
+
+
+class UploadManifest:
+    """Append-only record of the shipped files, one json object per line.
+    Updates are thread-safe."""
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.lock = threading.Lock()
+
+    def records(self):
+        if not self.path.is_file():
+            return []
+        with open(self.path, "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def shipped(self):
+        return {rec["name"] for rec in self.records()}
+
+    def add(self, record):
+        with self.lock, open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class Uploader:
+    """Ships files to a destination with a pool of `workers` threads, retrying
+    failed transfers up to `retries` times."""
+
+    def __init__(self, dest, manifest, workers=4, retries=3):
+        self.dest = dest
+        self.manifest = manifest
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.retries = retries
+        self.running = set()
+        self.failed = []
+
+    def submit(self, path):
+        stable = time.time()
+        self.running.add(self.pool.submit(self.ship, path, stable))
+
+    def ship(self, path, stable):
+        st = path.stat()
+        for attempt in range(self.retries + 1):
+            start = time.time()
+            try:
+                self.dest.put(path)
+                break
+            except (OSError, subprocess.CalledProcessError) as e:
+                err = getattr(e, "stderr", None) or e
+                print(f"transfer of {path.name} failed: {err}")
+                if attempt == self.retries:
+                    self.failed.append(path)
+                    return
+                time.sleep(2**attempt)
+        end = time.time()
+        record = {
+            "name": path.name,
+            "size": st.st_size,
+            "modified": st.st_mtime,
+            "stable": stable,
+            "start": start,
+            "shipped": end,
+        }
+        self.manifest.add(record)
+        print(
+            f"shipped {path.name} ({st.st_size / 1e6:.1f} MB) in {end - start:.1f} s, "
+            + f"{end - st.st_mtime:.1f} s after it was written"
+        )
+
+    def busy(self):
+        self.running = {f for f in self.running if not f.done()}
+        return bool(self.running)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.dest.close()
+
+
+def run_finished(reads_dir, run_dir):
+    """Whether the sequencing run is finished."""
+    if (reads_dir / END_SIGNAL).exists():
+        return True
+    return any(run_dir.glob("final_summary_*.txt"))
+
+
+def upload(reads_dir, dest, state_dir, run_dir=None, workers=4, interval=10.0):
+    """Ships the fast5 files of `reads_dir` until the run is finished, then
+    sends the end signal. Returns the number of files that could not be sent."""
+    reads_dir = pathlib.Path(reads_dir)
+    run_dir = reads_dir.parent if run_dir is None else pathlib.Path(run_dir)
+    state_dir = pathlib.Path(state_dir)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    manifest = UploadManifest(state_dir / MANIFEST_NAME)
+    shipped = manifest.shipped()
+    print(f"{len(shipped)} files already shipped")
+    watcher = StableFileWatcher(
+        reads_dir,
+        pattern="*.fast5",
+        interval=interval,
+        checks=2,
+        ignore=shipped | {END_SIGNAL},
+    )
+    uploader = Uploader(make_destination(dest, state_dir), manifest, workers)
+    print(f"watching {reads_dir} ({watcher.mode}), shipping to {dest}")
+    try:
+        finished = False
+        while not finished or watcher.pending or uploader.busy():
+            for path in watcher.wait(timeout=interval):
+                uploader.submit(path)
+            finished = finished or run_finished(reads_dir, run_dir)
+        uploader.pool.shutdown(wait=True)
+        if uploader.failed:
+            print(f"{len(uploader.failed)} files could not be shipped")
+        else:
+            signal_file = state_dir / END_SIGNAL
+            signal_file.touch()
+            uploader.dest.put(signal_file)
+            print("run finished, end signal sent")
+    finally:
+        watcher.close()
+        uploader.close()
+    return len(uploader.failed)
+
+
+def latency_report(records):
+    """Summary of the upload latency (time between the last write of a file by
+    the sequencer and the end of its transfer)."""
+    if not records:
+        return "no files shipped"
+    latency = np.array([r["shipped"] - r["modified"] for r in records])
+    wait = np.array([r["start"] - r["modified"] for r in records])
+    transfer = np.array([r["shipped"] - r["start"] for r in records])
+    size = sum(r["size"] for r in records)
+    lines = [
+        f"{len(records)} files, {size / 1e9:.2f} GB, "
+        + f"{size / 1e6 / max(transfer.sum(), 1e-9):.1f} MB/s per transfer"
+    ]
+    for label, values in [
+        ("latency", latency),
+        ("  waiting", wait),
+        ("  transfer", transfer),
+    ]:
+        p50, p90 = np.percentile(values, [50, 90])
+        lines.append(
+            f"{label:<10}: median {p50:.1f} s, 90% {p90:.1f} s, max {values.max():.1f} s"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="upload fast5 files to the cluster during a sequencing run"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_upload = subparsers.add_parser("upload", help="ship fast5 files as produced")
+    p_upload.add_argument("reads_dir", type=str, help="MinKNOW fast5 folder")
+    p_upload.add_argument(
+        "dest", type=str, help="destination folder, local or [user@]host:folder"
+    )
+    p_upload.add_argument(
+        "--state_dir",
+        type=str,
+        default=".",
+        help="folder of the manifest of shipped files",
+    )
+    p_upload.add_argument(
+        "--run_dir",
+        type=str,
+        help="MinKNOW run folder, containing the final summary at the end of "
+        + "the run. Defaults to the parent of the reads folder.",
+    )
+    p_upload.add_argument(
+        "--workers", type=int, default=4, help="number of concurrent transfers"
+    )
+    p_upload.add_argument(
+        "--interval",
+        type=float,
+        default=10,
+        help="seconds between checks of the size of the files being written",
+    )
+    p_report = subparsers.add_parser("report", help="upload latency summary")
+    p_report.add_argument("manifest", type=str, help="manifest of shipped files")
+    args = parser.parse_args()
+
+    if args.command == "upload":
+        n_failed = upload(
+            args.reads_dir,
+            args.dest,
+            args.state_dir,
+            run_dir=args.run_dir,
+            workers=args.workers,
+            interval=args.interval,
+        )
+        manifest = UploadManifest(pathlib.Path(args.state_dir) / MANIFEST_NAME)
+        print(latency_report(manifest.records()))
+        raise SystemExit(1 if n_failed else 0)
+    elif args.command == "report":
+        print(latency_report(UploadManifest(args.manifest).records()))
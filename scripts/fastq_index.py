@@ -0,0 +1,191 @@
+# Read-offset index for BGZF-compressed fastq files. The index is stored in a
+# companion `.fqi` file next to the fastq file, and contains for every read,
+# in file order, the virtual offset of the beginning of the record and a
+# 64-bit hash of the read id. It allows to seek directly to the n-th read,
+# to look up reads by id, and to split the file into chunks that can be
+# decompressed independently by parallel workers.
+
+import argparse
+import hashlib
+import pathlib
+import numpy as np
+from bgzf import BgzfWriter, BgzfReader
+from fastq_scan import open_fastq, iter_records_blocks
+
+INDEX_SUFFIX = ".fqi"
+INDEX_MAGIC = b"FQIDX\x01\x00\x00"
+RECORD = np.dtype([("voffset", "<u8"), ("id_hash", "<u8")])
+
+
+def index_file(fastq_file):
+    """Returns the path of the index of a fastq file."""
+    fastq_file = pathlib.Path(fastq_file)
+    return fastq_file.with_name(fastq_file.name + INDEX_SUFFIX)
+
+
+def read_id(header):
+    """Extracts the read id (bytes) from a fastq header line."""
+    return header[1:].split(maxsplit=1)[0]
+
+
+def id_hash(rid):
+    """64-bit hash of a read id (bytes)."""
+    return int.from_bytes(hashlib.blake2b(rid, digest_size=8).digest(), "little")
+
+
+def write_index_records(index_stream, voffsets, hashes):
+    """Appends records to an index stream, writing the header if the stream
+    is empty."""
+    if index_stream.tell() == 0:
+        index_stream.write(INDEX_MAGIC)
+    records = np.empty(len(voffsets), dtype=RECORD)
+    records["voffset"] = voffsets
+    records["id_hash"] = hashes
+    index_stream.write(records.tobytes())
+
+
+def write_bgzf_fastq(files, stream, index_stream, threads=1, start_offset=0):
+    """Writes the reads of the (optionally gzipped) fastq `files` to the binary
+    `stream` in BGZF format, and appends the corresponding records to
+    `index_stream`. `start_offset` is the current position of `stream`, when
+    appending to an existing file. Returns the number of reads written."""
+    writer = BgzfWriter(stream, threads=threads, start_offset=start_offset)
+    pos, starts, hashes = 0, [], []
+    for src in files:
+        with open_fastq(src) as f:
+            for lines in iter_records_blocks(f):
+                ends = pos + np.cumsum(np.fromiter(map(len, lines), np.int64) + 1)
+                starts += [pos] + ends[3:-1:4].tolist()
+                hashes += [id_hash(read_id(h)) for h in lines[0::4]]
+                writer.write(b"\n".join(lines) + b"\n")
+                pos = int(ends[-1])
+    writer.close()
+    voffsets = writer.virtual_offsets(np.array(starts, dtype=np.uint64))
+    write_index_records(index_stream, voffsets, np.array(hashes, dtype=np.uint64))
+    return len(starts)
+
+
+def build_index(fastq_file):
+    """Builds the index of an existing BGZF fastq file."""
+    voffsets, hashes = [], []
+    with BgzfReader(fastq_file) as reader:
+        while True:
+            voffset = reader.tell()
+            header = reader.readline()
+            if not header:
+                break
+            for _ in range(3):
+                reader.readline()
+            voffsets.append(voffset)
+            hashes.append(id_hash(read_id(header)))
+    with open(index_file(fastq_file), "wb") as f:
+        write_index_records(f, voffsets, np.array(hashes, dtype=np.uint64))
+    return len(voffsets)
+
+
+def load_index(fastq_file):
+    """Loads the index of a fastq file, as a structured array with fields
+    `voffset` and `id_hash`."""
+    with open(index_file(fastq_file), "rb") as f:
+        if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError(f"invalid index file for {fastq_file}")
+        return np.frombuffer(f.read(), dtype=RECORD)
+
+
+class IndexedFastq:
+    """Random access to the reads of an indexed BGZF fastq file. Reads are
+    returned as raw bytes of the four-line record."""
+
+    def __init__(self, fastq_file):
+        self.index = load_index(fastq_file)
+        self.reader = BgzfReader(fastq_file)
+
+    def __len__(self):
+        return len(self.index)
+
+    def _read_record(self):
+        return b"".join(self.reader.readline() for _ in range(4))
+
+    def get(self, n):
+        """Returns the n-th read of the file."""
+        self.reader.seek(self.index["voffset"][n])
+        return self._read_record()
+
+    def find(self, rid):
+        """Returns the read with the given id, or None if absent."""
+        rid = rid.encode() if isinstance(rid, str) else rid
+        for n in np.flatnonzero(self.index["id_hash"] == id_hash(rid)):
+            record = self.get(n)
+            if read_id(record) == rid:
+                return record
+        return None
+
+    def iter_range(self, start=0, end=None):
+        """Iterates over the reads with ordinal in [start, end). Only the
+        blocks containing these reads are decompressed."""
+        end = len(self) if end is None else min(end, len(self))
+        if start >= end:
+            return
+        self.reader.seek(self.index["voffset"][start])
+        for _ in range(start, end):
+            yield self._read_record()
+
+    def chunks(self, k):
+        """Splits the reads in (at most) `k` ordinal ranges [start, end)
+        covering approximately the same amount of compressed data. Each
+        range can be processed independently with `iter_range`."""
+        coffsets = (self.index["voffset"] >> np.uint64(16)).astype(np.float64)
+        if len(coffsets) == 0:
+            return []
+        targets = np.linspace(coffsets[0], coffsets[-1], k + 1)[1:-1]
+        bounds = np.searchsorted(coffsets, targets)
+        bounds = np.unique(np.concatenate([[0], bounds, [len(coffsets)]]))
+        return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+    def close(self):
+        self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="index BGZF fastq files and access reads by position or id"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_build = subparsers.add_parser("build", help="build the index of a file")
+    p_build.add_argument("fastq_file", type=str, help="BGZF fastq file")
+    p_get = subparsers.add_parser("get", help="print the n-th read")
+    p_get.add_argument("fastq_file", type=str, help="indexed BGZF fastq file")
+    p_get.add_argument("n", type=int, help="ordinal of the read (from 0)")
+    p_find = subparsers.add_parser("find", help="print the read with given id")
+    p_find.add_argument("fastq_file", type=str, help="indexed BGZF fastq file")
+    p_find.add_argument("read_id", type=str, help="read id")
+    p_chunks = subparsers.add_parser(
+        "chunks", help="print read ranges for parallel processing"
+    )
+    p_chunks.add_argument("fastq_file", type=str, help="indexed BGZF fastq file")
+    p_chunks.add_argument("k", type=int, help="number of chunks")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        n = build_index(args.fastq_file)
+        print(f"indexed {n} reads in {index_file(args.fastq_file)}")
+    else:
+        with IndexedFastq(args.fastq_file) as fq:
+            if args.command == "get":
+                print(fq.get(args.n).decode(), end="")
+            elif args.command == "find":
+                record = fq.find(args.read_id)
+                if record is None:
+                    raise KeyError(f"read {args.read_id} not found")
+                print(record.decode(), end="")
+            elif args.command == "chunks":
+                for start, end in fq.chunks(args.k):
+                    print(start, end)
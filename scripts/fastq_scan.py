@@ -0,0 +1,156 @@
+# Streaming scanner for (optionally gzipped) fastq files. Reads are parsed
+# directly on raw bytes in large blocks, without creating a Biopython record
+# per read, and their properties are stored in preallocated numpy buffers.
+
+import contextlib
+import gzip
+import sys
+import numpy as np
+
+# size of the blocks of (decompressed) data read at once
+BLOCK_SIZE = 4 * 1024**2
+
+# code assigned to reads without a `barcode=` field in the header
+NO_BARCODE = -1
+
+BARCODE_TAG = b"barcode="
+
+
+@contextlib.contextmanager
+def open_fastq(path):
+    """Context manager that opens a fastq file in binary mode, transparently
+    decompressing it if it is gzipped. If `path` is `-` then the standard
+    input is used."""
+    if path == "-":
+        stream = sys.stdin.buffer
+    else:
+        stream = open(path, "rb", buffering=BLOCK_SIZE)
+    try:
+        if stream.peek(2)[:2] == b"\x1f\x8b":
+            with gzip.GzipFile(fileobj=stream, mode="rb") as gz:
+                yield gz
+        else:
+            yield stream
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+
+
+def iter_records_blocks(stream, block_size=BLOCK_SIZE):
+    """Reads the stream in blocks and yields, for each block, the list of
+    lines belonging to complete 4-line fastq records. Lines of incomplete
+    records are carried over to the next block."""
+    rest = b""
+    while True:
+        data = stream.read(block_size)
+        if not data:
+            break
+        lines = (rest + data).split(b"\n")
+        # the last line is incomplete (or empty), and so are the records
+        # that do not fill a group of four lines
+        n_complete = (len(lines) - 1) // 4 * 4
+        rest = b"\n".join(lines[n_complete:])
+        if n_complete:
+            yield lines[:n_complete]
+    lines = rest.split(b"\n")
+    # tolerate a missing trailing newline, but not truncated records
+    if lines and lines[-1] == b"":
+        lines.pop()
+    if len(lines) % 4:
+        raise ValueError("truncated fastq record at the end of the file")
+    if lines:
+        yield lines
+
+
+# error probability of each phred+33 quality character
+ERROR_PROB = 10.0 ** (-(np.arange(256) - 33).clip(0) / 10.0)
+
+
+def read_mean_q(qual_lines, lengths):
+    """Returns the mean quality of each read (in phred scale, computed from
+    the average error probability), given the quality lines of a block of
+    reads and their lengths. Qualities of all reads are decoded at once."""
+    mean_q = np.full(len(lengths), np.nan)
+    nonempty = lengths > 0
+    if not nonempty.any():
+        return mean_q
+    quals = np.frombuffer(b"".join(qual_lines), dtype=np.uint8)
+    # windows line terminators
+    if quals.size > lengths.sum():
+        quals = quals[quals != 13]
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])[nonempty]
+    err = np.add.reduceat(ERROR_PROB[quals], starts)
+    mean_q[nonempty] = -10 * np.log10(err / lengths[nonempty])
+    return mean_q
+
+
+def header_barcode(header):
+    """Returns the value of the `barcode=` field of a read header (as bytes),
+    or None if the field is absent."""
+    idx = header.find(b" " + BARCODE_TAG)
+    if idx < 0:
+        return None
+    start = idx + 1 + len(BARCODE_TAG)
+    end = header.find(b" ", start)
+    if end < 0:
+        end = len(header)
+    return header[start:end].rstrip(b"\r")
+
+
+class FastqScanner:
+    """Scans fastq files and fills the `lengths`, `barcodes` and `mean_q`
+    buffers with read lengths, barcode codes and mean read qualities (see
+    `read_mean_q`, NaN for empty reads). Barcode names are collected in
+    `barcode_names`, and the code of a barcode is its index in this list
+    (`NO_BARCODE` for reads without barcode).
+
+    Buffers are allocated once with `capacity` entries, so memory use does not
+    depend on the size of the file. The arrays yielded by `scan` are views of
+    these buffers and are overwritten by the next iteration."""
+
+    def __init__(self, capacity=2**16, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.lengths = np.empty(capacity, dtype=np.int64)
+        self.barcodes = np.empty(capacity, dtype=np.int32)
+        self.mean_q = np.empty(capacity, dtype=np.float32)
+        self.barcode_names = []
+        self._codes = {None: NO_BARCODE}
+
+    def barcode_code(self, name):
+        """Returns the code for the barcode name (bytes), adding it if new."""
+        code = self._codes.get(name)
+        if code is None:
+            code = len(self.barcode_names)
+            self._codes[name] = code
+            self.barcode_names.append(name.decode())
+        return code
+
+    def _reserve(self, n):
+        """Grows the buffers if a block contains more reads than capacity."""
+        if n > len(self.lengths):
+            self.lengths = np.empty(n, dtype=np.int64)
+            self.barcodes = np.empty(n, dtype=np.int32)
+            self.mean_q = np.empty(n, dtype=np.float32)
+
+    def scan(self, path):
+        """Generator yielding `(lengths, barcodes, mean_q)` arrays for
+        consecutive blocks of reads in the file."""
+        with open_fastq(path) as stream:
+            for lines in iter_records_blocks(stream, self.block_size):
+                if not lines[0].startswith(b"@"):
+                    raise ValueError(f"{path} is not a valid fastq file")
+                n = len(lines) // 4
+                self._reserve(n)
+                lengths, barcodes = self.lengths[:n], self.barcodes[:n]
+                mean_q = self.mean_q[:n]
+                lengths[:] = np.fromiter(map(len, lines[1::4]), dtype=np.int64, count=n)
+                # windows line terminators
+                if lines[1].endswith(b"\r"):
+                    lengths -= 1
+                barcodes[:] = np.fromiter(
+                    (self.barcode_code(header_barcode(h)) for h in lines[0::4]),
+                    dtype=np.int32,
+                    count=n,
+                )
+                mean_q[:] = read_mean_q(lines[3::4], lengths)
+                yield lengths, barcodes, mean_q
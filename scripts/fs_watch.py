@@ -0,0 +1,187 @@
+# Event-driven detection of completed files in a folder being written by the
+# sequencer. The folder is watched with inotify (through ctypes, Linux only),
+# so that new files are noticed as soon as they are created, without listing
+# the whole folder again. When inotify is not available (other platforms,
+# network filesystems, watch limits reached) the folder is listed every
+# `interval` seconds instead.
+#
+# A file is considered complete once its size is unchanged over `checks`
+# consecutive observations, taken at least `interval` seconds apart. Only the
+# files that are not yet complete are stat'ed at every check.
+
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import os
+import pathlib
+import select
+import struct
+import time
+
+# inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# writes are not watched: file sizes are checked every `interval` seconds
+WATCH_MASK = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    """Minimal inotify wrapper, watching the entries of a single folder.
+    Raises OSError if inotify is not available."""
+
+    def __init__(self, folder, mask=WATCH_MASK):
+        libc_name = ctypes.util.find_library("c")
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if add_watch(self.fd, os.fsencode(str(folder)), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"cannot watch {folder}: {os.strerror(err)}")
+
+    def read(self, timeout):
+        """Waits up to `timeout` seconds (forever if None) for events, and
+        returns the names of the files concerned. Returns None if the event
+        queue overflowed, in which case events were lost."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        names, overflow = set(), False
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(buf):
+                _, mask, _, length = EVENT_HEADER.unpack_from(buf, pos)
+                pos += EVENT_HEADER.size
+                name = buf[pos : pos + length].rstrip(b"\0")
+                pos += length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                elif name:
+                    names.add(os.fsdecode(name))
+        return None if overflow else names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class StableFileWatcher:
+    """Reports the files of `folder` matching `pattern` once their size is
+    stable. Each file is reported once. Files present when the watcher is
+    started are reported too, unless they are listed in `ignore`."""
+
+    def __init__(
+        self,
+        folder,
+        pattern="*.fast5",
+        interval=10.0,
+        checks=2,
+        use_inotify=True,
+        ignore=(),
+    ):
+        self.folder = pathlib.Path(folder)
+        self.pattern = pattern
+        self.interval = interval
+        self.checks = checks
+        self.reported = set(ignore)
+        # path -> (size, number of observations with this size, time)
+        self.pending = {}
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify(self.folder)
+            except OSError as e:
+                print(f"inotify not available ({e}), polling {self.folder}")
+        # listed after the watch is set up, so that no file is missed
+        self._scan()
+
+    @property
+    def mode(self):
+        return "polling" if self.inotify is None else "inotify"
+
+    def _add(self, name):
+        if fnmatch.fnmatch(name, self.pattern) and name not in self.reported:
+            self.pending.setdefault(name, None)
+
+    def _scan(self):
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    self._add(entry.name)
+
+    def _observe(self, now):
+        """Stats the pending files, and returns the ones that became stable."""
+        stable = []
+        for name, obs in list(self.pending.items()):
+            if obs is not None and now - obs[2] < self.interval:
+                continue
+            try:
+                size = (self.folder / name).stat().st_size
+            except FileNotFoundError:
+                del self.pending[name]
+                continue
+            if obs is not None and obs[0] == size:
+                obs = (size, obs[1] + 1, now)
+            else:
+                obs = (size, 1, now)
+            if obs[1] >= self.checks:
+                del self.pending[name]
+                self.reported.add(name)
+                stable.append(self.folder / name)
+            else:
+                self.pending[name] = obs
+        return stable
+
+    def _next_check(self, now):
+        """Time until the next observation of a pending file is due."""
+        due = [obs[2] + self.interval for obs in self.pending.values() if obs]
+        if any(obs is None for obs in self.pending.values()):
+            return 0.0
+        return max(0.0, min(due) - now) if due else None
+
+    def wait(self, timeout=None):
+        """Waits up to `timeout` seconds (forever if None) until some files
+        are stable, and returns their paths (possibly an empty list)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            stable = self._observe(now)
+            remaining = None if deadline is None else max(0.0, deadline - now)
+            if stable or remaining == 0.0:
+                return sorted(stable)
+            delay = self._next_check(now)
+            if self.inotify is None:
+                delay = self.interval if delay is None else delay
+            if remaining is not None:
+                delay = remaining if delay is None else min(delay, remaining)
+            if self.inotify is None:
+                time.sleep(delay)
+                self._scan()
+                continue
+            names = self.inotify.read(delay)
+            if names is None:
+                self._scan()
+            else:
+                for name in names:
+                    self._add(name)
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
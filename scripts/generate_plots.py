@@ -1,18 +1,71 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import numpy as np
 import argparse
 import pathlib
+import stats_store
+from basecall_stats import scan_files
+from read_summary import ReadSummary, bin_edges, q_bin_edges
+from stats_cache import open_cache
+import profiling
+from profiling import stage
+
+FASTQ_SUFFIXES = (".fastq", ".fq", ".fastq.gz", ".fq.gz")
 
 
 def selective_show(b):
+    import matplotlib.pyplot as plt
+
     if b:
         plt.show()
     else:
         plt.close()
 
 
+def fastq_files(stats_file):
+    """Returns the fastq files to scan if `stats_file` is a fastq file or a
+    folder of fastq files without statistics shards, else an empty list."""
+    if stats_file.name.endswith(FASTQ_SUFFIXES):
+        return [stats_file]
+    if stats_file.is_dir() and not any(stats_file.glob("*.npz")):
+        files = [f for f in stats_file.iterdir() if f.name.endswith(FASTQ_SUFFIXES)]
+        return sorted(files)
+    return []
+
+
+def load_summary(stats_file, jobs=1, cache=None):
+    """Loads the per-barcode read summary. `stats_file` can be either a summary
+    `.npz` file, a folder of statistics shards, a csv file with one row per
+    read, or fastq files (a single file or a folder). In the last cases the
+    summary is computed from the reads. Fastq files are scanned by `jobs`
+    processes, using the statistics `cache` if specified."""
+    if stats_file.suffix == ".npz":
+        return ReadSummary.load(stats_file)
+
+    files = fastq_files(stats_file)
+    if files:
+        _, summary = scan_files(files, np.datetime64("now"), jobs=jobs, cache=cache)
+        return summary
+
+    # pandas is only needed for tables, and is slow to import
+    import pandas as pd
+
+    with stage("read table"):
+        if stats_file.is_dir():
+            df = stats_store.read_stats(stats_file)
+        else:
+            df = pd.read_csv(stats_file)
+            # for backward compatibility, to later be removed
+            if " barcode" in df.columns:
+                df = df.rename(columns={" barcode": "barcode"})
+
+    df = df.dropna(subset=["barcode"])
+    codes, names = pd.factorize(df["barcode"])
+    summary = ReadSummary()
+    # tables saved before read qualities were recorded have no `mean_q`
+    mean_q = df["mean_q"].to_numpy() if "mean_q" in df.columns else None
+    summary.add(df["len"].to_numpy(), codes, list(names), mean_q=mean_q)
+    return summary
+
+
 if __name__ == "__main__":
 
     # parse arguments
@@ -22,7 +75,10 @@ if __name__ == "__main__":
     parser.add_argument(
         "stats_file",
         type=str,
-        help="The csv file containing the basecalling statistics.",
+        help="""The file containing the basecalling statistics. Either a
+        summary `.npz` file, a csv file or the folder containing the
+        statistics shards. A fastq file or a folder of fastq files (e.g.
+        the `barcodeXX.fastq.gz` files) can also be used.""",
     )
     parser.add_argument(
         "--dest",
@@ -41,73 +97,104 @@ if __name__ == "__main__":
         help="if specified figures are displayed when created.",
         action="store_true",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="number of worker processes used to scan fastq files",
+        default=1,
+    )
+    parser.add_argument(
+        "--no_cache",
+        help="do not use the statistics cache (see `stats_cache.py`)",
+        action="store_true",
+    )
+    profiling.add_argument(parser)
 
     args = parser.parse_args()
+    profiling.setup(args)
+
+    # imported after parsing the arguments, so that `--help` is fast
+    import matplotlib.pyplot as plt
 
     df_file = pathlib.Path(args.stats_file)
     sv_fld = pathlib.Path(args.dest)
 
-    # import dataframe
-    df = pd.read_csv(df_file)
-
-    # for backward compatibility, to later be removed
-    if " barcode" in df.columns:
-        df = df.rename(columns={" barcode": "barcode"})
+    # import per-barcode summary
+    cache = open_cache(not args.no_cache)
+    with stage("load summary"):
+        summary = load_summary(df_file, jobs=args.jobs, cache=cache)
 
     # select the right barcode order
-    bc_order = np.sort(df["barcode"].unique())
-    df["barcode"] = pd.Categorical(df["barcode"], bc_order)
+    bc_order = summary.sorted_barcodes()
+    idx = [summary.barcodes.index(bc) for bc in bc_order]
+    n_reads = summary.n_reads[idx]
+    tot_bases = summary.tot_bases[idx]
 
     # select barcodes with more than threshold reads
-    n_reads = df["barcode"].value_counts()
-    selected_bc = np.sort(n_reads[n_reads > args.thr].index.values)
-    mask = df["barcode"].isin(selected_bc)
+    selected_bc = [bc for bc, n in zip(bc_order, n_reads) if n > args.thr]
 
     # log-length distribution by barcode, normalized
-    sns.histplot(
-        data=df[mask],
-        x="len",
-        hue="barcode",
-        hue_order=selected_bc,
-        bins=1000,
-        cumulative=True,
-        stat="density",
-        common_bins=True,
-        common_norm=False,
-        element="step",
-        fill=False,
-    )
+    edges = bin_edges()
+    for bc in selected_bc:
+        hist = summary.hist[summary.barcodes.index(bc)]
+        cdf = np.cumsum(hist) / hist.sum()
+        plt.step(edges, np.append(0, cdf), where="post", label=bc)
     plt.xscale("log")
     plt.xlabel("read length (bp)")
+    plt.ylabel("cumulative density")
+    plt.legend(title="barcode")
     plt.tight_layout()
-    plt.savefig(sv_fld / "len_cdf.png", facecolor="w", dpi=200)
+    with stage("save figure"):
+        plt.savefig(sv_fld / "len_cdf.png", facecolor="w", dpi=200)
     selective_show(args.display)
 
     # number of reads by barcode
-    sns.histplot(data=df, x="barcode")
+    plt.bar(bc_order, n_reads)
     plt.xticks(rotation=90)
+    plt.xlabel("barcode")
     plt.ylabel("n. reads")
     plt.axhline(args.thr, ls=":", color="gray", label="threshold")
     plt.legend()
     plt.yscale("log")
     plt.tight_layout()
-    plt.savefig(sv_fld / "n_reads.png", facecolor="w", dpi=200)
+    with stage("save figure"):
+        plt.savefig(sv_fld / "n_reads.png", facecolor="w", dpi=200)
     selective_show(args.display)
 
     # total read length by barcode
-    sns.histplot(data=df, x="barcode", weights="len")
+    plt.bar(bc_order, tot_bases)
     plt.xticks(rotation=90)
+    plt.xlabel("barcode")
     plt.ylabel("tot. read length")
     plt.yscale("log")
     plt.tight_layout()
-    plt.savefig(sv_fld / "tot_length.png", facecolor="w", dpi=200)
+    with stage("save figure"):
+        plt.savefig(sv_fld / "tot_length.png", facecolor="w", dpi=200)
     selective_show(args.display)
 
     # read length distribution by barcode
-    sns.boxplot(data=df[mask], x="barcode", y="len", order=selected_bc)
+    if len(selected_bc) > 0:
+        plt.gca().bxp([summary.box_stats(bc) for bc in selected_bc])
     plt.xticks(rotation=90)
     plt.yscale("log")
+    plt.xlabel("barcode")
     plt.ylabel("read length distribution")
     plt.tight_layout()
-    plt.savefig(sv_fld / "read_length_distr.png", facecolor="w", dpi=200)
+    with stage("save figure"):
+        plt.savefig(sv_fld / "read_length_distr.png", facecolor="w", dpi=200)
+    selective_show(args.display)
+
+    # mean read quality distribution by barcode, if qualities are available
+    q_edges = q_bin_edges()
+    for bc in selected_bc:
+        qhist = summary.qhist[summary.barcodes.index(bc)]
+        if qhist.sum() > 0:
+            plt.step(q_edges, np.append(0, qhist / qhist.sum()), where="post", label=bc)
+    if plt.gca().has_data():
+        plt.xlabel("mean read quality (phred)")
+        plt.ylabel("fraction of reads")
+        plt.legend(title="barcode")
+        plt.tight_layout()
+        with stage("save figure"):
+            plt.savefig(sv_fld / "mean_q_distr.png", facecolor="w", dpi=200)
     selective_show(args.display)
@@ -0,0 +1,126 @@
+# Length pre-filter of the reads of a barcode before assembly, replacing
+# `filtlong --min_length 1000 --keep_percent 95` in `assemble.nf`. Reads shorter
+# than `--min_length` are discarded, and the longest reads making up
+# `--keep_percent` percent of the remaining bases are kept. Unlike filtlong,
+# reads are ranked by length only, not by a combination of length and quality.
+#
+# The file is read twice, streaming the reads in large blocks. The first pass
+# builds the histogram of read lengths (in parallel chunks for indexed BGZF
+# files, see `barcode_qc.py`), from which the length threshold is computed.
+# Histograms are saved in the statistics cache (see `stats_cache.py`), shared
+# with the QC of `archive.py`, so the first pass is skipped for files already
+# scanned. The second pass writes the kept reads compressed in BGZF format,
+# so that no uncompressed copy of the reads is written to disk.
+#
+# Usage: python3 length_filter.py barcode01.fastq.gz --out reads.fastq.gz
+
+import argparse
+import numpy as np
+from barcode_qc import combine, file_tasks, scan_task
+from bgzf import BgzfWriter
+from fastq_scan import iter_records_blocks, open_fastq
+from stats_cache import open_cache
+import profiling
+from profiling import stage
+
+
+def length_histogram(fastq_file, threads=8, cache=None):
+    """Returns the distinct read lengths of a file (sorted) and their
+    counts."""
+
+    def compute(path):
+        from concurrent.futures import ProcessPoolExecutor
+
+        tasks = file_tasks(path)
+        with ProcessPoolExecutor(max_workers=min(threads, len(tasks))) as pool:
+            res = combine(list(pool.map(scan_task, tasks)))
+        # same entry as `barcode_qc.qc_table`
+        return {"len": res[0], "count": res[1], "q": np.array(res[2:])}
+
+    if cache is None:
+        stats = compute(fastq_file)
+    else:
+        stats = cache.cached("qc", fastq_file, compute)
+    return stats["len"], stats["count"]
+
+
+def length_threshold(values, counts, min_length=1000, keep_percent=95):
+    """Returns the minimum length of the kept reads, given the histogram of
+    read lengths: the longest reads (of at least `min_length` bp) are kept
+    until they make up `keep_percent` percent of the bases of all reads of at
+    least `min_length` bp. Reads as long as the threshold are all kept."""
+    keep = values >= min_length
+    values, counts = values[keep][::-1], counts[keep][::-1]
+    if len(values) == 0:
+        return min_length
+    bases = np.cumsum(values * counts)
+    idx = np.searchsorted(bases, bases[-1] * keep_percent / 100)
+    return int(values[min(idx, len(values) - 1)])
+
+
+def filter_reads(fastq_file, out_file, threshold, threads=1):
+    """Writes the reads at least `threshold` bp long to `out_file` in BGZF
+    format. Returns the number of kept reads and bases."""
+    n_reads, n_bases = 0, 0
+    with open_fastq(fastq_file) as stream, open(out_file, "wb") as out:
+        writer = BgzfWriter(out, threads=threads)
+        for lines in iter_records_blocks(stream):
+            n = len(lines) // 4
+            ls = np.fromiter(map(len, lines[1::4]), dtype=np.int64, count=n)
+            if lines[1].endswith(b"\r"):
+                ls -= 1
+            kept = np.flatnonzero(ls >= threshold)
+            if len(kept) == n:
+                writer.write(b"\n".join(lines) + b"\n")
+            elif len(kept) > 0:
+                writer.write(
+                    b"".join(b"\n".join(lines[4 * i : 4 * i + 4]) + b"\n" for i in kept)
+                )
+            n_reads += len(kept)
+            n_bases += int(ls[kept].sum())
+        writer.close()
+    return n_reads, n_bases
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="keep the longest reads of a fastq file, writing them compressed"
+    )
+    parser.add_argument("fastq_file", type=str, help="(gzipped) fastq file")
+    parser.add_argument(
+        "--out", type=str, required=True, help="output file (BGZF fastq.gz)"
+    )
+    parser.add_argument(
+        "--min_length", type=int, default=1000, help="minimum read length (bp)"
+    )
+    parser.add_argument(
+        "--keep_percent",
+        type=float,
+        default=95,
+        help="percent of the bases to keep, discarding the shortest reads",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=8, help="number of parallel processes"
+    )
+    parser.add_argument(
+        "--no_cache",
+        help="do not use the statistics cache (see `stats_cache.py`)",
+        action="store_true",
+    )
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.setup(args)
+
+    cache = open_cache(not args.no_cache)
+    with stage("length histogram"):
+        values, counts = length_histogram(args.fastq_file, args.threads, cache)
+    threshold = length_threshold(values, counts, args.min_length, args.keep_percent)
+    with stage("filter reads"):
+        n_reads, n_bases = filter_reads(
+            args.fastq_file, args.out, threshold, args.threads
+        )
+    print(
+        f"kept {n_reads} of {int(counts.sum())} reads ({n_bases} of "
+        + f"{int(np.sum(values * counts))} bases), threshold {threshold} bp"
+    )
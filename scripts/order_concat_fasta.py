@@ -1,37 +1,195 @@
+# Concatenates fasta files in a single file, with records sorted by id.
+#
+# By default each file must contain a single record, and all sequences are
+# loaded in memory with Biopython. With `--stream` the records are never
+# loaded: a lightweight (id, file, offset, length) index of all records is
+# built in a first pass and sorted, and the records are then copied verbatim
+# (with their original line wrapping) from the input files to the output in
+# large blocks. This mode supports multi-record and gzipped files, and its
+# memory use does not depend on the size of the sequences.
+
 import argparse
-from Bio import SeqIO
-import numpy as np
+import gzip
+import os
+import shutil
+import tempfile
+import profiling
+from profiling import stage
+
+# size of the blocks read and copied at once
+BLOCK_SIZE = 8 * 1024**2
+
+
+def is_gzipped(path):
+    with open(path, "rb") as f:
+        return f.read(2) == b"\x1f\x8b"
+
+
+def open_fasta(path):
+    """Opens a (possibly gzipped) fasta file in binary mode."""
+    return gzip.open(path, "rb") if is_gzipped(path) else open(path, "rb")
+
+
+def header_starts(buf, end):
+    """Positions of the header lines in `buf[:end]`, which starts at the
+    beginning of a line."""
+    if end > 0 and buf.startswith(b">"):
+        yield 0
+    pos = buf.find(b"\n>", 0, end)
+    while pos >= 0:
+        yield pos + 1
+        pos = buf.find(b"\n>", pos + 1, end)
+
+
+def index_fasta(stream, block_size=BLOCK_SIZE):
+    """Returns the list of (id, offset, length) of the records of a fasta
+    stream, where offsets and lengths refer to the uncompressed data. The id
+    is the first word of the header, as for Biopython records."""
+    starts = []
+    buf, base = b"", 0
+    while True:
+        block = stream.read(block_size)
+        buf += block
+        # only complete lines are processed, buf always starts at a line start
+        end = len(buf) if not block else buf.rfind(b"\n") + 1
+        for pos in header_starts(buf, end):
+            line_end = buf.find(b"\n", pos, end)
+            line_end = end if line_end < 0 else line_end
+            header = buf[pos + 1 : line_end].split(maxsplit=1)
+            starts.append((header[0].decode() if header else "", base + pos))
+        buf, base = buf[end:], base + end
+        if not block:
+            break
+    offsets = [off for _, off in starts] + [base]
+    return [(rid, off, nxt - off) for (rid, off), nxt in zip(starts, offsets[1:])]
+
+
+def build_index(files):
+    """Returns the (id, file index, offset, length) of all records, sorted by
+    id. Records with the same id keep the order of the input files."""
+    index = []
+    for i, path in enumerate(files):
+        with open_fasta(path) as stream:
+            index += [(rid, i, off, n) for rid, off, n in index_fasta(stream)]
+    return sorted(index, key=lambda rec: rec[0])
+
+
+class RecordReader:
+    """Random access to the records of the input files. Gzipped files are
+    read forward, and decompressed to a temporary file if their records are
+    needed out of order."""
+
+    def __init__(self, files, index, tmp_dir):
+        self.files = files
+        self.tmp_dir = tmp_dir
+        self.streams = {}
+        # number of records still to be read from each file
+        self.remaining = [0] * len(files)
+        last, self.in_order = {}, [True] * len(files)
+        for _, i, off, _ in index:
+            self.remaining[i] += 1
+            if off < last.get(i, -1):
+                self.in_order[i] = False
+            last[i] = off
+
+    def _open(self, i):
+        path = self.files[i]
+        if self.in_order[i] or not is_gzipped(path):
+            return open_fasta(path)
+        tmp = os.path.join(self.tmp_dir, f"{i}.fasta")
+        with gzip.open(path, "rb") as fin, open(tmp, "wb") as fout:
+            shutil.copyfileobj(fin, fout, BLOCK_SIZE)
+        return open(tmp, "rb")
+
+    def copy(self, i, offset, length, out):
+        """Copies a record to the `out` stream, adding a final newline if
+        missing."""
+        if i not in self.streams:
+            self.streams[i] = self._open(i)
+        stream = self.streams[i]
+        stream.seek(offset)
+        last = b"\n"
+        while length > 0:
+            data = stream.read(min(length, BLOCK_SIZE))
+            if not data:
+                raise ValueError(f"{self.files[i]} was modified while reading")
+            out.write(data)
+            length -= len(data)
+            last = data[-1:]
+        if last != b"\n":
+            out.write(b"\n")
+        self.remaining[i] -= 1
+        if self.remaining[i] == 0:
+            self.streams.pop(i).close()
+
+    def close(self):
+        for stream in self.streams.values():
+            stream.close()
+
+
+def stream_concat(files, out_file):
+    """Writes the records of all files to `out_file`, sorted by id, without
+    loading the sequences in memory. Returns the number of records."""
+    with stage("index records"):
+        index = build_index(files)
+    with tempfile.TemporaryDirectory() as tmp_dir, open(out_file, "wb") as out:
+        reader = RecordReader(files, index, tmp_dir)
+        try:
+            with stage("copy records"):
+                for _, i, offset, length in index:
+                    reader.copy(i, offset, length, out)
+        finally:
+            reader.close()
+    return len(index)
 
 
 if __name__ == "__main__":
 
     # parse arguments
     parser = argparse.ArgumentParser(
-        description="concatenates fasta files in a single file, with "
+        description="concatenates fasta files in a single file, with records "
+        + "sorted by id"
     )
     parser.add_argument(
         "--prefix",
         type=str,
         help="prefix of the output fasta file",
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="""index the records and copy them to the output without loading
+        them in memory. Supports multi-record and gzipped files. Records are
+        copied verbatim, keeping their original line wrapping.""",
+    )
     parser.add_argument(
         "files",
-        type=argparse.FileType("r"),
+        type=str,
         nargs="+",
         help="List of fasta files to concatenate",
     )
 
+    profiling.add_argument(parser)
     args = parser.parse_args()
+    profiling.setup(args)
+
+    if args.stream:
+        stream_concat(args.files, f"{args.prefix}.fasta")
+        exit(0)
+
+    # Biopython is slow to import, and only needed here
+    from Bio import SeqIO
 
     # creat list of reads
     reads = []
-    for f in args.files:
-        r = SeqIO.read(f, format="fasta")
-        reads.append(r)
+    with stage("read contigs"):
+        for f in args.files:
+            r = SeqIO.read(f, format="fasta")
+            reads.append(r)
 
     # sort reads by id
     reads = sorted(reads, key=lambda r: r.id)
 
     # write in a single fasta file with specified prefix
-    with open(f"{args.prefix}.fasta", "w") as f:
+    with stage("write contigs"), open(f"{args.prefix}.fasta", "w") as f:
         SeqIO.write(reads, f, format="fasta")
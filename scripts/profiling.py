@@ -0,0 +1,202 @@
+# Opt-in instrumentation of the stages of the scripts, to find out where the
+# time goes (decompression, parsing, pandas, subprocesses, filesystem...).
+# Stages are marked with the `stage` context manager or the `profiled`
+# decorator:
+#
+#   with profiling.stage("copy barcodes"):
+#       ...
+#
+# and profiling is enabled by the `--profile [TRACE]` option (see
+# `add_argument` and `setup`). For each stage the wall time, CPU time (of the
+# process, all threads, and of its terminated subprocesses), peak resident
+# memory, bytes read and written (all I/O system calls, including network
+# filesystems) and number of subprocesses started are recorded. At exit, a
+# summary per stage is printed and a trace is saved in Chrome trace format,
+# which can be opened in `chrome://tracing` or https://ui.perfetto.dev.
+#
+# When profiling is disabled `stage` returns a shared no-op context manager,
+# so instrumented code runs at the same speed.
+
+import atexit
+import contextlib
+import functools
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+DEFAULT_TRACE = "profile_trace.json"
+
+# active profiler, None when profiling is disabled
+_profiler = None
+_NO_STAGE = contextlib.nullcontext()
+
+
+def io_counters():
+    """Bytes read and written by the process so far, or zeros if not
+    available (non-Linux systems)."""
+    try:
+        with open("/proc/self/io", "rb") as f:
+            fields = dict(line.split(b":") for line in f.read().splitlines())
+        return int(fields[b"rchar"]), int(fields[b"wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+class Profiler:
+    """Records the stages of the current process, and writes them to
+    `trace_file` when `finish` is called."""
+
+    def __init__(self, trace_file=DEFAULT_TRACE):
+        self.trace_file = trace_file
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.events = []
+        self.n_subprocesses = 0
+        self._count_subprocesses()
+        self.start = self.snapshot()
+
+    def _count_subprocesses(self):
+        popen_init = subprocess.Popen.__init__
+
+        @functools.wraps(popen_init)
+        def counting_init(popen, *args, **kwargs):
+            with self.lock:
+                self.n_subprocesses += 1
+            popen_init(popen, *args, **kwargs)
+
+        subprocess.Popen.__init__ = counting_init
+
+    def snapshot(self):
+        t = os.times()
+        read, written = io_counters()
+        return {
+            "wall": time.perf_counter(),
+            "cpu": t.user + t.system + t.children_user + t.children_system,
+            "read": read,
+            "written": written,
+            "subprocesses": self.n_subprocesses,
+        }
+
+    def record(self, name, start, end):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": round((start["wall"] - self.start["wall"]) * 1e6),
+            "dur": round((end["wall"] - start["wall"]) * 1e6),
+            "pid": self.pid,
+            "tid": threading.get_ident(),
+            "args": {
+                "cpu_s": round(end["cpu"] - start["cpu"], 4),
+                "max_rss_mb": round(rss, 1),
+                "read_mb": round((end["read"] - start["read"]) / 1e6, 3),
+                "written_mb": round((end["written"] - start["written"]) / 1e6, 3),
+                "subprocesses": end["subprocesses"] - start["subprocesses"],
+            },
+        }
+        with self.lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # worker processes forked during a stage are not recorded
+        if os.getpid() != self.pid:
+            yield
+            return
+        start = self.snapshot()
+        try:
+            yield
+        finally:
+            self.record(name, start, self.snapshot())
+
+    def summary(self):
+        """Per-stage totals, in order of first occurrence. Time spent in
+        nested stages is also counted in the enclosing stage."""
+        stages = {}
+        for e in self.events:
+            s = stages.setdefault(e["name"], {"calls": 0, "wall_s": 0.0})
+            s["calls"] += 1
+            s["wall_s"] += e["dur"] / 1e6
+            for key, value in e["args"].items():
+                if key == "max_rss_mb":
+                    s[key] = max(s.get(key, 0), value)
+                else:
+                    s[key] = s.get(key, 0) + value
+        lines = [
+            f"{'stage':<24} {'calls':>6} {'wall (s)':>9} {'cpu (s)':>8} "
+            + f"{'rss (MB)':>9} {'read (MB)':>10} {'write (MB)':>10} {'subproc':>7}"
+        ]
+        for name, s in stages.items():
+            lines.append(
+                f"{name[:24]:<24} {s['calls']:>6} {s['wall_s']:>9.3f} "
+                + f"{s['cpu_s']:>8.3f} {s['max_rss_mb']:>9.1f} {s['read_mb']:>10.1f} "
+                + f"{s['written_mb']:>10.1f} {s['subprocesses']:>7}"
+            )
+        return "\n".join(lines)
+
+    def finish(self):
+        """Records the whole run as the `total` stage, writes the trace and
+        prints the summary."""
+        self.record("total", self.start, self.snapshot())
+        trace = {"traceEvents": self.events, "displayTimeUnit": "ms"}
+        with open(self.trace_file, "w") as f:
+            json.dump(trace, f)
+        print(
+            f"\n---- profile (trace saved in {self.trace_file}) ----", file=sys.stderr
+        )
+        print(self.summary(), file=sys.stderr)
+
+
+def stage(name):
+    """Context manager marking a stage of the script."""
+    if _profiler is None:
+        return _NO_STAGE
+    return _profiler.stage(name)
+
+
+def profiled(name=None):
+    """Decorator marking a function as a stage, named after the function by
+    default."""
+
+    def decorator(func):
+        label = func.__name__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with _profiler.stage(label):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def enable(trace_file=DEFAULT_TRACE):
+    """Starts profiling. The trace is written when the interpreter exits."""
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(trace_file)
+        atexit.register(_profiler.finish)
+    return _profiler
+
+
+def add_argument(parser):
+    """Adds the `--profile` option to an argument parser."""
+    parser.add_argument(
+        "--profile",
+        metavar="TRACE",
+        help=f"""profile the stages of the script, printing a summary and saving
+        a Chrome trace in TRACE (e.g. {DEFAULT_TRACE}).""",
+    )
+
+
+def setup(args):
+    """Enables profiling if requested by the parsed arguments."""
+    if getattr(args, "profile", None) is not None:
+        enable(args.profile)
@@ -0,0 +1,240 @@
+# Compact, mergeable per-barcode summary of read statistics. For each barcode
+# it stores the number of reads, the total number of bases, the minimum and
+# maximum read length, a histogram of read lengths in logarithmic bins and a
+# histogram of the mean read qualities.
+# Since bins have a fixed relative width, the histogram also serves as a
+# quantile sketch with bounded relative error (about 1% with the default
+# binning), that is used to compute the boxplot statistics.
+
+import argparse
+import os
+import pathlib
+import numpy as np
+
+# logarithmic binning of read lengths: BINS_PER_DECADE bins for each power of
+# ten, from 1 bp up to 10^MAX_DECADE bp. Lengths outside are clipped.
+BINS_PER_DECADE = 100
+MAX_DECADE = 7
+
+# linear binning of the mean read quality (phred), from 0 to MAX_Q. Higher
+# qualities are clipped.
+Q_BIN_WIDTH = 0.5
+MAX_Q = 60
+
+
+def bin_edges():
+    """Returns the edges of the read-length histogram bins."""
+    n_bins = BINS_PER_DECADE * MAX_DECADE
+    return np.logspace(0, MAX_DECADE, n_bins + 1)
+
+
+def bin_index(lengths):
+    """Returns the histogram bin index for each read length."""
+    n_bins = BINS_PER_DECADE * MAX_DECADE
+    idx = np.floor(np.log10(np.maximum(lengths, 1)) * BINS_PER_DECADE)
+    return np.clip(idx.astype(np.int64), 0, n_bins - 1)
+
+
+def q_bin_edges():
+    """Returns the edges of the mean-quality histogram bins."""
+    return np.linspace(0, MAX_Q, round(MAX_Q / Q_BIN_WIDTH) + 1)
+
+
+def q_bin_index(mean_q):
+    """Returns the histogram bin index for each mean read quality."""
+    n_bins = round(MAX_Q / Q_BIN_WIDTH)
+    idx = np.floor(np.asarray(mean_q) / Q_BIN_WIDTH)
+    return np.clip(idx.astype(np.int64), 0, n_bins - 1)
+
+
+class ReadSummary:
+    """Per-barcode summary of read lengths. Reads are added with `add`, and
+    summaries built from different files or batches can be combined with
+    `merge`. The `sources` attribute records the names of the partial
+    summaries already merged, so that merging the same one twice has no
+    effect."""
+
+    def __init__(self):
+        n_bins = BINS_PER_DECADE * MAX_DECADE
+        self.barcodes = []
+        self.hist = np.zeros((0, n_bins), dtype=np.int64)
+        self.qhist = np.zeros((0, round(MAX_Q / Q_BIN_WIDTH)), dtype=np.int64)
+        self.n_reads = np.zeros(0, dtype=np.int64)
+        self.tot_bases = np.zeros(0, dtype=np.int64)
+        self.min_len = np.zeros(0, dtype=np.int64)
+        self.max_len = np.zeros(0, dtype=np.int64)
+        self.sources = []
+
+    def _index(self, barcode):
+        """Returns the row of the barcode, adding it if new."""
+        if barcode not in self.barcodes:
+            self.barcodes.append(barcode)
+            self.hist = np.vstack([self.hist, np.zeros((1, self.hist.shape[1]), int)])
+            self.qhist = np.vstack(
+                [self.qhist, np.zeros((1, self.qhist.shape[1]), int)]
+            )
+            self.n_reads = np.append(self.n_reads, 0)
+            self.tot_bases = np.append(self.tot_bases, 0)
+            self.min_len = np.append(self.min_len, np.iinfo(np.int64).max)
+            self.max_len = np.append(self.max_len, 0)
+        return self.barcodes.index(barcode)
+
+    def add(self, lengths, barcodes, barcode_names, mean_q=None):
+        """Adds a block of reads. `barcodes` contains, for each read, the index
+        of its barcode in `barcode_names`. Reads with negative index (no
+        barcode) are ignored. If given, `mean_q` contains the mean quality of
+        each read (NaN if unknown)."""
+        lengths = np.asarray(lengths)
+        barcodes = np.asarray(barcodes)
+        bins = bin_index(lengths)
+        if mean_q is not None:
+            mean_q = np.asarray(mean_q)
+            has_q = ~np.isnan(mean_q)
+            qbins = q_bin_index(np.where(has_q, mean_q, 0))
+        for code in np.unique(barcodes[barcodes >= 0]):
+            mask = barcodes == code
+            i = self._index(barcode_names[code])
+            ls = lengths[mask]
+            self.hist[i] += np.bincount(bins[mask], minlength=self.hist.shape[1])
+            self.n_reads[i] += len(ls)
+            self.tot_bases[i] += ls.sum()
+            self.min_len[i] = min(self.min_len[i], ls.min())
+            self.max_len[i] = max(self.max_len[i], ls.max())
+            if mean_q is not None:
+                self.qhist[i] += np.bincount(
+                    qbins[mask & has_q], minlength=self.qhist.shape[1]
+                )
+
+    def merge(self, other, source=None):
+        """Adds the content of another summary to this one. If `source` is
+        specified and was already merged, the summary is not added again."""
+        if source is not None:
+            if source in self.sources:
+                return
+            self.sources.append(source)
+        for j, bc in enumerate(other.barcodes):
+            i = self._index(bc)
+            self.hist[i] += other.hist[j]
+            self.qhist[i] += other.qhist[j]
+            self.n_reads[i] += other.n_reads[j]
+            self.tot_bases[i] += other.tot_bases[j]
+            self.min_len[i] = min(self.min_len[i], other.min_len[j])
+            self.max_len[i] = max(self.max_len[i], other.max_len[j])
+
+    def sorted_barcodes(self):
+        """Returns the list of barcodes in alphabetical order."""
+        return sorted(self.barcodes)
+
+    def quantiles(self, barcode, qs):
+        """Approximate quantiles of the read length distribution of a barcode,
+        interpolated geometrically within the histogram bins."""
+        i = self.barcodes.index(barcode)
+        edges = bin_edges()
+        cum = np.cumsum(self.hist[i])
+        targets = np.asarray(qs) * cum[-1]
+        b = np.minimum(np.searchsorted(cum, targets, side="left"), len(cum) - 1)
+        prev = np.where(b > 0, cum[b - 1], 0)
+        frac = (targets - prev) / np.maximum(self.hist[i][b], 1)
+        res = edges[b] * (edges[b + 1] / edges[b]) ** frac
+        return np.clip(res, self.min_len[i], self.max_len[i])
+
+    def box_stats(self, barcode):
+        """Returns the boxplot statistics for the barcode, in the format used
+        by `matplotlib.axes.Axes.bxp`. Whiskers extend to the most extreme
+        bins within 1.5 times the inter-quartile range. Only the minimum and
+        maximum lengths are reported as outliers."""
+        i = self.barcodes.index(barcode)
+        q1, med, q3 = self.quantiles(barcode, [0.25, 0.5, 0.75])
+        iqr = q3 - q1
+        edges = bin_edges()
+        occupied = self.hist[i] > 0
+        lo = edges[:-1][occupied & (edges[1:] >= q1 - 1.5 * iqr)]
+        hi = edges[1:][occupied & (edges[:-1] <= q3 + 1.5 * iqr)]
+        whislo = max(lo.min(), self.min_len[i]) if len(lo) else q1
+        whishi = min(hi.max(), self.max_len[i]) if len(hi) else q3
+        fliers = [
+            x for x in (self.min_len[i], self.max_len[i]) if x < whislo or x > whishi
+        ]
+        return {
+            "label": barcode,
+            "med": med,
+            "q1": q1,
+            "q3": q3,
+            "whislo": whislo,
+            "whishi": whishi,
+            "fliers": fliers,
+        }
+
+    def save(self, path):
+        """Atomically saves the summary in compressed `.npz` format."""
+        path = pathlib.Path(path)
+        tmp = path.with_name(f".{path.name}.tmp")
+        with open(tmp, "wb") as f:
+            np.savez_compressed(
+                f,
+                barcodes=np.array(self.barcodes, dtype=str),
+                hist=self.hist,
+                qhist=self.qhist,
+                n_reads=self.n_reads,
+                tot_bases=self.tot_bases,
+                min_len=self.min_len,
+                max_len=self.max_len,
+                sources=np.array(self.sources, dtype=str),
+                bins=np.array([BINS_PER_DECADE, MAX_DECADE]),
+                q_bins=np.array([Q_BIN_WIDTH, MAX_Q]),
+            )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a summary saved with `save`."""
+        summary = cls()
+        with np.load(path, allow_pickle=False) as data:
+            assert tuple(data["bins"]) == (
+                BINS_PER_DECADE,
+                MAX_DECADE,
+            ), f"incompatible histogram binning in {path}"
+            summary.barcodes = data["barcodes"].tolist()
+            summary.hist = data["hist"]
+            summary.n_reads = data["n_reads"]
+            summary.tot_bases = data["tot_bases"]
+            summary.min_len = data["min_len"]
+            summary.max_len = data["max_len"]
+            summary.sources = data["sources"].tolist()
+            # summaries saved before read qualities were recorded
+            if "qhist" in data.files:
+                assert tuple(data["q_bins"]) == (
+                    Q_BIN_WIDTH,
+                    MAX_Q,
+                ), f"incompatible quality binning in {path}"
+                summary.qhist = data["qhist"]
+            else:
+                summary.qhist = np.zeros(
+                    (len(summary.barcodes), summary.qhist.shape[1]), dtype=np.int64
+                )
+        return summary
+
+
+def merge_files(out_file, in_files):
+    """Merges the summaries in `in_files` into `out_file` (if it exists its
+    content is kept). Summaries that were already merged are skipped."""
+    out_file = pathlib.Path(out_file)
+    summary = ReadSummary.load(out_file) if out_file.is_file() else ReadSummary()
+    for f in in_files:
+        summary.merge(ReadSummary.load(f), source=pathlib.Path(f).name)
+    summary.save(out_file)
+    return summary
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="merge per-barcode read summaries in a single file"
+    )
+    parser.add_argument("out_file", type=str, help="summary file to update")
+    parser.add_argument(
+        "in_files", type=str, nargs="+", help="summary files to merge in it"
+    )
+    args = parser.parse_args()
+
+    merge_files(args.out_file, args.in_files)
@@ -0,0 +1,164 @@
+# Concurrency-safe updates of shared `sample.csv` tables. A table is locked
+# with an fcntl advisory lock on a companion `.sample.csv.lock` file, waiting
+# in a blocking call (no polling) until the lock is released. The lock is
+# released by the kernel when its holder exits, even if it crashes.
+#
+# The lock file records the pid and host of the current holder. If the
+# holder runs on this host and no longer exists, but the lock was not
+# released (e.g. lost by the lock manager of a network filesystem), the
+# lock is considered stale: the lock file is replaced by a new one, and
+# waiting processes retry on it.
+#
+# Updates are written to a temporary file, which atomically replaces the
+# table, so that readers never see a truncated table.
+
+import collections
+import contextlib
+import datetime
+import fcntl
+import io
+import os
+import pathlib
+import socket
+import pandas as pd
+
+READ_ONLY = 0o444
+
+
+def lock_path(table):
+    table = pathlib.Path(table)
+    return table.with_name(f".{table.name}.lock")
+
+
+def owner_record():
+    """pid, host and time of the current process, recorded in lock files."""
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    return f"{os.getpid()} {socket.gethostname()} {now}\n"
+
+
+def read_owner(fd):
+    """Returns (pid, host, time) of the holder of a lock file, or None."""
+    fields = os.pread(fd, 4096, 0).decode(errors="replace").split()
+    if len(fields) != 3 or not fields[0].isdigit():
+        return None
+    return int(fields[0]), fields[1], fields[2]
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def is_stale(owner):
+    """A lock is stale if its holder ran on this host and has exited."""
+    if owner is None:
+        return False
+    pid, host, _ = owner
+    return host == socket.gethostname() and not pid_alive(pid)
+
+
+@contextlib.contextmanager
+def locked(table, verbose=True):
+    """Holds the exclusive lock of a table within the context. Locks are
+    held by processes: threads of the same process are not serialized."""
+    path = lock_path(table)
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            owner = read_owner(fd)
+            if is_stale(owner):
+                print(f"removing stale lock {path} held by {owner}")
+                with contextlib.suppress(FileNotFoundError):
+                    if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                        os.unlink(path)
+                os.close(fd)
+                continue
+            if verbose:
+                print(f"waiting for lock {path} held by {owner}")
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+        # the lock file might have been replaced while waiting: retry
+        try:
+            same = os.stat(path).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+            same = False
+        if same:
+            break
+        os.close(fd)
+    try:
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, owner_record().encode(), 0)
+        yield
+    finally:
+        os.ftruncate(fd, 0)
+        fcntl.lockf(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def write_atomic(path, write, mode=READ_ONLY):
+    """Writes a file with the function `write(tmp_path)` to a temporary file
+    in the same folder, then atomically replaces `path` with it."""
+    path = pathlib.Path(path)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        write(tmp)
+        with open(tmp, "rb+") as f:
+            os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def read_rows(table, read_kwargs=None):
+    return pd.read_csv(table, **(read_kwargs or {}))
+
+
+def append_rows(table, df, read_kwargs=None):
+    """Appends the rows of `df` to the csv `table`, creating it if needed.
+    Returns the rows that were added, e.g. to remove them later with
+    `remove_rows`."""
+    table = pathlib.Path(table)
+    with locked(table):
+        new_df = df
+        if table.is_file():
+            new_df = pd.concat([read_rows(table, read_kwargs), df], ignore_index=True)
+        write_atomic(table, lambda tmp: new_df.to_csv(tmp, index=False))
+    return df
+
+
+def remove_rows(table, rows, read_kwargs=None):
+    """Removes the `rows` returned by `append_rows` from the table, keeping
+    the rows added in the meantime by other processes. One matching row is
+    removed for each of `rows`, starting from the end of the table, so that
+    identical rows that were already in the table are kept. The table is
+    removed if no row is left."""
+    table = pathlib.Path(table)
+    with locked(table):
+        if not table.is_file():
+            return
+        df = read_rows(table, read_kwargs)
+        # parsed as the table, so that values compare equal
+        rows = read_rows(io.StringIO(rows.to_csv(index=False)), read_kwargs)
+        combined = pd.concat([df, rows], ignore_index=True)
+        keys = combined.groupby(
+            list(combined.columns), dropna=False, sort=False
+        ).ngroup()
+        to_remove = collections.Counter(keys[len(df) :])
+        keep = [True] * len(df)
+        for i in reversed(range(len(df))):
+            if to_remove[keys[i]] > 0:
+                to_remove[keys[i]] -= 1
+                keep[i] = False
+        df = df[keep]
+        if df.empty:
+            table.unlink()
+        else:
+            write_atomic(table, lambda tmp: df.to_csv(tmp, index=False))
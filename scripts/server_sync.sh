@@ -1,21 +1,15 @@
 USER='d_nanopore'
 SERVER='login.scicore.unibas.ch'
 DEST='genome-assembly-pipeline/genome-assembly/runs/2022_01_14_Alex_Sequencing/input'
-# without trailing slash, this will create a directory at destination
 READS='/var/lib/minknow/data/2022_01_14_Alex_Sequencing/no_sample/20220114_1326_MN23519_FAL02190_89855126/fast5/'
+# manifest of the files already shipped, to restart the upload without
+# sending files again
+STATE="$HOME/fast5_uploads/$(basename $(dirname $READS))"
 
+# ships new fast5 files as soon as they are complete, and sends
+# `end-signal.fast5` when the run is finished
+python3 "$(dirname "$0")/fast5_uploader.py" upload $READS $USER@$SERVER:$DEST \
+    --state_dir "$STATE" --workers 4
 
-while true;
-do
-   rsync -varu --include "*.fast5" --exclude "*" $READS $USER@$SERVER:$DEST
-   sleep 300;
-done
-
-# rsync relevant options:
-# -a : transfer in archive mode
-# -v : verbose
-# -r : recursive
-# -u : update. Skips files that are newer on the receiver.
-# -n : performs a dry run
-# --ignore-existing : ignores files that already exist on the receiver
-# --remove-source-files : sender removes synchronized files
+# upload latency summary:
+# python3 scripts/fast5_uploader.py report "$STATE/upload_manifest.jsonl"
@@ -0,0 +1,211 @@
+# Persistent cache of per-file read statistics, shared by the scripts that
+# scan fastq files (`basecall_stats.py`, `generate_plots.py`, `archive.py`),
+# so that statistics of files that did not change are not computed again.
+#
+# Each entry is a `.npz` file of arrays, whose name is a hash of the kind of
+# statistics, the absolute path, size and modification time of the scanned
+# file (and optionally a checksum of its content). A modified file therefore
+# gets a new entry, and the old one is eventually evicted. Entries are written
+# to a temporary file and atomically renamed, so that concurrent processes
+# (e.g. parallel Nextflow tasks) can share the cache without locking. Reading
+# an entry refreshes its modification time. A running total of the size of
+# the cache is kept in a small file, so that writing an entry does not list
+# the cache folder. When the total exceeds the maximum size, the least
+# recently used entries are removed by a single process at a time, and the
+# total is recomputed from the entries.
+#
+# The cache folder is `~/.cache/nanopore_stats` by default, and can be changed
+# with the `NANOPORE_STATS_CACHE` environment variable.
+
+import argparse
+import fcntl
+import hashlib
+import os
+import pathlib
+import sys
+import uuid
+import numpy as np
+from copy_engine import file_digest
+
+# incremented when the format of the cached statistics changes
+CACHE_VERSION = 2
+
+DEFAULT_DIR = pathlib.Path.home() / ".cache" / "nanopore_stats"
+DEFAULT_MAX_SIZE = 4 * 1024**3
+ENV_DIR = "NANOPORE_STATS_CACHE"
+LOCK_FILE = ".evict.lock"
+SIZE_FILE = ".size"
+
+# when full, the cache is reduced to this fraction of its maximum size
+LOW_WATER = 0.9
+
+
+class StatsCache:
+    """Cache of statistics (dictionaries of numpy arrays) of files, stored in
+    `folder` up to `max_size` bytes. If `content_hash` is True, the checksum
+    of the content of the file is also part of the key: this protects from
+    modifications that preserve size and modification time, at the cost of
+    reading the file."""
+
+    def __init__(self, folder=None, max_size=DEFAULT_MAX_SIZE, content_hash=False):
+        if folder is None:
+            folder = os.environ.get(ENV_DIR, DEFAULT_DIR)
+        self.folder = pathlib.Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.content_hash = content_hash
+
+    def key(self, kind, path):
+        """Returns the key of the statistics `kind` of a file."""
+        path = pathlib.Path(path).resolve()
+        st = path.stat()
+        key = f"{CACHE_VERSION}|{kind}|{path}|{st.st_size}|{st.st_mtime_ns}"
+        if self.content_hash:
+            key += f"|{file_digest(path)}"
+        return key
+
+    def entry(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+        return self.folder / f"{digest}.npz"
+
+    def _load(self, key):
+        entry = self.entry(key)
+        try:
+            with np.load(entry, allow_pickle=False) as data:
+                if data["_key"].item() != key:
+                    return None
+                stats = {k: data[k] for k in data.files if k != "_key"}
+            os.utime(entry)
+        except (OSError, ValueError, EOFError, KeyError):
+            return None
+        return stats
+
+    def _save(self, key, stats):
+        entry = self.entry(key)
+        tmp = self.folder / f".{entry.name}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                np.savez(f, _key=np.array(key), **stats)
+            size = tmp.stat().st_size
+            os.replace(tmp, entry)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        if self._update_size(size) > self.max_size:
+            self.evict()
+
+    def _update_size(self, n=0, total=None):
+        """Adds `n` bytes to the running total of the size of the cache, or
+        sets it to `total`, and returns it. The total is computed from the
+        entries the first time. Overwritten entries are counted twice, so the
+        total overestimates the size until it is recomputed by `evict`."""
+        with open(self.folder / SIZE_FILE, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            text = f.read().strip()
+            if total is None and text.isdigit():
+                total = int(text) + n
+            elif total is None:
+                total = sum(size for _, size, _ in self.entries())
+            f.seek(0)
+            f.truncate()
+            f.write(str(total))
+        return total
+
+    def get(self, kind, path):
+        """Returns the cached statistics of a file, or None if absent."""
+        return self._load(self.key(kind, path))
+
+    def put(self, kind, path, stats):
+        """Saves the statistics (dictionary of arrays) of a file."""
+        self._save(self.key(kind, path), stats)
+
+    def cached(self, kind, path, compute):
+        """Returns the statistics of a file from the cache, or computes them
+        with `compute(path)` and saves them. The key is computed before the
+        statistics, so that a file modified in the meantime is not cached with
+        outdated statistics."""
+        key = self.key(kind, path)
+        stats = self._load(key)
+        if stats is None:
+            stats = compute(path)
+            self._save(key, stats)
+        return stats
+
+    def entries(self):
+        """Returns the list of (path, size, mtime) of the entries."""
+        res = []
+        for entry in self.folder.glob("*.npz"):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            res.append((entry, st.st_size, st.st_mtime))
+        return res
+
+    def evict(self, max_size=None):
+        """Removes the least recently used entries until the cache is below
+        `max_size`. By default, if the cache exceeds its maximum size, it is
+        reduced to a fraction `LOW_WATER` of it. Returns the number of removed
+        entries, or None if another process is already evicting."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        if max_size is None:
+            max_size = self.max_size * LOW_WATER if total > self.max_size else total
+        if total <= max_size:
+            self._update_size(total=total)
+            return 0
+        with open(self.folder / LOCK_FILE, "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            removed = 0
+            for entry, size, _ in sorted(entries, key=lambda e: e[2]):
+                if total <= max_size:
+                    break
+                entry.unlink(missing_ok=True)
+                total -= size
+                removed += 1
+            self._update_size(total=total)
+        return removed
+
+    def clear(self):
+        return self.evict(max_size=0)
+
+
+def open_cache(enabled=True):
+    """Returns the default cache, or None if disabled or not writable."""
+    if not enabled:
+        return None
+    try:
+        return StatsCache()
+    except OSError as e:
+        print(f"statistics cache disabled: {e}", file=sys.stderr)
+        return None
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="manage the statistics cache")
+    parser.add_argument(
+        "--folder",
+        type=str,
+        help=f"cache folder (default: ${ENV_DIR} or {DEFAULT_DIR})",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("info", help="number and size of the cached entries")
+    subparsers.add_parser("clear", help="remove all entries")
+    p_evict = subparsers.add_parser("evict", help="reduce the size of the cache")
+    p_evict.add_argument("max_size", type=float, help="maximum size (GB)")
+    args = parser.parse_args()
+
+    cache = StatsCache(args.folder)
+    if args.command == "info":
+        entries = cache.entries()
+        size = sum(s for _, s, _ in entries)
+        print(f"{cache.folder}: {len(entries)} entries, {size / 1e6:.1f} MB")
+    elif args.command == "clear":
+        print(f"{cache.clear()} entries removed")
+    elif args.command == "evict":
+        print(f"{cache.evict(args.max_size * 1e9)} entries removed")
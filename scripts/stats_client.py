@@ -0,0 +1,97 @@
+# Client of the statistics daemon (see `stats_daemon.py`). Only the standard
+# library is imported, so that a client call starts in a few tens of
+# milliseconds.
+#
+# Usage:
+#   python3 stats_client.py process /tmp/stats.sock reads_*.fastq.gz
+#   python3 stats_client.py snapshot /tmp/stats.sock
+#   python3 stats_client.py stop /tmp/stats.sock
+
+import argparse
+import json
+import os
+import socket
+import time
+
+
+def request(socket_path, message, timeout=None, wait_start=0):
+    """Sends a request to the daemon and returns its response. If the socket
+    does not exist yet, waits up to `wait_start` seconds for the daemon to
+    start."""
+    deadline = time.monotonic() + wait_start
+    while True:
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            sock.connect(str(socket_path))
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+    with sock, sock.makefile("rwb") as f:
+        f.write(json.dumps(message).encode() + b"\n")
+        f.flush()
+        return json.loads(f.readline())
+
+
+def print_snapshot(snapshot):
+    print(
+        f"{snapshot['files']} files processed, {snapshot['running']} running, "
+        + f"{snapshot['pending_reads']} reads not yet saved"
+    )
+    print(f"{'barcode':<14} {'n_reads':>9} {'tot_bases':>13} {'median_len':>10}")
+    for bc, s in sorted(snapshot["barcodes"].items()):
+        print(
+            f"{bc:<14} {s['n_reads']:>9} {s['tot_bases']:>13} "
+            + f"{s['median_len']:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="send requests to the live basecalling statistics daemon"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_process = subparsers.add_parser("process", help="process fastq files")
+    p_process.add_argument("socket", type=str, help="path of the Unix socket")
+    p_process.add_argument("fastq", type=str, nargs="+", help="fastq files")
+    p_process.add_argument(
+        "--no_wait",
+        help="return as soon as the files are queued",
+        action="store_true",
+    )
+    p_process.add_argument(
+        "--wait_start",
+        type=float,
+        default=60,
+        help="seconds to wait for the daemon to start",
+    )
+    p_snapshot = subparsers.add_parser(
+        "snapshot", help="print the per-barcode statistics"
+    )
+    p_snapshot.add_argument("socket", type=str, help="path of the Unix socket")
+    p_snapshot.add_argument(
+        "--json", help="print the raw json response", action="store_true"
+    )
+    for name in ("checkpoint", "stop"):
+        p = subparsers.add_parser(name, help=f"{name} the daemon")
+        p.add_argument("socket", type=str, help="path of the Unix socket")
+
+    args = parser.parse_args()
+
+    if args.command == "process":
+        paths = [os.path.abspath(f) for f in args.fastq]
+        message = {"cmd": "process", "paths": paths, "wait": not args.no_wait}
+        response = request(args.socket, message, wait_start=args.wait_start)
+    else:
+        response = request(args.socket, {"cmd": args.command})
+
+    if not response["ok"]:
+        exit(f"stats daemon error: {response['error']}")
+    if args.command == "snapshot" and not args.json:
+        print_snapshot(response)
+    elif args.command != "process":
+        print(json.dumps(response))
@@ -0,0 +1,266 @@
+# Long-lived service computing the live basecalling statistics, as an
+# alternative to running `basecall_stats.py` for every batch of basecalled
+# files. The daemon listens on a Unix domain socket for requests to process
+# fastq files, which are parsed by a pool of worker processes, and keeps the
+# per-barcode summary of all reads (see `read_summary.py`) in memory, so that
+# snapshot queries are answered without reading any file.
+#
+# Periodically (and when stopped) the reads processed since the previous
+# checkpoint are saved in a new statistics shard (see `stats_store.py`), and
+# the summary in `summary.npz`, in the statistics folder. Shards are
+# compacted every `--compact_every` checkpoints. When restarted, the daemon
+# loads `summary.npz`, and files that were already processed are skipped.
+#
+# Requests are sent with `stats_client.py`. Each request is a single json
+# line, answered by a single json line:
+#
+#   {"cmd": "process", "paths": [...], "wait": true}
+#   {"cmd": "snapshot"}
+#   {"cmd": "checkpoint"}
+#   {"cmd": "stop"}
+#
+# Usage: python3 stats_daemon.py /tmp/stats.sock runs/test/basecalling_stats
+
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import signal
+import socketserver
+import sys
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from basecall_stats import scan_file
+from read_summary import ReadSummary
+from stats_client import request
+import stats_store
+from stats_cache import open_cache
+
+SUMMARY_NAME = "summary.npz"
+
+
+class StatsDaemon:
+    """In-memory aggregate of the statistics of the processed files, saved
+    to `stats_dir` by `checkpoint`."""
+
+    def __init__(self, stats_dir, jobs=4, cache=None, compact_every=10):
+        self.stats_dir = pathlib.Path(stats_dir)
+        self.stats_dir.mkdir(parents=True, exist_ok=True)
+        self.pool = ProcessPoolExecutor(max_workers=jobs)
+        self.cache = cache
+        self.compact_every = compact_every
+        self.lock = threading.Lock()
+        summary_file = self.stats_dir / SUMMARY_NAME
+        if summary_file.is_file():
+            self.summary = ReadSummary.load(summary_file)
+        else:
+            self.summary = ReadSummary()
+        # shards of the files processed since the last checkpoint
+        self.pending = []
+        # files being processed, to avoid processing a file twice
+        self.running = {}
+        self.n_checkpoints = 0
+
+    def _done(self, path, future, merged):
+        with self.lock:
+            del self.running[path]
+            if future.exception() is None and path not in self.summary.sources:
+                shard, summary = future.result()
+                self.summary.merge(summary, source=path)
+                self.pending.append(shard)
+        if future.exception() is not None:
+            print(f"failed to process {path}: {future.exception()}", file=sys.stderr)
+            merged.set_exception(future.exception())
+        else:
+            merged.set_result(path)
+
+    def process(self, paths):
+        """Schedules the processing of the files, skipping those already
+        processed. Returns futures that are done when the statistics of each
+        file have been added to the summary."""
+        now = datetime.datetime.now()
+        futures, submitted = [], []
+        with self.lock:
+            for path in map(os.path.realpath, paths):
+                if path in self.running:
+                    futures.append(self.running[path])
+                elif path not in self.summary.sources:
+                    merged = Future()
+                    self.running[path] = merged
+                    future = self.pool.submit(scan_file, path, now, self.cache)
+                    submitted.append((path, future, merged))
+                    futures.append(merged)
+        # the callback runs in this thread if the scan is already done, and
+        # takes the lock
+        for path, future, merged in submitted:
+            future.add_done_callback(lambda f, p=path, m=merged: self._done(p, f, m))
+        return futures
+
+    def snapshot(self):
+        """Per-barcode statistics of all the processed reads."""
+        with self.lock:
+            s = self.summary
+            barcodes = {
+                bc: {
+                    "n_reads": int(s.n_reads[i]),
+                    "tot_bases": int(s.tot_bases[i]),
+                    "min_len": int(s.min_len[i]),
+                    "max_len": int(s.max_len[i]),
+                    "median_len": float(s.quantiles(bc, [0.5])[0]),
+                }
+                for i, bc in enumerate(s.barcodes)
+                if s.n_reads[i] > 0
+            }
+            return {
+                "files": len(s.sources),
+                "running": len(self.running),
+                "pending_reads": sum(len(sh["len"]) for sh in self.pending),
+                "barcodes": barcodes,
+            }
+
+    def checkpoint(self):
+        """Saves the reads processed since the last checkpoint in a new
+        shard, and the summary in `summary.npz`. Returns the path of the new
+        shard, or None if no file was processed."""
+        with self.lock:
+            if not self.pending:
+                return None
+            data = stats_store.concat_shards(self.pending)
+            shard = stats_store.save_shard(
+                self.stats_dir / stats_store.shard_name(),
+                data["len"],
+                data["barcode"],
+                data["barcode_names"],
+                data["time"],
+                data["mean_q"],
+            )
+            self.summary.save(self.stats_dir / SUMMARY_NAME)
+            self.pending = []
+            self.n_checkpoints += 1
+        if self.n_checkpoints % self.compact_every == 0:
+            stats_store.compact(self.stats_dir, min_age=0)
+        return shard
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.checkpoint()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            response = self.server.dispatch(request)
+        except Exception as e:
+            response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+        self.wfile.flush()
+        if response.get("stopping"):
+            # shutdown waits for serve_forever, so it cannot run in this thread
+            threading.Thread(target=self.server.shutdown).start()
+
+
+class StatsServer(socketserver.ThreadingUnixStreamServer):
+    """Answers the requests of the clients, one thread per connection, and
+    checkpoints the daemon every `checkpoint_every` seconds."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, stats, checkpoint_every=60):
+        self.socket_path = str(socket_path)
+        if os.path.exists(self.socket_path):
+            try:
+                request(self.socket_path, {"cmd": "snapshot"}, timeout=1)
+            except OSError:
+                os.unlink(self.socket_path)  # left by a daemon that crashed
+            else:
+                raise RuntimeError(f"a daemon is already serving {socket_path}")
+        super().__init__(self.socket_path, RequestHandler)
+        self.stats = stats
+        self.stopped = threading.Event()
+        self.checkpointer = threading.Thread(
+            target=self._checkpoint_loop, args=(checkpoint_every,), daemon=True
+        )
+        self.checkpointer.start()
+
+    def _checkpoint_loop(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                self.stats.checkpoint()
+            except OSError as e:
+                print(f"checkpoint failed: {e}", file=sys.stderr)
+
+    def dispatch(self, request):
+        cmd = request.get("cmd")
+        if cmd == "process":
+            futures = self.stats.process(request["paths"])
+            if not request.get("wait", True):
+                return {"ok": True, "queued": len(futures)}
+            errors = [str(f.exception()) for f in futures if f.exception() is not None]
+            if errors:
+                return {"ok": False, "error": "; ".join(errors)}
+            return {"ok": True, "processed": len(futures)}
+        if cmd == "snapshot":
+            return {"ok": True, **self.stats.snapshot()}
+        if cmd == "checkpoint":
+            shard = self.stats.checkpoint()
+            return {"ok": True, "shard": None if shard is None else str(shard)}
+        if cmd == "stop":
+            return {"ok": True, "stopping": True}
+        raise ValueError(f"unknown command {cmd!r}")
+
+    def server_close(self):
+        self.stopped.set()
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.stats.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="daemon computing the live basecalling statistics"
+    )
+    parser.add_argument("socket", type=str, help="path of the Unix socket")
+    parser.add_argument(
+        "stats_dir", type=str, help="folder where shards and summary are saved"
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=4, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--checkpoint_every",
+        type=float,
+        default=60,
+        help="seconds between checkpoints to the statistics folder",
+    )
+    parser.add_argument(
+        "--compact_every",
+        type=int,
+        default=10,
+        help="number of checkpoints after which shards are compacted",
+    )
+    parser.add_argument(
+        "--cache",
+        help="""use the statistics cache (see `stats_cache.py`). Off by default,
+        since each batch file is usually scanned only once.""",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    daemon = StatsDaemon(
+        args.stats_dir,
+        jobs=args.jobs,
+        cache=open_cache(args.cache),
+        compact_every=args.compact_every,
+    )
+    with StatsServer(args.socket, daemon, args.checkpoint_every) as server:
+        # stopping with SIGTERM also saves a last checkpoint
+        signal.signal(
+            signal.SIGTERM,
+            lambda *_: threading.Thread(target=server.shutdown).start(),
+        )
+        print(f"serving on {args.socket}", flush=True)
+        server.serve_forever()
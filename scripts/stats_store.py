@@ -0,0 +1,207 @@
+# Append-only store for the live basecalling statistics. Every batch of reads
+# is saved in a small immutable `.npz` shard containing read length, barcode,
+# time and mean quality. New shards are periodically merged in a compacted
+# shard, so that the number of files stays small. Compacted shards are never
+# merged again, so the cost of a compaction only depends on the new shards.
+# The reader presents all shards in a folder as a single table.
+
+import argparse
+import datetime
+import fcntl
+import os
+import pathlib
+import time
+import uuid
+import numpy as np
+
+SHARD_PREFIX = "shard_"
+COMPACT_PREFIX = "compact_"
+LOCK_FILE = ".compact.lock"
+
+
+def shard_name(prefix=SHARD_PREFIX):
+    """Returns a unique, time-sortable file name for a new shard."""
+    now = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    return f"{prefix}{now}_{uuid.uuid4().hex[:8]}.npz"
+
+
+def save_shard(path, lengths, barcodes, barcode_names, times, mean_q=None, sources=()):
+    """Atomically saves a shard. `barcodes` contains indices in the
+    `barcode_names` list (negative for reads without barcode), `times` is an
+    array of `datetime64` timestamps, one per read, and `mean_q` the mean
+    quality of each read (NaN if unknown). For compacted shards `sources` is
+    the list of names of the merged shards."""
+    path = pathlib.Path(path)
+    if mean_q is None:
+        mean_q = np.full(len(lengths), np.nan)
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "wb") as f:
+        np.savez(
+            f,
+            len=np.asarray(lengths, dtype=np.int64),
+            barcode=np.asarray(barcodes, dtype=np.int32),
+            barcode_names=np.array(barcode_names, dtype=str),
+            time=np.asarray(times, dtype="datetime64[ms]"),
+            mean_q=np.asarray(mean_q, dtype=np.float32),
+            sources=np.array(sources, dtype=str),
+        )
+    os.replace(tmp, path)
+    return path
+
+
+def load_shard(path):
+    """Loads a shard in a dictionary of arrays."""
+    with np.load(path, allow_pickle=False) as data:
+        shard = {k: data[k] for k in data.files}
+    # shards saved before read qualities were recorded
+    if "mean_q" not in shard:
+        shard["mean_q"] = np.full(len(shard["len"]), np.nan, dtype=np.float32)
+    return shard
+
+
+def list_shards(fld):
+    """Returns the list of shards in the folder that have not been merged
+    in a compacted shard yet. Shards that cannot be read (e.g. because they
+    are still being copied) are skipped."""
+    fld = pathlib.Path(fld)
+    files = sorted(fld.glob(f"{COMPACT_PREFIX}*.npz")) + sorted(
+        fld.glob(f"{SHARD_PREFIX}*.npz")
+    )
+    shards, merged = {}, set()
+    for f in files:
+        try:
+            shards[f.name] = load_shard(f)
+        except (OSError, ValueError, EOFError):
+            continue
+        merged.update(shards[f.name]["sources"].tolist())
+    return [(name, sh) for name, sh in shards.items() if name not in merged]
+
+
+def concat_shards(shards):
+    """Merges a list of shards in a single one, with a common list of
+    barcode names."""
+    names = sorted({n for sh in shards for n in sh["barcode_names"].tolist()})
+    codes = {n: i for i, n in enumerate(names)}
+    barcodes = []
+    for sh in shards:
+        remap = np.array([codes[n] for n in sh["barcode_names"].tolist()] + [-1])
+        # negative codes (no barcode) are mapped to the last entry, i.e. -1
+        barcodes.append(remap[sh["barcode"]])
+    return {
+        "len": np.concatenate([sh["len"] for sh in shards] + [np.empty(0, int)]),
+        "barcode": np.concatenate(barcodes + [np.empty(0, int)]),
+        "barcode_names": np.array(names, dtype=str),
+        "time": np.concatenate(
+            [sh["time"] for sh in shards] + [np.empty(0, "datetime64[ms]")]
+        ),
+        "mean_q": np.concatenate(
+            [sh["mean_q"] for sh in shards] + [np.empty(0, np.float32)]
+        ),
+    }
+
+
+def read_stats(fld):
+    """Returns a dataframe with columns `len`, `barcode`, `time` and `mean_q`,
+    containing the reads of all shards in the folder."""
+    import pandas as pd
+
+    data = concat_shards([sh for _, sh in list_shards(fld)])
+    barcode = np.append(data["barcode_names"], None)[data["barcode"]]
+    return pd.DataFrame(
+        {
+            "len": data["len"],
+            "barcode": barcode,
+            "time": data["time"],
+            "mean_q": data["mean_q"],
+        }
+    )
+
+
+def merged_sources(fld):
+    """Returns the names of the shards merged in the compacted shards of the
+    folder."""
+    merged = set()
+    for f in pathlib.Path(fld).glob(f"{COMPACT_PREFIX}*.npz"):
+        try:
+            with np.load(f, allow_pickle=False) as data:
+                merged.update(data["sources"].tolist())
+        except (OSError, ValueError, EOFError, KeyError):
+            continue
+    return merged
+
+
+def compact(fld, min_age=60):
+    """Merges the new (not compacted) shards of the folder that are older
+    than `min_age` seconds in a compacted shard, and removes the merged files.
+    Returns the path of the compacted shard, or None if there was nothing to
+    compact or another compaction is running."""
+    fld = pathlib.Path(fld)
+    with open(fld / LOCK_FILE, "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        merged = merged_sources(fld)
+        now = time.time()
+        shards = []
+        for f in sorted(fld.glob(f"{SHARD_PREFIX}*.npz")):
+            if f.name in merged:
+                # left by a compaction interrupted before removing it
+                f.unlink(missing_ok=True)
+                continue
+            if now - f.stat().st_mtime < min_age:
+                continue
+            try:
+                shards.append((f.name, load_shard(f)))
+            except (OSError, ValueError, EOFError):
+                continue
+        if len(shards) < 2:
+            return None
+        # merged files are recorded, so that readers can skip them until they
+        # are removed
+        sources = [name for name, _ in shards]
+        data = concat_shards([sh for _, sh in shards])
+        out = save_shard(
+            fld / shard_name(COMPACT_PREFIX),
+            data["len"],
+            data["barcode"],
+            data["barcode_names"],
+            data["time"],
+            data["mean_q"],
+            sources=sources,
+        )
+        for name, _ in shards:
+            (fld / name).unlink()
+    return out
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="manage the folder of live basecalling statistics shards"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_compact = subparsers.add_parser(
+        "compact", help="merge shards in a single compacted shard"
+    )
+    p_compact.add_argument("fld", type=str, help="folder containing the shards")
+    p_compact.add_argument(
+        "--min_age",
+        type=float,
+        default=60,
+        help="only merge shards older than this number of seconds",
+    )
+    p_export = subparsers.add_parser(
+        "export", help="export the content of all shards in a csv file"
+    )
+    p_export.add_argument("fld", type=str, help="folder containing the shards")
+    p_export.add_argument("csv_file", type=str, help="destination csv file")
+
+    args = parser.parse_args()
+
+    if args.command == "compact":
+        out = compact(args.fld, min_age=args.min_age)
+        if out is not None:
+            print(f"shards merged in {out}")
+    elif args.command == "export":
+        read_stats(args.fld).to_csv(args.csv_file, index=False)